@@ -30,10 +30,13 @@ setup(
     install_requires=[
         'tomtoolkit>=2.12,<3.0',
         'antares-client>=1.4,<2.0',
-        'elasticsearch-dsl>=7.3,<7.5'
+        'elasticsearch-dsl>=7.3,<7.5',
+        'numpy>=1.20'
     ],
     extras_require={
-        'test': ['factory_boy>=3.1,<3.4']
+        'test': ['factory_boy>=3.1,<3.4', 'pyarrow>=10.0', 'httpx>=0.23'],
+        'export': ['pyarrow>=10.0'],
+        'async': ['httpx>=0.23']
     },
     include_package_data=True,
 )
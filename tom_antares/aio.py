@@ -0,0 +1,167 @@
+import asyncio
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from importlib.util import find_spec
+from urllib.parse import urljoin
+
+import requests
+
+from tom_antares.metrics import metrics
+from tom_antares.transport import http_transport
+from tom_antares.utils import LazyModule, get_antares_setting
+
+# httpx is an optional dependency, installed with the 'async' extra: pip install tom-antares[async]
+httpx = LazyModule('httpx')
+antares_config = LazyModule('antares_client.config')
+
+DEFAULT_ASYNC_MAX_CONNECTIONS = 10
+
+
+class TransportError(Exception):
+    '''
+    Raised by ``AsyncANTARESClient`` when a request fails without a response, e.g. when
+    ANTARES cannot be reached or does not answer within the timeout.
+    '''
+
+
+class HTTPXTransport:
+    '''
+    Sends requests with an ``httpx.AsyncClient``, which keeps up to ``max_connections``
+    connections alive between requests. Requests are paced by the rate limiter of
+    ``http_transport``, when one is configured, without blocking the event loop.
+    '''
+
+    def __init__(self, max_connections, timeout):
+        self.errors = (httpx.TransportError,)
+        connect_timeout, read_timeout = http_transport.timeout(timeout)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    async def get(self, url, params=None):
+        rate_limiter = http_transport.rate_limiter
+        if rate_limiter is not None:
+            delay = rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return await self.client.get(url, params=params)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ThreadedTransport:
+    '''
+    Sends requests through ``http_transport``, sharing its connection pool, rate limiter and
+    timeouts with the sync broker calls, on a pool of ``max_connections`` threads so that the
+    event loop is never blocked. Used when httpx is not installed.
+    '''
+    errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def __init__(self, max_connections, timeout):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='tom_antares_async')
+
+    async def get(self, url, params=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(http_transport.get, url, params=params, timeout=self.timeout)
+        )
+
+    async def aclose(self):
+        self._executor.shutdown(wait=False)
+
+
+TRANSPORTS = {'httpx': HTTPXTransport, 'threads': ThreadedTransport}
+
+
+class AsyncANTARESClient:
+    '''
+    Pooled async HTTP client for the ANTARES API, used by the async methods of
+    ``ANTARESBroker`` so that many queries can run concurrently on one event loop.
+
+    Requests are sent with httpx when it is installed, and otherwise from a pool of threads
+    (see ``ThreadedTransport``); the ``async_transport`` setting, ``'httpx'`` or ``'threads'``,
+    chooses one explicitly. At most ``async_max_connections`` requests are in flight at once,
+    and connections are kept alive between them. Either way, requests share the rate limit and
+    timeouts of ``tom_antares.transport.http_transport`` with the sync broker calls.
+
+    A client belongs to the event loop it is used on. Use it as an async context manager, or
+    share the client of the running loop returned by ``get_async_client``:
+
+        async with AsyncANTARESClient() as client:
+            alerts = [alert async for alert in ANTARESBroker().afetch_alerts(parameters, client=client)]
+    '''
+
+    def __init__(self, max_connections=None, timeout=None, transport=None):
+        self.max_connections = max_connections or get_antares_setting(
+            'async_max_connections', DEFAULT_ASYNC_MAX_CONNECTIONS
+        )
+        self.timeout = timeout or antares_config.config['API_TIMEOUT']
+        transport = transport or get_antares_setting('async_transport') or (
+            'httpx' if find_spec('httpx') else 'threads'
+        )
+        self.transport = TRANSPORTS[transport](self.max_connections, self.timeout)
+
+    @staticmethod
+    def url(path):
+        '''
+        Returns the URL of a path of the ANTARES API. Absolute URLs, such as the links to the
+        next page of a search, are returned unchanged.
+        '''
+        return urljoin(antares_config.config['ANTARES_API_BASE_URL'], path)
+
+    async def get(self, path, params=None):
+        '''
+        Sends a GET request for a path of the ANTARES API, or an absolute URL, and returns the
+        response, whatever its status.
+
+        :raises TransportError: if no response was received
+        '''
+        url = self.url(path)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = await self.transport.get(url, params=params)
+            return response
+        except self.transport.errors as e:
+            raise TransportError(f'Request to {url} failed: {e}') from e
+        finally:
+            if metrics.enabled:
+                metrics.record_request(url, time.perf_counter() - start, response)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+# The shared client of each running event loop, dropped along with the loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    '''
+    Returns the ``AsyncANTARESClient`` shared by the async broker calls made on the running
+    event loop, creating it on first use.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncANTARESClient()
+    return client
+
+
+async def close_async_client():
+    '''
+    Closes the shared client of the running event loop, e.g. when an async service shuts down.
+    '''
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -1,22 +1,772 @@
+import asyncio
+import heapq
+import json
 import logging
+import math
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 
-import antares_client
-import marshmallow
-from antares_client.search import get_available_tags, get_by_ztf_object_id, get_by_id
-from astropy.time import Time, TimezoneInfo
+import requests
 from datetime import datetime, timezone
-from crispy_forms.layout import HTML, Div, Fieldset, Layout
 from django import forms
+from django.db import IntegrityError, transaction
+from django.utils import timezone as django_timezone
 from tom_alerts.alerts import GenericAlert, GenericBroker, GenericQueryForm
+from tom_dataproducts.models import ReducedDatum
 from tom_targets.models import Target, TargetName
 
+from tom_antares.aio import TransportError, get_async_client
+from tom_antares.cache import LocusCache, QueryCache, TagCache
+from tom_antares.features import FEATURE_NAMES, add_features
+from tom_antares.metrics import metrics
+from tom_antares.models import QueryWatermark
+from tom_antares.sky_index import sky_index
+from tom_antares.transport import route_antares_client
+from tom_antares.utils import (  # noqa: F401, angular_separation is part of this module's interface
+    LazyModule, RateLimiter, angular_separation, chunked, get_antares_setting, numeric_or_nan, parse_ids,
+    run_concurrently
+)
+
+# Imported on first use, as are astropy and crispy_forms, so that loading the broker is cheap
+antares_client = LazyModule('antares_client', on_import=route_antares_client)
+marshmallow = LazyModule('marshmallow')
+np = LazyModule('numpy')
+
 logger = logging.getLogger(__name__)
 
 ANTARES_BASE_URL = 'https://antares.noirlab.edu'
 
+# Number of loci whose separations are computed together when cone searches are filtered client-side
+CONE_FILTER_CHUNK_SIZE = 50
+
+# Number of rows written per INSERT, and names per lookup, when objects are created in bulk
+BULK_CREATE_CHUNK_SIZE = 500
+
+# Number of ZTF object ids combined into each terms query by fetch_loci_by_ztf_object_id, which
+# keeps the query within URL length limits
+ZTF_ID_CHUNK_SIZE = 100
+DEFAULT_LOOKUP_MAX_WORKERS = 8
+DEFAULT_LOOKUP_TIMEOUT = 60
+
+# The end of the last_day window is rounded up to a multiple of this many days, so that the same
+# query is sent, and can be served from the query cache, for five minutes at a time
+LAST_DAY_RESOLUTION = 5 / 1440
+
+# HTTP statuses on which resilient searches retry a page
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_SEARCH_RETRIES = 3
+DEFAULT_SEARCH_RETRY_BACKOFF = 1.0
+
+# Number of loci per page requested by count_loci, when ANTARES does not report a count, and by
+# search_projected, whose loci are small enough to fetch many at a time
+COUNT_PAGE_SIZE = 1000
+PROJECTED_PAGE_SIZE = 1000
+
+# Sharded searches: the default number of worker threads, and the number of loci the shards may
+# fetch ahead of the consumer
+DEFAULT_SHARD_MAX_WORKERS = 8
+SHARD_QUEUE_SIZE = 1000
+
+# Form parameters which, in addition to a cone, constrain a search
+CONE_SEARCH_CONSTRAINTS = [
+    'ztfid', 'antid', 'tag', 'nobs__gt', 'nobs__lt', 'mjd__gt', 'mjd__lt', 'last_day', 'mag__min', 'mag__max',
+    'esquery', 'newest_alert_observation_time__gte',
+]
+
+LookupResult = namedtuple('LookupResult', ['id', 'locus', 'error'])
+
+# ZTF filter ids, as found in the ztf_fid alert property
+ZTF_FILTERS = {1: 'g', 2: 'r', 3: 'i'}
+
+# Locus and alert properties kept by compact serialization, in addition to the
+# compact_properties and compact_alert_properties settings
+COMPACT_PROPERTIES = [
+    'ztf_object_id', 'horizons_targetname', 'newest_alert_observation_time', 'newest_alert_magnitude',
+]
+COMPACT_ALERT_PROPERTIES = ['ztf_fid', 'ztf_magpsf', 'ztf_sigmapsf', 'ztf_diffmaglim', 'ztf_rb']
+
+# Locus properties kept by search_projected, enough to list loci, plot them and make targets
+PROJECTED_PROPERTIES = COMPACT_PROPERTIES + ['num_mag_values', 'oldest_alert_observation_time']
+
+# Orders of fetch_alerts results: a field, prefixed with '-' for descending order. ANTARES sorts
+# on the locus properties in SERVER_SORT_FIELDS. Other fields, light-curve features or properties
+# of the newest alert, are computed for up to sort_scan_limit loci, and the best kept locally.
+DEFAULT_SORT = '-newest_alert_observation_time'
+SERVER_SORT_FIELDS = [
+    'newest_alert_observation_time', 'newest_alert_magnitude', 'brightest_alert_magnitude', 'num_mag_values',
+]
+SORT_CHOICES = [
+    ('-newest_alert_observation_time', 'Most recently observed'),
+    ('newest_alert_magnitude', 'Brightest latest alert'),
+    ('brightest_alert_magnitude', 'Brightest alert'),
+    ('-num_mag_values', 'Most measurements'),
+    ('-ztf_rb', 'Highest real/bogus score of the latest alert'),
+    ('-rise_rate', 'Fastest rising'),
+    ('days_since_first_detection', 'Most recently detected first'),
+]
+DEFAULT_SORT_SCAN_LIMIT = 1000
+
+# Loci serialized together when light-curve features are attached, so that their features are
+# computed by one vectorized add_features call per page of results rather than per locus
+FEATURES_BATCH_SIZE = 100
+
+
+def cone_search_filters(ra, dec, radius):
+    '''
+    Returns Elasticsearch filters for the smallest RA/Dec box containing the cone.
+
+    The RA half-width is widened by 1/cos(dec), the box covers every RA when the cone
+    contains a pole, and it is split in two when it crosses RA=0/360. Loci in the corners
+    of the box still need to be removed with ``within_cone``.
+    '''
+    dec_min = max(dec - radius, -90.0)
+    dec_max = min(dec + radius, 90.0)
+    filters = [{'range': {'dec': {'gte': dec_min, 'lte': dec_max}}}]
+    if dec_min <= -90.0 or dec_max >= 90.0:
+        return filters
+
+    half_width = np.degrees(np.arcsin(min(np.sin(np.radians(radius)) / np.cos(np.radians(dec)), 1.0)))
+    ra_min = ra - half_width
+    ra_max = ra + half_width
+    if ra_min < 0.0:
+        filters.append({'bool': {'should': [
+            {'range': {'ra': {'gte': ra_min + 360.0}}},
+            {'range': {'ra': {'lte': ra_max}}},
+        ], 'minimum_should_match': 1}})
+    elif ra_max > 360.0:
+        filters.append({'bool': {'should': [
+            {'range': {'ra': {'gte': ra_min}}},
+            {'range': {'ra': {'lte': ra_max - 360.0}}},
+        ], 'minimum_should_match': 1}})
+    else:
+        filters.append({'range': {'ra': {'gte': ra_min, 'lte': ra_max}}})
+    return filters
+
+
+def within_cone(loci, ra, dec, radius, chunk_size=CONE_FILTER_CHUNK_SIZE):
+    '''
+    Lazily yields the loci lying within ``radius`` degrees of (``ra``, ``dec``), computing
+    the separations for ``chunk_size`` loci at a time. Loci may be ``antares_client`` loci
+    or dicts with ``ra`` and ``dec`` keys, such as those from ``search_projected``.
+    '''
+    for chunk in chunked(loci, chunk_size):
+        positions = [(locus['ra'], locus['dec']) if isinstance(locus, dict) else (locus.ra, locus.dec)
+                     for locus in chunk]
+        separations = angular_separation(
+            ra, dec, [position[0] for position in positions], [position[1] for position in positions]
+        )
+        for locus, separation in zip(chunk, separations):
+            if separation <= radius:
+                yield locus
+
+
+class SearchReport:
+    '''
+    Summary of a search by ``ANTARESBroker.fetch_alerts``, available from the broker's
+    ``search_report`` attribute once iteration has finished.
+
+    ``complete`` is False if the search stopped early because of an invalid locus, which only
+    happens when ``resilient_search`` is off, or if a shard of a sharded search failed.
+    ``skipped_ids`` lists the loci skipped because they could not be deserialized. For sharded
+    searches, ``shards`` is the ``ShardedSearch.state`` from which the search can be resumed.
+    '''
+
+    def __init__(self):
+        self.pages = 0
+        self.loci = 0
+        self.retries = 0
+        self.skipped_ids = []
+        self.complete = True
+        self.shards = None
+
+    @property
+    def num_skipped(self):
+        return len(self.skipped_ids)
+
+    def merge(self, other):
+        '''
+        Adds the pages, retries and skipped loci of another report, e.g. of a shard, to this one.
+        '''
+        self.pages += other.pages
+        self.retries += other.retries
+        self.skipped_ids.extend(other.skipped_ids)
+        self.complete = self.complete and other.complete
+        self.shards = other.shards if other.shards is not None else self.shards
+
+    def __repr__(self):
+        return (f'SearchReport(pages={self.pages}, loci={self.loci}, retries={self.retries}, '
+                f'skipped={self.num_skipped}, complete={self.complete})')
+
+
+def page_body(response):
+    '''
+    Returns the JSON body of a response to a page request which is not to be retried.
+
+    :raises AntaresException: if the response is an HTTP error, or its body is not JSON
+    '''
+    try:
+        body = response.json()
+    except ValueError:
+        raise antares_client.AntaresException(
+            f'HTTP {response.status_code} response from ANTARES is not JSON: {response.text[:200]}'
+        )
+    if response.status_code >= 400:
+        raise antares_client.AntaresException(body)
+    return body
+
+
+def search_pages(query, report=None, params=None, retries=None, backoff=None, sleep=time.sleep,
+                 rate_limiter=None):
+    '''
+    Lazily yields the JSON bodies of the pages of results of an Elasticsearch query of the
+    ANTARES loci, sorted like ``antares_client.search.search``. ``params`` are added to the
+    request for the first page, e.g. ``page[limit]`` or ``fields[locus_listing]``; ANTARES
+    carries them over to the links to the following pages.
+
+    Failed page requests, whether connection errors or HTTP 429 and 5xx responses, are
+    retried from the same page up to ``retries`` times, waiting ``backoff`` seconds and then
+    twice as long after each further failure. These default to the ``search_retries`` and
+    ``search_retry_backoff`` settings. Other errors, such as an HTTP 400 for an invalid
+    query, raise at once, as described in ``page_body``. A ``RateLimiter`` may be given to
+    pace the requests.
+    '''
+    report = report if report is not None else SearchReport()
+    retries = retries if retries is not None else get_antares_setting('search_retries', DEFAULT_SEARCH_RETRIES)
+    backoff = backoff if backoff is not None else get_antares_setting(
+        'search_retry_backoff', DEFAULT_SEARCH_RETRY_BACKOFF
+    )
+    antares_api = antares_client._api.api
+    antares_config = antares_client.config.config
+    url = urljoin(antares_config['ANTARES_API_BASE_URL'], 'loci')
+    params = {
+        'sort': '-properties.newest_alert_observation_time',
+        'elasticsearch_query[locus_listing]': json.dumps(query),
+        **(params or {}),
+    }
+    while url:
+        for attempt in range(0, retries + 1):
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            try:
+                response = antares_api.requests.get(url, params=params, timeout=antares_config['API_TIMEOUT'])
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+                error = f'HTTP {response.status_code}'
+            if attempt == retries:
+                raise antares_client.AntaresException(f'Failed to fetch {url} after {retries + 1} attempts: {error}')
+            delay = backoff * 2 ** attempt
+            logger.warning(f'Failed to fetch a page of ANTARES results ({error}), retrying in {delay}s')
+            report.retries += 1
+            metrics.increment('tom_antares_retries_total')
+            sleep(delay)
+        body = page_body(response)
+
+        report.pages += 1
+        yield body
+        url = body.get('links', {}).get('next')
+        params = None
+
+
+async def asearch_pages(query, client=None, report=None, params=None, retries=None, backoff=None):
+    '''
+    Async version of ``search_pages``: an async iterator over the JSON bodies of the pages of
+    results of an Elasticsearch query, requested with an ``AsyncANTARESClient``, by default
+    the shared client of the running event loop. Failed pages are retried as by
+    ``search_pages``, without blocking the event loop while waiting.
+    '''
+    client = client or get_async_client()
+    report = report if report is not None else SearchReport()
+    retries = retries if retries is not None else get_antares_setting('search_retries', DEFAULT_SEARCH_RETRIES)
+    backoff = backoff if backoff is not None else get_antares_setting(
+        'search_retry_backoff', DEFAULT_SEARCH_RETRY_BACKOFF
+    )
+    url = 'loci'
+    params = {
+        'sort': '-properties.newest_alert_observation_time',
+        'elasticsearch_query[locus_listing]': json.dumps(query),
+        **(params or {}),
+    }
+    while url:
+        for attempt in range(0, retries + 1):
+            try:
+                response = await client.get(url, params=params)
+            except TransportError as e:
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+                error = f'HTTP {response.status_code}'
+            if attempt == retries:
+                raise antares_client.AntaresException(
+                    f'Failed to fetch {client.url(url)} after {retries + 1} attempts: {error}'
+                )
+            delay = backoff * 2 ** attempt
+            logger.warning(f'Failed to fetch a page of ANTARES results ({error}), retrying in {delay}s')
+            report.retries += 1
+            metrics.increment('tom_antares_retries_total')
+            await asyncio.sleep(delay)
+        body = page_body(response)
+
+        report.pages += 1
+        yield body
+        url = body.get('links', {}).get('next')
+        params = None
+
+
+def search_loci(query, report=None, **kwargs):
+    '''
+    Lazily yields the loci matching an Elasticsearch query, in the same order as
+    ``antares_client.search.search``, but without giving up on the rest of the results when
+    something goes wrong.
+
+    Each locus in a page is deserialized separately, and those that fail are skipped and their
+    ids added to ``report.skipped_ids``. Failed pages are retried as described in
+    ``search_pages``, which takes the same keyword arguments.
+    '''
+    report = report if report is not None else SearchReport()
+    schema = antares_client._api.schemas._LocusListingSchema(partial=True)
+    for body in search_pages(query, report, **kwargs):
+        yield from page_loci(body, schema, report)
+
+
+def page_loci(body, schema, report):
+    '''
+    Lazily yields the loci of a page of search results, deserialized one at a time with
+    ``schema``. Those that fail are skipped and their ids added to ``report.skipped_ids``.
+    '''
+    for item in body.get('data', []):
+        try:
+            locus = schema.load({'data': item})
+        except marshmallow.exceptions.ValidationError as e:
+            logger.warning(f'Skipping ANTARES locus {item.get("id")}, which could not be deserialized: {e}')
+            report.skipped_ids.append(item.get('id'))
+            metrics.increment('tom_antares_dropped_loci_total', reason='invalid')
+            continue
+        yield locus
+
+
+def count_loci(query, **kwargs):
+    '''
+    Returns the number of loci matching an Elasticsearch query.
+
+    A single locus is requested and the total is read from the ``count`` ANTARES reports in
+    the response's ``meta``. Should it be missing, the loci are counted from pages of
+    ``COUNT_PAGE_SIZE`` loci projected to their RA. Takes the keyword arguments of
+    ``search_pages``.
+    '''
+    pages = search_pages(query, params={'page[limit]': 1, 'fields[locus_listing]': 'ra'}, **kwargs)
+    count = next(pages).get('meta', {}).get('count')
+    if count is not None:
+        return count
+    pages = search_pages(query, params={'page[limit]': COUNT_PAGE_SIZE, 'fields[locus_listing]': 'ra'}, **kwargs)
+    return sum(len(body.get('data', [])) for body in pages)
+
+
+def search_projected(query, properties=None, report=None, **kwargs):
+    '''
+    Lazily yields the loci matching an Elasticsearch query as dicts of only their
+    ``locus_id``, ``ra``, ``dec``, ``tags`` and the given ``properties``, by default
+    ``PROJECTED_PROPERTIES``.
+
+    ANTARES is asked for just these attributes, with a JSON:API sparse fieldset, in pages of
+    ``PROJECTED_PAGE_SIZE`` loci. The loci are not deserialized into ``antares_client``
+    objects and their alerts are never requested, so the dicts have an empty ``alerts`` list.
+    Takes the keyword arguments of ``search_pages``.
+    '''
+    properties = set(properties if properties is not None else PROJECTED_PROPERTIES)
+    params = {'page[limit]': PROJECTED_PAGE_SIZE, 'fields[locus_listing]': 'ra,dec,properties,tags'}
+    for body in search_pages(query, report, params=params, **kwargs):
+        for item in body.get('data', []):
+            attributes = item.get('attributes', {})
+            yield {
+                'locus_id': item.get('id'),
+                'ra': attributes.get('ra'),
+                'dec': attributes.get('dec'),
+                'properties': {k: v for k, v in attributes.get('properties', {}).items() if k in properties},
+                'tags': attributes.get('tags', []),
+                'alerts': [],
+            }
+
+
+def shard_ranges(start, end, num_shards):
+    '''
+    Splits ``[start, end]`` into ``num_shards`` disjoint Elasticsearch ranges of equal width,
+    each including its start and all but the last excluding their end.
+    '''
+    width = (end - start) / num_shards
+    bounds = [start + i * width for i in range(0, num_shards)] + [end]
+    return [
+        {'gte': lower, 'lt': upper} if i < num_shards - 1 else {'gte': lower, 'lte': upper}
+        for i, (lower, upper) in enumerate(zip(bounds, bounds[1:]))
+    ]
+
+
+class ShardStopped(Exception):
+    pass
+
+
+class ShardedSearch:
+    '''
+    Runs an Elasticsearch query of the ANTARES loci as ``num_shards`` searches, each restricted
+    to a disjoint slice of ``field`` between ``start`` and ``end``, e.g. of
+    ``properties.newest_alert_observation_time`` or of ``ra``. The shards are fetched with
+    ``search_loci`` on a pool of ``max_workers`` threads, pacing their requests with a shared
+    ``RateLimiter`` when ``rate_limit`` requests per second is given:
+
+        search = ShardedSearch(query, 'properties.newest_alert_observation_time', 58000, 60000, 16)
+        loci = list(search.search(max_alerts=100000))
+
+    Loci are yielded as the shards return them, so they are not in any particular order, and
+    once each, should a locus move between shards during the search. Iteration ends once
+    ``max_alerts`` loci have been yielded or every shard has finished, and the shard threads
+    have stopped once it ends.
+
+    ``state`` records the range of each shard, how many of its loci were consumed, whether
+    yielded or skipped as invalid, and whether it has finished or failed. It can be saved as
+    JSON, and a search that failed or stopped early is resumed by passing its ``state`` to a
+    new ``ShardedSearch``, which only requests the loci that were not consumed yet.
+    ``report`` is a ``SearchReport`` of the last search.
+    '''
+
+    def __init__(self, query, field=None, start=None, end=None, num_shards=None, max_workers=None, rate_limit=None,
+                 state=None):
+        self.query = query
+        self.state = state if state is not None else [
+            {'field': field, 'range': bounds, 'offset': 0, 'done': False, 'error': None}
+            for bounds in shard_ranges(start, end, num_shards)
+        ]
+        self.max_workers = max_workers or min(len(self.state), DEFAULT_SHARD_MAX_WORKERS)
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.report = SearchReport()
+
+    def shard_query(self, shard):
+        return {'query': {'bool': {'filter': [
+            self.query['query'], {'range': {shard['field']: shard['range']}}
+        ]}}}
+
+    def search(self, max_alerts=float('inf')) -> iter:
+        '''
+        Lazily yields the loci of the shards that have not finished yet, at most ``max_alerts``.
+        '''
+        self.report = report = SearchReport()
+        report.shards = self.state
+        pending = [shard for shard in self.state if not shard['done']]
+        results = queue.Queue(maxsize=SHARD_QUEUE_SIZE)
+        stop = threading.Event()
+        finished = object()
+        shard_reports = []
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    return results.put(item, timeout=0.1)
+                except queue.Full:
+                    pass
+
+        def backoff(seconds):
+            # Abandons a shard waiting to retry a request once the search has stopped
+            if stop.wait(seconds):
+                raise ShardStopped()
+
+        def run(shard):
+            shard_report = SearchReport()
+            shard_reports.append(shard_report)
+            counted = 0
+
+            def skipped():
+                # Loci skipped as invalid since the last item put, which the shard's offset counts too
+                nonlocal counted
+                count = shard_report.num_skipped - counted
+                counted += count
+                return count
+
+            try:
+                loci = search_loci(self.shard_query(shard), shard_report, params={'page[offset]': shard['offset']},
+                                   sleep=backoff, rate_limiter=self.rate_limiter)
+                for locus in loci:
+                    if stop.is_set():
+                        return
+                    put((shard, locus, skipped()))
+                put((shard, finished, skipped()))
+            except ShardStopped:
+                pass
+            except Exception as e:
+                put((shard, e, skipped()))
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='tom_antares_shard')
+        for shard in pending:
+            shard['error'] = None
+            executor.submit(run, shard)
+        seen = set()
+        try:
+            while pending and report.loci < max_alerts:
+                shard, item, skipped = results.get()
+                shard['offset'] += skipped
+                if item is finished:
+                    shard['done'] = True
+                    pending.remove(shard)
+                elif isinstance(item, Exception):
+                    logger.warning(f'Shard {shard["field"]} {shard["range"]} of an ANTARES search failed: {item}')
+                    shard['error'] = str(item)
+                    report.complete = False
+                    pending.remove(shard)
+                else:
+                    shard['offset'] += 1
+                    if item.locus_id in seen:
+                        metrics.increment('tom_antares_dropped_loci_total', reason='duplicate')
+                        continue
+                    seen.add(item.locus_id)
+                    report.loci += 1
+                    yield item
+        finally:
+            stop.set()
+            # The shards stop at their next locus or retry, and must have stopped updating their
+            # reports before these are merged
+            executor.shutdown(wait=True, cancel_futures=True)
+            for shard_report in shard_reports:
+                report.merge(shard_report)
+
+    def __iter__(self):
+        return self.search()
+
+
+def is_compact(alert):
+    return isinstance(alert['alerts'], dict)
+
+
+def locus_alerts(alert):
+    '''
+    Returns the alerts of a serialized locus as a list of ``alert_id``/``mjd``/``properties``
+    dicts, expanding the columns of a compact locus.
+    '''
+    if not is_compact(alert):
+        return alert['alerts']
+    columns = {name: values.tolist() for name, values in alert['alerts']['properties'].items()}
+    return [
+        {
+            'alert_id': alert_id,
+            'mjd': mjd,
+            'properties': {name: values[i] for name, values in columns.items() if not np.isnan(values[i])},
+        }
+        for i, (alert_id, mjd) in enumerate(zip(alert['alerts']['alert_id'], alert['alerts']['mjd'].tolist()))
+    ]
+
+
+def newest_alert_property(alert, key, default=''):
+    '''
+    Returns a property of the last alert of a serialized locus, or ``default`` if it has none.
+    '''
+    if not is_compact(alert):
+        return alert['alerts'][-1]['properties'].get(key, default) if alert['alerts'] else default
+    values = alert['alerts']['properties'].get(key)
+    if values is None or not len(values) or np.isnan(values[-1]):
+        return default
+    return values[-1].item()
+
+
+def merge_alerts(previous, updates):
+    '''
+    Merges newly fetched alerts into a previous list of results. Alerts in ``updates`` replace
+    those with the same ``locus_id``, and the result is ordered newest first, as ANTARES
+    returns it.
+    '''
+    merged = {alert['locus_id']: alert for alert in previous}
+    merged.update((alert['locus_id'], alert) for alert in updates)
+    return sorted(
+        merged.values(),
+        key=lambda alert: alert['properties'].get('newest_alert_observation_time') or 0,
+        reverse=True,
+    )
+
+
+def is_server_sort(sort):
+    return sort.lstrip('-') in SERVER_SORT_FIELDS
+
+
+def sort_param(sort):
+    '''
+    Returns the JSON:API ``sort`` parameter with which ANTARES sorts loci by a locus property.
+    '''
+    return f'{"-" if sort.startswith("-") else ""}properties.{sort.lstrip("-")}'
+
+
+def sorted_search(query, sort):
+    '''
+    Like ``antares_client.search.search``, but with the loci sorted by ANTARES on another locus
+    property, given as in ``SERVER_SORT_FIELDS``.
+    '''
+    return antares_client._api.api._list_all_resources(
+        urljoin(antares_client.config.config['ANTARES_API_BASE_URL'], 'loci'),
+        antares_client._api.schemas._LocusListingSchema,
+        params={'sort': sort_param(sort), 'elasticsearch_query[locus_listing]': json.dumps(query)},
+    )
+
+
+def sort_value(alert, field):
+    '''
+    Returns the value of a serialized locus by which it is sorted client-side, or ``None``: a
+    light-curve feature from ``FEATURE_NAMES``, computed and attached unless already present,
+    a locus property in ``SERVER_SORT_FIELDS``, or else a property of the newest alert.
+    '''
+    if field in FEATURE_NAMES:
+        if 'features' not in alert:
+            add_features([alert])
+        return alert['features'][field]
+    if field in SERVER_SORT_FIELDS:
+        return alert['properties'].get(field)
+    return newest_alert_property(alert, field, default=None)
+
+
+def top_alerts(alerts, max_alerts, sort):
+    '''
+    Returns the first ``max_alerts`` serialized loci in the order given by ``sort``, a field
+    for ``sort_value`` prefixed with ``-`` for descending order. Loci lacking a value come last
+    and ties keep their original order.
+
+    The loci are consumed in batches of ``FEATURES_BATCH_SIZE`` into a heap of at most
+    ``max_alerts`` loci, so memory use does not depend on how many are scanned. When sorting
+    on a light-curve feature, the features of each batch are computed by one ``add_features``
+    call.
+    '''
+    field = sort.lstrip('-')
+    descending = sort.startswith('-')
+
+    def key(item):
+        i, alert = item
+        value = sort_value(alert, field)
+        if value is None or value != value:
+            return (1, 0, i)
+        return (0, -value if descending else value, i)
+
+    def batched():
+        for batch in chunked(enumerate(alerts), FEATURES_BATCH_SIZE):
+            missing = [alert for _, alert in batch if 'features' not in alert] if field in FEATURE_NAMES else []
+            if missing:
+                add_features(missing)
+            yield from batch
+
+    if max_alerts == float('inf'):
+        return [alert for _, alert in sorted(batched(), key=key)]
+    return [alert for _, alert in heapq.nsmallest(int(max_alerts), batched(), key=key)]
+
+
+def get_available_tags():
+    return antares_client.search.get_available_tags()
+
+
+def get_by_id(locus_id):
+    return antares_client.search.get_by_id(locus_id)
+
+
+def get_by_ztf_object_id(ztf_object_id):
+    return antares_client.search.get_by_ztf_object_id(ztf_object_id)
+
+
+def fetch_available_tags():
+    with metrics.timer('tags'):
+        return get_available_tags()
+
+
+tag_cache = TagCache(fetch_available_tags)
+locus_cache = LocusCache()
+query_cache = QueryCache()
+
+
+def warm_tag_cache():
+    '''
+    Populates the tag cache ahead of the first form render, e.g. from a worker start-up hook.
+    '''
+    return tag_cache.refresh()
+
 
 def get_tag_choices():
-    tags = get_available_tags()
+    tags = tag_cache.get()
+    return [(s, s) for s in tags]
+
+
+def load_alerts(locus):
+    '''
+    Reads the alerts of a locus, which ``antares_client`` fetches on first access, so that they
+    are fetched by the calling thread, e.g. one of a pool in ``fetch_loci``, rather than when the
+    locus is serialized. Returns the locus, which may be ``None``.
+    '''
+    if locus is not None:
+        locus.alerts
+    return locus
+
+
+async def aload_alerts(loci, client=None):
+    '''
+    Fetches the alerts of loci concurrently and sets them on each locus, so that reading its
+    ``alerts``, e.g. in ``alert_to_dict``, does not block the event loop. Loci whose alerts
+    are already loaded are left alone.
+    '''
+    client = client or get_async_client()
+    schema = antares_client._api.schemas._AlertSchema(many=True, partial=True)
+
+    async def load(locus):
+        response = await client.get(f'loci/{locus.locus_id}/alerts')
+        if response.status_code >= 400:
+            raise antares_client.AntaresException(response.json())
+        locus.alerts = schema.load(response.json())
+
+    # antares_client leaves _alerts as None until the alerts are first read
+    await asyncio.gather(*(load(locus) for locus in loci if locus._alerts is None))
+
+
+async def aget_by_id(locus_id, client=None):
+    '''
+    Async version of ``get_by_id``. Use ``aload_alerts`` to fetch the locus's alerts.
+    '''
+    client = client or get_async_client()
+    response = await client.get(f'loci/{locus_id}')
+    if response.status_code == 404:
+        return None
+    if response.status_code >= 400:
+        raise antares_client.AntaresException(response.json())
+    return antares_client._api.schemas._LocusSchema(partial=True).load(response.json())
+
+
+async def aget_by_ztf_object_id(ztf_object_id, client=None):
+    '''
+    Async version of ``get_by_ztf_object_id``. Use ``aload_alerts`` to fetch the locus's alerts.
+    '''
+    client = client or get_async_client()
+    query = {'query': {'bool': {'filter': {'term': {'properties.ztf_object_id': ztf_object_id}}}}}
+    pages = asearch_pages(query, client, params={'page[limit]': 1})
+    try:
+        body = await pages.__anext__()
+    finally:
+        await pages.aclose()
+    schema = antares_client._api.schemas._LocusListingSchema(many=True, partial=True)
+    loci = schema.load(body)
+    return loci[0] if loci else None
+
+
+async def aget_available_tags(client=None):
+    '''
+    Async version of ``get_available_tags``.
+    '''
+    client = client or get_async_client()
+    response = await client.get('loci/statistics')
+    if response.status_code >= 400:
+        raise antares_client.AntaresException(response.json())
+    return list(response.json().get('data', {}).get('attributes', {}).get('tags', {}).keys())
+
+
+async def aget_tag_choices(client=None):
+    '''
+    Async version of ``get_tag_choices``, which fetches the tags without blocking when none
+    are cached.
+    '''
+    tags = await tag_cache.aget(lambda: aget_available_tags(client))
     return [(s, s) for s in tags]
 
 
@@ -60,14 +810,14 @@ class ANTARESBrokerForm(GenericQueryForm):
         required=False,
         label='',
         widget=forms.TextInput(
-            attrs={'placeholder': 'ZTF object id, e.g. ZTF19aapreis'}
+            attrs={'placeholder': 'ZTF object id(s), e.g. ZTF19aapreis, ZTF20achooum'}
         ),
     )
     antid = forms.CharField(
         required=False,
         label='',
         widget=forms.TextInput(
-            attrs={'placeholder': 'ANTARES locus id, e.g. ANT2020m4pja'}
+            attrs={'placeholder': 'ANTARES locus id(s), e.g. ANT2020m4pja'}
         ),
     )
     tag = forms.MultipleChoiceField(required=False, choices=get_tag_choices)
@@ -86,18 +836,21 @@ class ANTARESBrokerForm(GenericQueryForm):
         label='RA',
         widget=forms.TextInput(attrs={'placeholder': 'RA (Degrees)'}),
         min_value=0.0,
+        max_value=360.0,
     )
     dec = forms.FloatField(
         required=False,
         label='Dec',
         widget=forms.TextInput(attrs={'placeholder': 'Dec (Degrees)'}),
-        min_value=0.0,
+        min_value=-90.0,
+        max_value=90.0,
     )
     sr = forms.FloatField(
         required=False,
         label='Search Radius',
         widget=forms.TextInput(attrs={'placeholder': 'radius (Degrees)'}),
         min_value=0.0,
+        max_value=180.0,
     )
     mjd__gt = forms.FloatField(
         required=False,
@@ -138,6 +891,12 @@ class ANTARESBrokerForm(GenericQueryForm):
         min_value=1,
         initial=20,
     )
+    sort = forms.ChoiceField(
+        required=False,
+        label='Order of the alerts fetched',
+        choices=SORT_CHOICES,
+        initial=DEFAULT_SORT,
+    )
 
     # cone_search = ConeSearchField()
     # api_search_tags = forms.MultipleChoiceField(choices=get_tag_choices)
@@ -146,6 +905,8 @@ class ANTARESBrokerForm(GenericQueryForm):
 
     # TODO: add layout
     def __init__(self, *args, **kwargs):
+        from crispy_forms.layout import HTML, Div, Fieldset, Layout
+
         super().__init__(*args, **kwargs)
         self.helper.layout = Layout(
             self.common_layout,
@@ -234,6 +995,7 @@ class ANTARESBrokerForm(GenericQueryForm):
             ),
             Fieldset('View Tags', 'tag'),
             Fieldset('Max Alerts', 'max_alerts'),
+            Fieldset('Sort', 'sort'),
             HTML('<hr/>'),
             HTML('<h3>Advanced query</h3>'),
             Fieldset('', 'esquery'),
@@ -255,19 +1017,14 @@ class ANTARESBrokerForm(GenericQueryForm):
     def clean(self):
         cleaned_data = super().clean()
 
-        # Ensure all cone search fields are present
+        # Ensure all cone search fields are present. RA and Dec may legitimately be 0.
         if (
-            any(cleaned_data[k] for k in ['ra', 'dec', 'sr'])
-            and not all(cleaned_data[k] for k in ['ra', 'dec', 'sr'])
+            any(cleaned_data.get(k) is not None for k in ['ra', 'dec', 'sr'])
+            and not all(cleaned_data.get(k) is not None for k in ['ra', 'dec', 'sr'])
         ):
             raise forms.ValidationError(
                 'All of RA, Dec, and Search Radius must be included to perform a cone search.'
             )
-        # default value for cone search
-        if not all(cleaned_data[k] for k in ['ra', 'dec', 'sr']):
-            cleaned_data['ra'] = 180.0
-            cleaned_data['dec'] = 0.0
-            cleaned_data['sr'] = 180.0
         # Ensure alert timing constraints have sensible values
         if (
             all(cleaned_data[k] for k in ['mjd__lt', 'mjd__gt'])
@@ -323,32 +1080,105 @@ class ANTARESBroker(GenericBroker):
     form = ANTARESBrokerForm
 
     @classmethod
-    def alert_to_dict(cls, locus):
+    def alert_to_dict(cls, locus, compact=False, features=None):
         '''
         Note: The ANTARES API returns a Locus object, which in the TOM Toolkit
         would otherwise be called an alert.
 
         This method serializes the Locus into a dict so that it can be cached by the view.
+
+        With ``compact=True`` only the properties this broker uses are kept, plus those listed
+        in the ``compact_properties`` and ``compact_alert_properties`` settings. Catalogs are
+        dropped and the alerts are stored as columns: a list of ids and NumPy arrays of
+        ``mjd`` and of each numeric alert property, with NaN where an alert lacks it. Use
+        ``locus_alerts`` to read the alerts of either form, and ``expand_alert`` to fetch
+        the full payload again.
+
+        With ``features``, by default the ``lightcurve_features`` setting, the light-curve
+        features of ``tom_antares.features.compute_features`` are attached as a ``features``
+        dict. ``serialize_loci`` computes them for many loci at once, which is much cheaper.
         '''
-        return {
-            'locus_id': locus.locus_id,
-            'ra': locus.ra,
-            'dec': locus.dec,
-            'properties': locus.properties,
-            'tags': locus.tags,
-            # 'lightcurve': locus.lightcurve.to_json(),
-            'catalogs': locus.catalogs,
-            'alerts': [
-                {
-                    'alert_id': alert.alert_id,
-                    'mjd': alert.mjd,
-                    'properties': alert.properties,
-                }
-                for alert in locus.alerts
-            ],
-        }
+        if compact:
+            property_names = COMPACT_PROPERTIES + get_antares_setting('compact_properties', [])
+            alert_property_names = COMPACT_ALERT_PROPERTIES + get_antares_setting('compact_alert_properties', [])
+            alerts = locus.alerts
+            serialized = {
+                'locus_id': locus.locus_id,
+                'ra': locus.ra,
+                'dec': locus.dec,
+                'properties': {k: v for k, v in locus.properties.items() if k in property_names},
+                'tags': locus.tags,
+                'alerts': {
+                    'alert_id': [alert.alert_id for alert in alerts],
+                    'mjd': np.array([alert.mjd for alert in alerts], dtype=float),
+                    'properties': {
+                        name: np.array([numeric_or_nan(alert.properties.get(name)) for alert in alerts], dtype=float)
+                        for name in alert_property_names
+                    },
+                },
+            }
+        else:
+            serialized = {
+                'locus_id': locus.locus_id,
+                'ra': locus.ra,
+                'dec': locus.dec,
+                'properties': locus.properties,
+                'tags': locus.tags,
+                # 'lightcurve': locus.lightcurve.to_json(),
+                'catalogs': locus.catalogs,
+                'alerts': [
+                    {
+                        'alert_id': alert.alert_id,
+                        'mjd': alert.mjd,
+                        'properties': alert.properties,
+                    }
+                    for alert in locus.alerts
+                ],
+            }
+        if features if features is not None else get_antares_setting('lightcurve_features', False):
+            add_features([serialized])
+        return serialized
+
+    @classmethod
+    def serialize_loci(cls, loci, compact=False) -> list:
+        '''
+        Serializes many loci with ``alert_to_dict``. With the ``lightcurve_features`` setting,
+        the features of all of them are then computed at once by ``add_features``.
+        '''
+        alerts = [cls.alert_to_dict(locus, compact=compact, features=False) for locus in loci]
+        if get_antares_setting('lightcurve_features', False):
+            add_features(alerts)
+        return alerts
+
+    def expand_alert(self, alert: dict) -> dict:
+        '''
+        Returns the full serialization of a locus, fetching it again from ANTARES if the
+        given alert was serialized with ``compact=True``.
+        '''
+        if not is_compact(alert):
+            return alert
+        locus = self.fetch_locus(alert['locus_id'])
+        return self.alert_to_dict(locus) if locus else alert
+
+    @staticmethod
+    def is_cone_search(parameters: dict) -> bool:
+        return all(parameters.get(k) is not None for k in ['ra', 'dec', 'sr'])
 
-    def fetch_alerts(self, parameters: dict) -> iter:
+    def filters_cone(self, parameters: dict) -> bool:
+        '''
+        Whether the loci found by the query built from the parameters must still be filtered
+        with ``within_cone``, as they are with the ``'box'`` ``cone_search_method``.
+        '''
+        return (
+            self.is_cone_search(parameters)
+            and get_antares_setting('cone_search_method', 'sky_distance') == 'box'
+            and not (parse_ids(parameters.get('ztfid')) or parameters.get('esquery'))
+        )
+
+    def build_query(self, parameters: dict) -> dict:
+        '''
+        Builds the Elasticsearch query sent to ANTARES from the form parameters.
+        '''
         tags = parameters.get('tag')
         nobs_gt = parameters.get('nobs__gt')
         nobs_lt = parameters.get('nobs__lt')
@@ -361,111 +1191,734 @@ class ANTARESBroker(GenericBroker):
         mag_min = parameters.get('mag__min')
         mag_max = parameters.get('mag__max')
         elsquery = parameters.get('esquery')
-        ztfid = parameters.get('ztfid')
-        antid = parameters.get('antid')
-        max_alerts = parameters.get('max_alerts', 20)
-        alerts = []
-        if antid:
-            try:
-                locus = get_by_id(antid)
-            except antares_client.exceptions.AntaresException:
-                locus = None
-            if locus:
-                alerts.append(self.alert_to_dict(locus))
+        ztfids = parse_ids(parameters.get('ztfid'))
+        if len(ztfids) == 1:
+            query = {
+                'query': {
+                    'bool': {'must': [{'match': {'properties.ztf_object_id': ztfids[0]}}]}
+                }
+            }
+        elif ztfids:
+            query = {'query': {'bool': {'filter': {'terms': {'properties.ztf_object_id': ztfids}}}}}
+        elif elsquery:
+            query = elsquery
         else:
-            if ztfid:
-                query = {
-                    'query': {
-                        'bool': {'must': [{'match': {'properties.ztf_object_id': ztfid}}]}
+            filters = []
+
+            if nobs_gt or nobs_lt:
+                nobs_range = {'range': {'properties.num_mag_values': {}}}
+                if nobs_gt:
+                    nobs_range['range']['properties.num_mag_values']['gte'] = nobs_gt
+                if nobs_lt:
+                    nobs_range['range']['properties.num_mag_values']['lte'] = nobs_lt
+                filters.append(nobs_range)
+
+            if last_day:
+                from astropy.time import Time
+
+                ut = Time(datetime.now(tz=timezone.utc), scale='utc')
+                now = math.ceil(ut.mjd / LAST_DAY_RESOLUTION) * LAST_DAY_RESOLUTION
+                mjd_range = {
+                    'range': {
+                        'properties.newest_alert_observation_time': {
+                            'lte': now,
+                            'gte': now - 1.0,
+                        }
                     }
                 }
-            elif elsquery:
-                query = elsquery
-            else:
-                filters = []
-
-                if nobs_gt or nobs_lt:
-                    nobs_range = {'range': {'properties.num_mag_values': {}}}
-                    if nobs_gt:
-                        nobs_range['range']['properties.num_mag_values']['gte'] = nobs_gt
-                    if nobs_lt:
-                        nobs_range['range']['properties.num_mag_values']['lte'] = nobs_lt
-                    filters.append(nobs_range)
-
-                if last_day:
-                    ut = Time(datetime.now(tz=timezone.utc), scale='utc')
-                    mjd_range = {
-                        'range': {
-                            'properties.newest_alert_observation_time': {
-                                'lte': ut.mjd,
-                                'gte': ut.mjd - 1.0,
-                            }
-                        }
+                filters.append(mjd_range)
+                mjd_lt = ''
+                mjd_gt = ''
+
+            if mjd_lt:
+                mjd_lt_range = {
+                    'range': {
+                        'properties.newest_alert_observation_time': {'lte': mjd_lt}
                     }
-                    filters.append(mjd_range)
-                    mjd_lt = ''
-                    mjd_gt = ''
-
-                if mjd_lt:
-                    mjd_lt_range = {
-                        'range': {
-                            'properties.newest_alert_observation_time': {'lte': mjd_lt}
-                        }
+                }
+                filters.append(mjd_lt_range)
+
+            if mjd_gt:
+                mjd_gt_range = {
+                    'range': {
+                        'properties.oldest_alert_observation_time': {'gte': mjd_gt}
                     }
-                    filters.append(mjd_lt_range)
+                }
+                filters.append(mjd_gt_range)
 
-                if mjd_gt:
-                    mjd_gt_range = {
-                        'range': {
-                            'properties.oldest_alert_observation_time': {'gte': mjd_gt}
+            if mag_min or mag_max:
+                mag_range = {'range': {'properties.newest_alert_magnitude': {}}}
+                if mag_min:
+                    mag_range['range']['properties.newest_alert_magnitude'][
+                        'gte'
+                    ] = mag_min
+                if mag_max:
+                    mag_range['range']['properties.newest_alert_magnitude'][
+                        'lte'
+                    ] = mag_max
+                filters.append(mag_range)
+
+            if self.is_cone_search(parameters):
+                if get_antares_setting('cone_search_method', 'sky_distance') == 'box':
+                    filters.extend(cone_search_filters(sra, sdec, ssr))
+                else:
+                    filters.append({
+                        'sky_distance': {
+                            'distance': f'{ssr} degree',
+                            'htm16': {'center': f'{sra} {sdec}'},
                         }
+                    })
+
+            if tags:
+                filters.append({'terms': {'tags': tags}})
+
+            query = {'query': {'bool': {'filter': filters}}}
+
+        newer_than = parameters.get('newest_alert_observation_time__gte')
+        if newer_than is not None:
+            query = {
+                'query': {
+                    'bool': {
+                        'filter': [
+                            query['query'],
+                            {'range': {'properties.newest_alert_observation_time': {'gte': newer_than}}},
+                        ]
                     }
-                    filters.append(mjd_gt_range)
-
-                if mag_min or mag_max:
-                    mag_range = {'range': {'properties.newest_alert_magnitude': {}}}
-                    if mag_min:
-                        mag_range['range']['properties.newest_alert_magnitude'][
-                            'gte'
-                        ] = mag_min
-                    if mag_max:
-                        mag_range['range']['properties.newest_alert_magnitude'][
-                            'lte'
-                        ] = mag_max
-                    filters.append(mag_range)
-
-                if sra and ssr:  # TODO: add cross-field validation
-                    ra_range = {'range': {'ra': {'gte': sra - ssr, 'lte': sra + ssr}}}
-                    filters.append(ra_range)
-
-                if sdec and ssr:  # TODO: add cross-field validation
-                    dec_range = {'range': {'dec': {'gte': sdec - ssr, 'lte': sdec + ssr}}}
-                    filters.append(dec_range)
-
-                if tags:
-                    filters.append({'terms': {'tags': tags}})
-
-                query = {'query': {'bool': {'filter': filters}}}
+                }
+            }
+        return query
+
+    def fetch_alerts(self, parameters: dict, use_query_cache=True) -> iter:
+        '''
+        Lazily yields serialized loci matching the query parameters.
+
+        Each locus is converted with ``alert_to_dict`` as soon as it arrives from
+        ``antares_client.search.search``, so the first result is available before the
+        rest of the query has been fetched. No further pages are requested once
+        ``max_alerts`` loci have been yielded or the consumer stops iterating.
+
+        Loci are serialized compactly when the ``compact_alerts`` setting is enabled. With the
+        ``lightcurve_features`` setting, loci are serialized by ``serialize_loci`` in batches of
+        ``FEATURES_BATCH_SIZE``, a page of results, so that their features are computed together.
+
+        Several ANTARES or ZTF ids may be given, separated by commas or whitespace. These are
+        looked up in batches by ``fetch_loci`` or ``fetch_loci_by_ztf_object_id`` and yielded
+        in the order given; ids that could not be found are logged and skipped.
+
+        A ``SearchReport`` of the search is kept in ``search_report``. When the
+        ``resilient_search`` setting is enabled, loci are fetched with ``search_loci``, which
+        skips loci that cannot be deserialized and retries failed pages, instead of
+        ``antares_client.search.search``, which ends the search at the first invalid locus.
+        Skipped loci do not count towards ``max_alerts``.
+
+        When ``query_cache_backend`` is configured, complete search results are cached in
+        ``query_cache`` under a hash of the query, and repeated searches are served from it
+        without contacting ANTARES. Results are only cached once iteration has finished.
+        Searches with an unbounded ``max_alerts``, such as incremental polls by
+        ``poll_query``, those passing ``use_query_cache=False``, such as exports, and those
+        returning more than ``query_cache_max_results`` loci are never cached, so that memory
+        use stays independent of the number of loci streamed.
+
+        With the ``search_shards`` setting, large searches with an unbounded ``max_alerts``
+        are split into shards fetched concurrently, as described in ``sharded_search``, and
+        loci are yielded in the order the shards return them.
+
+        Loci are yielded newest first unless another ``sort`` is given, as described for
+        ``SORT_CHOICES``. ANTARES sorts on the locus properties in ``SERVER_SORT_FIELDS``, so
+        only the first ``max_alerts`` loci are fetched, without sharding unless newest first.
+        For other sort keys, up to ``sort_scan_limit`` loci are fetched, or ``max_alerts`` if
+        more, and ``top_alerts`` keeps the best ``max_alerts``.
+        '''
+        antids = parse_ids(parameters.get('antid'))
+        ztfids = parse_ids(parameters.get('ztfid'))
+        max_alerts = parameters.get('max_alerts', 20)
+        sort = parameters.get('sort') or DEFAULT_SORT
+        if not is_server_sort(sort):
+            scan_limit = max(get_antares_setting('sort_scan_limit', DEFAULT_SORT_SCAN_LIMIT), max_alerts)
+            scanned = self.fetch_alerts({**parameters, 'sort': None, 'max_alerts': scan_limit}, use_query_cache)
+            yield from top_alerts(scanned, max_alerts, sort)
+            return
+        compact = get_antares_setting('compact_alerts', False)
+        # Loci are serialized one at a time, or a page at a time when their features are computed
+        batch_size = FEATURES_BATCH_SIZE if get_antares_setting('lightcurve_features', False) else 1
+        self.search_report = report = SearchReport()
+        if antids or len(ztfids) > 1:
+            results = self.fetch_loci(antids) if antids else self.fetch_loci_by_ztf_object_id(ztfids)
+            loci = []
+            for result in results:
+                if result.locus is None:
+                    logger.warning(f'Unable to fetch ANTARES locus {result.id}: {result.error}')
+                    metrics.increment('tom_antares_dropped_loci_total', reason='not_found')
+                elif len(loci) < max_alerts:
+                    loci.append(result.locus)
+            for batch in chunked(loci, batch_size):
+                with metrics.timer('alert_to_dict', exclude_http=True):
+                    alerts = self.serialize_loci(batch, compact=compact)
+                for alert in alerts:
+                    report.loci += 1
+                    metrics.increment('tom_antares_loci_total')
+                    yield alert
+            return
+
+        query = self.build_query(parameters)
+        filter_cone = self.filters_cone(parameters)
+        cache_key = None
+        if use_query_cache and query_cache.enabled and max_alerts != float('inf') and (
+            parameters.get('newest_alert_observation_time__gte') is None and not parameters.get('shard_state')
+        ):
+            cache_key = QueryCache.key(
+                query, max_alerts=max_alerts, compact=compact,
+                cone=[parameters['ra'], parameters['dec'], parameters['sr']] if filter_cone else None,
+                sort=sort if sort != DEFAULT_SORT else None,
+                features=get_antares_setting('lightcurve_features', False),
+            )
+            alerts = query_cache.get(cache_key)
+            if alerts is not None:
+                metrics.increment('tom_antares_query_cache_hits_total')
+                report.loci = len(alerts)
+                yield from alerts
+                return
+
+        sharded_search = self.sharded_search(parameters, query) if sort == DEFAULT_SORT else None
+        if sharded_search is not None:
+            loci = sharded_loci = sharded_search.search(float('inf') if filter_cone else max_alerts)
+        elif get_antares_setting('resilient_search', False):
+            loci = search_loci(query, report, params={'sort': sort_param(sort)})
+        elif sort != DEFAULT_SORT:
+            loci = sorted_search(query, sort)
+        else:
             loci = antares_client.search.search(query)
-            while len(alerts) < max_alerts:
+        if filter_cone:
+            loci = within_cone(loci, parameters['ra'], parameters['dec'], parameters['sr'])
+        alerts = []
+        max_cached = query_cache.max_results
+        num_alerts = 0
+        stopped = False
+        while num_alerts < max_alerts and not stopped:
+            batch = []
+            while len(batch) < batch_size and num_alerts + len(batch) < max_alerts:
                 try:
-                    locus = next(loci)
-                except (marshmallow.exceptions.ValidationError, StopIteration):
+                    with metrics.timer('deserialize', exclude_http=True):
+                        batch.append(next(loci))
+                except marshmallow.exceptions.ValidationError as e:
+                    logger.warning(f'Stopped the search at a locus which could not be deserialized: {e}')
+                    metrics.increment('tom_antares_dropped_loci_total', reason='invalid')
+                    report.complete = False
+                    stopped = True
                     break
-                alerts.append(self.alert_to_dict(locus))
-        return iter(alerts)
+                except StopIteration:
+                    stopped = True
+                    break
+            with metrics.timer('alert_to_dict', exclude_http=True):
+                batch = self.serialize_loci(batch, compact=compact)
+            for alert in batch:
+                num_alerts += 1
+                report.loci += 1
+                metrics.increment('tom_antares_loci_total')
+                if cache_key is not None:
+                    if len(alerts) < max_cached:
+                        alerts.append(alert)
+                    else:
+                        # Too many to cache: stop holding on to them
+                        cache_key = None
+                        alerts = []
+                if sky_index.enabled:
+                    sky_index.add([alert])
+                yield alert
+        if sharded_search is not None:
+            sharded_loci.close()
+            report.merge(sharded_search.report)
+        self.update_sky_index(parameters, report, num_alerts < max_alerts)
+        if cache_key is not None and report.complete:
+            query_cache.set(cache_key, alerts)
+
+    async def afetch_alerts(self, parameters: dict, client=None):
+        '''
+        Async version of ``fetch_alerts``: an async iterator over the serialized loci matching
+        the query parameters, for use in async views and services:
+
+            async for alert in ANTARESBroker().afetch_alerts({'tag': ['in_m31'], 'max_alerts': 50}):
+                ...
+
+        Requests are sent with ``client``, by default the shared ``AsyncANTARESClient`` of the
+        running event loop, so many searches can run concurrently on one loop. Pages are
+        requested with ``asearch_pages`` and the alerts of the loci in each page are fetched
+        concurrently with ``aload_alerts``, only for the loci that will be yielded. ANTARES
+        and ZTF ids are looked up concurrently with ``afetch_locus`` and ``afetch_alert``.
+
+        Loci that cannot be deserialized are skipped, as with the ``resilient_search``
+        setting. The query cache, sharded searches and the sky index are only used by
+        ``fetch_alerts``. A ``sort`` is applied as by ``fetch_alerts``.
+        '''
+        client = client or get_async_client()
+        antids = parse_ids(parameters.get('antid'))
+        ztfids = parse_ids(parameters.get('ztfid'))
+        max_alerts = parameters.get('max_alerts', 20)
+        sort = parameters.get('sort') or DEFAULT_SORT
+        if not is_server_sort(sort):
+            scan_limit = max(get_antares_setting('sort_scan_limit', DEFAULT_SORT_SCAN_LIMIT), max_alerts)
+            scanned = self.afetch_alerts({**parameters, 'sort': None, 'max_alerts': scan_limit}, client)
+            for alert in top_alerts([alert async for alert in scanned], max_alerts, sort):
+                yield alert
+            return
+        compact = get_antares_setting('compact_alerts', False)
+        self.search_report = report = SearchReport()
+        if antids or len(ztfids) > 1:
+            lookup = self.afetch_locus if antids else self.afetch_alert
+            ids = antids or ztfids
+            loci = await asyncio.gather(*(lookup(id_, client) for id_ in ids), return_exceptions=True)
+            found = []
+            for id_, locus in zip(ids, loci):
+                if locus is None or isinstance(locus, Exception):
+                    logger.warning(f'Unable to fetch ANTARES locus {id_}: {locus or "Not found"}')
+                    metrics.increment('tom_antares_dropped_loci_total', reason='not_found')
+                elif len(found) < max_alerts:
+                    found.append(locus)
+            for alert in self.serialize_loci(found, compact=compact):
+                report.loci += 1
+                metrics.increment('tom_antares_loci_total')
+                yield alert
+            return
+
+        query = self.build_query(parameters)
+        filter_cone = self.filters_cone(parameters)
+        schema = antares_client._api.schemas._LocusListingSchema(partial=True)
+        pages = asearch_pages(query, client, report, params={'sort': sort_param(sort)})
+        try:
+            async for body in pages:
+                loci = page_loci(body, schema, report)
+                if filter_cone:
+                    loci = within_cone(loci, parameters['ra'], parameters['dec'], parameters['sr'])
+                loci = list(loci)[:max_alerts - report.loci]
+                await aload_alerts(loci, client)
+                for alert in self.serialize_loci(loci, compact=compact):
+                    report.loci += 1
+                    metrics.increment('tom_antares_loci_total')
+                    yield alert
+                if report.loci >= max_alerts:
+                    break
+        finally:
+            await pages.aclose()
+
+    def count_alerts(self, parameters: dict) -> int:
+        '''
+        Returns the number of loci matching the query parameters, ignoring ``max_alerts``,
+        without fetching the loci themselves: ``count_loci`` asks ANTARES for the total of the
+        query built by ``build_query``.
+
+        Cone searches with the ``'box'`` ``cone_search_method`` are counted by filtering the
+        positions of the loci in the box, fetched with ``search_projected``. ANTARES ids are
+        counted by looking them up with ``fetch_loci``, which does not fetch their alerts.
+        '''
+        antids = parse_ids(parameters.get('antid'))
+        if antids:
+            return sum(1 for result in self.fetch_loci(antids, with_alerts=False) if result.locus is not None)
+        query = self.build_query(parameters)
+        if self.filters_cone(parameters):
+            loci = search_projected(query, properties=())
+            return sum(1 for _ in within_cone(loci, parameters['ra'], parameters['dec'], parameters['sr']))
+        return count_loci(query)
+
+    def fetch_projected(self, parameters: dict, properties=None) -> iter:
+        '''
+        Lazily yields up to ``max_alerts`` loci matching the query parameters, like
+        ``fetch_alerts``, but projected by ``search_projected`` to their position, tags and
+        ``properties``, by default ``PROJECTED_PROPERTIES``, and without their alerts. This is
+        much cheaper than ``fetch_alerts`` for listing or plotting many loci. The loci can
+        still be converted with ``to_generic_alerts`` and ingested with ``to_targets``.
+
+        A ``SearchReport`` of the search is kept in ``search_report``. The query cache is not
+        used.
+        '''
+        properties = set(properties if properties is not None else PROJECTED_PROPERTIES)
+        antids = parse_ids(parameters.get('antid'))
+        max_alerts = parameters.get('max_alerts', 20)
+        self.search_report = report = SearchReport()
+        if antids:
+            loci = (
+                {
+                    'locus_id': result.locus.locus_id,
+                    'ra': result.locus.ra,
+                    'dec': result.locus.dec,
+                    'properties': {k: v for k, v in result.locus.properties.items() if k in properties},
+                    'tags': result.locus.tags,
+                    'alerts': [],
+                }
+                for result in self.fetch_loci(antids, with_alerts=False) if result.locus is not None
+            )
+        else:
+            loci = search_projected(self.build_query(parameters), properties, report)
+            if self.filters_cone(parameters):
+                loci = within_cone(loci, parameters['ra'], parameters['dec'], parameters['sr'])
+        loci = iter(loci)
+        exhausted = False
+        while report.loci < max_alerts:
+            alert = next(loci, None)
+            if alert is None:
+                exhausted = True
+                break
+            report.loci += 1
+            metrics.increment('tom_antares_loci_total')
+            if sky_index.enabled:
+                sky_index.add([alert])
+            yield alert
+        if not antids:
+            self.update_sky_index(parameters, report, exhausted)
+
+    @classmethod
+    def is_cone_search_only(cls, parameters: dict) -> bool:
+        '''
+        Whether the parameters describe a cone search constrained by nothing else, whose
+        complete results are every locus in the cone.
+        '''
+        return cls.is_cone_search(parameters) and not any(parameters.get(k) for k in CONE_SEARCH_CONSTRAINTS)
+
+    def update_sky_index(self, parameters: dict, report: SearchReport, exhausted: bool):
+        '''
+        Marks the cone of a search as covered in ``sky_index`` if the search returned every locus
+        in it, and saves the index when due.
+        '''
+        if not sky_index.enabled:
+            return
+        if exhausted and report.complete and self.is_cone_search_only(parameters):
+            sky_index.mark_covered(parameters['ra'], parameters['dec'], parameters['sr'])
+        sky_index.flush()
+
+    def cone_search(self, ra, dec, radius) -> list:
+        '''
+        Returns the loci within ``radius`` degrees of (``ra``, ``dec``), nearest first, as dicts
+        of their ``locus_id``, ``ztf_object_id``, ``ra``, ``dec`` and ``separation``.
+
+        When ``sky_index`` is enabled and covers the cone, the loci are found in the index
+        without contacting ANTARES. Otherwise they are fetched with ``fetch_projected``, which
+        adds them to the index and marks the cone as covered.
+        '''
+        if sky_index.enabled and sky_index.covers(ra, dec, radius):
+            metrics.increment('tom_antares_sky_index_hits_total')
+            return sky_index.cone(ra, dec, radius)
+        parameters = {'ra': ra, 'dec': dec, 'sr': radius, 'max_alerts': float('inf')}
+        loci = list(self.fetch_projected(parameters, properties=['ztf_object_id']))
+        separations = angular_separation(ra, dec, [locus['ra'] for locus in loci], [locus['dec'] for locus in loci])
+        matches = [
+            {
+                'locus_id': locus['locus_id'],
+                'ztf_object_id': locus['properties'].get('ztf_object_id', ''),
+                'ra': locus['ra'],
+                'dec': locus['dec'],
+                'separation': float(separation),
+            }
+            for locus, separation in zip(loci, separations) if separation <= radius
+        ]
+        return sorted(matches, key=lambda match: match['separation'])
+
+    def sharded_search(self, parameters: dict, query: dict):
+        '''
+        Returns the ``ShardedSearch`` with which ``fetch_alerts`` runs the query built from the
+        parameters when the ``search_shards`` setting is greater than 1, or ``None``.
+
+        Only searches for every matching locus, with an unbounded ``max_alerts`` such as
+        incremental polls, are split: the shards return loci in no particular order, so the
+        first ``max_alerts`` of a sharded search would not be the newest.
+
+        Queries bounded in time, by ``mjd__gt``, ``last_day`` or an incremental poll, are split
+        over ``properties.newest_alert_observation_time``, from the lower bound to ``mjd__lt``
+        or the present. Other queries are split over RA. Queries already narrowed to a ZTF
+        object id or a cone are not split, as each shard would cost a request for the same
+        few loci. The shards run on at most
+        ``search_shard_workers`` threads, limited to ``search_rate_limit`` requests per second
+        overall if set. A search is resumed from the ``shard_state`` parameter, which is the
+        ``search_report.shards`` of an earlier one.
+        '''
+        state = parameters.get('shard_state')
+        num_shards = get_antares_setting('search_shards', 1)
+        if not state and num_shards <= 1:
+            return None
+        options = {
+            'max_workers': get_antares_setting('search_shard_workers'),
+            'rate_limit': get_antares_setting('search_rate_limit'),
+        }
+        if state:
+            return ShardedSearch(query, state=state, **options)
+        if parameters.get('max_alerts', 20) != float('inf'):
+            return None
+        if parse_ids(parameters.get('ztfid')) or all(parameters.get(k) is not None for k in ('ra', 'dec', 'sr')):
+            return None
+
+        from astropy.time import Time
+
+        now = Time.now().mjd
+        starts = [parameters.get('mjd__gt'), parameters.get('newest_alert_observation_time__gte')]
+        if parameters.get('last_day'):
+            starts.append(now - 1.0 - LAST_DAY_RESOLUTION)
+        starts = [start for start in starts if start]
+        if not starts:
+            return ShardedSearch(query, 'ra', 0.0, 360.0, num_shards, **options)
+        end = parameters.get('mjd__lt') or now + LAST_DAY_RESOLUTION
+        return ShardedSearch(query, 'properties.newest_alert_observation_time', max(starts), end, num_shards,
+                             **options)
+
+    @staticmethod
+    def query_watermark(broker_query) -> QueryWatermark:
+        '''
+        Returns the ``QueryWatermark`` of a saved query, creating it on its first poll. When
+        concurrent first polls both try to create it, the one that loses reads the other's.
+        '''
+        try:
+            return QueryWatermark.objects.get(query=broker_query)
+        except QueryWatermark.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic():
+                return QueryWatermark.objects.create(query=broker_query)
+        except IntegrityError:
+            return QueryWatermark.objects.get(query=broker_query)
+
+    def poll_query(self, broker_query, previous=None) -> list:
+        '''
+        Returns the loci matching a saved ``BrokerQuery`` that are new, or have new alerts,
+        since the query was last polled, and advances the query's ``QueryWatermark``. Given
+        the ``previous`` results of the query, returns them with the new loci merged in by
+        ``merge_alerts`` instead.
+
+        Only loci whose ``newest_alert_observation_time`` is at or after the watermark are
+        requested, so the cost of a poll scales with the number of new alerts rather than
+        with the size of the query. The first poll returns up to ``max_alerts`` of the newest
+        loci and sets the watermark; later polls return every locus updated since.
+
+        The watermark is advanced with a conditional update, so overlapping polls of the same
+        query, e.g. from ``pollantaresqueries`` running on a schedule, never move it backwards.
+        A poll that loses that race returns nothing, as the other poll returned the same loci.
+        '''
+        watermark = self.query_watermark(broker_query)
+        since = watermark.newest_alert_observation_time
+        # Polls follow the newest loci, whatever order the query's results are shown in
+        parameters = {**broker_query.parameters, 'sort': None}
+        if since is not None:
+            parameters['newest_alert_observation_time__gte'] = since
+            parameters['max_alerts'] = float('inf')
+
+        alerts = []
+        for alert in self.fetch_alerts(parameters):
+            observation_time = alert['properties'].get('newest_alert_observation_time')
+            if since is not None and observation_time is not None and (
+                observation_time < since
+                or (observation_time == since and alert['locus_id'] in watermark.locus_ids)
+            ):
+                continue
+            alerts.append(alert)
+
+        observation_times = [
+            alert['properties']['newest_alert_observation_time'] for alert in alerts
+            if alert['properties'].get('newest_alert_observation_time') is not None
+        ]
+        newest = max(observation_times + ([since] if since is not None else []), default=None)
+        locus_ids = [
+            alert['locus_id'] for alert in alerts
+            if alert['properties'].get('newest_alert_observation_time') == newest
+        ]
+        if newest == since:
+            locus_ids = watermark.locus_ids + locus_ids
+
+        updated = QueryWatermark.objects.filter(pk=watermark.pk, modified=watermark.modified).update(
+            newest_alert_observation_time=newest, locus_ids=locus_ids, modified=django_timezone.now()
+        )
+        if not updated:
+            logger.info(f'{broker_query} was polled concurrently, discarding {len(alerts)} alerts')
+            alerts = []
+        else:
+            broker_query.last_run = django_timezone.now()
+            broker_query.save(update_fields=['last_run'])
+        return merge_alerts(previous, alerts) if previous is not None else alerts
 
     def fetch_alert(self, id_):
-        alert = get_by_ztf_object_id(id_)
-        return alert
+        '''
+        Returns the locus with the given ZTF object id, or ``None``. Lookups are cached in
+        ``locus_cache``.
+        '''
+        return locus_cache.get(LocusCache.key(ztf_object_id=id_), lambda: get_by_ztf_object_id(id_))
 
     def fetch_locus(self, id_):
-        alert = get_by_id(id_)
-        return alert
+        '''
+        Returns the locus with the given ANTARES locus id, or ``None``. Lookups are cached in
+        ``locus_cache``.
+        '''
+        return locus_cache.get(LocusCache.key(locus_id=id_), lambda: get_by_id(id_))
+
+    async def afetch_alert(self, id_, client=None):
+        '''
+        Async version of ``fetch_alert``, returning the locus with its alerts loaded.
+        '''
+        locus = await locus_cache.aget(
+            LocusCache.key(ztf_object_id=id_), lambda: aget_by_ztf_object_id(id_, client)
+        )
+        if locus is not None:
+            await aload_alerts([locus], client)
+        return locus
+
+    async def afetch_locus(self, id_, client=None):
+        '''
+        Async version of ``fetch_locus``, returning the locus with its alerts loaded.
+        '''
+        locus = await locus_cache.aget(LocusCache.key(locus_id=id_), lambda: aget_by_id(id_, client))
+        if locus is not None:
+            await aload_alerts([locus], client)
+        return locus
+
+    def fetch_loci(self, locus_ids, max_workers=None, timeout=None, with_alerts=True) -> list:
+        '''
+        Looks up many loci by ANTARES locus id, concurrently on a pool of at most
+        ``max_workers`` threads, allowing ``timeout`` seconds for each lookup. These default
+        to the ``lookup_max_workers`` and ``lookup_timeout`` settings. Unless ``with_alerts`` is
+        false, the alerts of each locus are loaded by the same lookup, as by ``load_alerts``.
+
+        :returns: a ``LookupResult(id, locus, error)`` for each id, in the order given. ``locus``
+                  is ``None`` when the lookup failed or found nothing.
+        '''
+        locus_ids = parse_ids(locus_ids)
+        results = run_concurrently(
+            [
+                (lambda id_=id_: load_alerts(self.fetch_locus(id_))) if with_alerts
+                else (lambda id_=id_: self.fetch_locus(id_))
+                for id_ in locus_ids
+            ],
+            max_workers=max_workers or get_antares_setting('lookup_max_workers', DEFAULT_LOOKUP_MAX_WORKERS),
+            timeout=timeout or get_antares_setting('lookup_timeout', DEFAULT_LOOKUP_TIMEOUT),
+        )
+        return [
+            LookupResult(id_, locus, error or (None if locus else 'Not found'))
+            for id_, (locus, error) in zip(locus_ids, results)
+        ]
+
+    def fetch_loci_by_ztf_object_id(self, ztf_object_ids, max_workers=None, timeout=None, with_alerts=True) -> list:
+        '''
+        Looks up many loci by ZTF object id. The ids are combined into ``terms`` queries of
+        ``ZTF_ID_CHUNK_SIZE`` ids each, which are run concurrently as in ``fetch_loci``. Unless
+        ``with_alerts`` is false, the alerts of the loci found are then loaded concurrently on
+        the same pool size, one ``load_alerts`` per locus.
+
+        :returns: a ``LookupResult(id, locus, error)`` for each id, in the order given
+        '''
+        ztf_object_ids = parse_ids(ztf_object_ids)
+        chunks = list(chunked(ztf_object_ids, ZTF_ID_CHUNK_SIZE))
+        max_workers = max_workers or get_antares_setting('lookup_max_workers', DEFAULT_LOOKUP_MAX_WORKERS)
+        timeout = timeout or get_antares_setting('lookup_timeout', DEFAULT_LOOKUP_TIMEOUT)
+        results = run_concurrently(
+            [
+                lambda chunk=chunk: list(antares_client.search.search(
+                    {'query': {'bool': {'filter': {'terms': {'properties.ztf_object_id': chunk}}}}}
+                ))
+                for chunk in chunks
+            ],
+            max_workers=max_workers,
+            timeout=timeout,
+        )
+        found = [locus for loci, error in results for locus in loci or []] if with_alerts else []
+        alert_errors = {
+            id(locus): error for locus, (_, error) in zip(found, run_concurrently(
+                [lambda locus=locus: load_alerts(locus) for locus in found], max_workers=max_workers, timeout=timeout
+            )) if error
+        }
+
+        lookup_results = []
+        for chunk, (loci, error) in zip(chunks, results):
+            loci_by_id = {locus.properties.get('ztf_object_id'): locus for locus in loci or []}
+            for id_ in chunk:
+                locus = loci_by_id.get(id_)
+                if locus is not None and id(locus) in alert_errors:
+                    lookup_results.append(LookupResult(id_, None, alert_errors[id(locus)]))
+                else:
+                    lookup_results.append(LookupResult(id_, locus, error or (None if locus else 'Not found')))
+        return lookup_results
 
-    # TODO: This function
     def process_reduced_data(self, target, alert=None):
-        pass
+        '''
+        Creates photometry ``ReducedDatum``s for the alerts of a locus, as described in
+        ``ingest_photometry``.
+
+        :param alert: a serialized locus, as returned by ``alert_to_dict``. If not given,
+                      the locus is fetched from ANTARES by the target's name.
+        :returns: the list of created ``ReducedDatum``s
+        '''
+        if alert is None:
+            locus = self.fetch_alert(target.name)
+            if locus is None:
+                return []
+            alert = self.alert_to_dict(locus)
+        return self.ingest_photometry([(target, alert)])
+
+    def ingest_alerts(self, alerts) -> list:
+        '''
+        Saves many alerts to the TOM: creates or matches their targets with ``to_targets``
+        and then ingests their photometry with ``ingest_photometry``. Both steps skip what
+        already exists, so ingesting the same alerts again is harmless.
+
+        :returns: a ``(target, created)`` tuple for each alert, in input order
+        '''
+        alerts = list(alerts)
+        results = self.to_targets(alerts)
+        self.ingest_photometry((target, alert) for (target, _), alert in zip(results, alerts))
+        return results
+
+    def ingest_photometry(self, targets_and_alerts) -> list:
+        '''
+        Creates photometry ``ReducedDatum``s for the alerts of many loci at once.
+
+        ZTF candidates become detections with their PSF magnitude and error, and
+        ``ztf_upper_limit`` alerts become non-detections with their limiting magnitude.
+        The ANTARES alert id is stored as the datum's ``source_location``, so alerts that
+        were ingested before are skipped. Reingesting loci costs one query to find the
+        existing data plus the batched inserts, however many alerts they have.
+
+        :param targets_and_alerts: ``(target, alert)`` pairs, where each alert is a serialized
+                                   locus as returned by ``alert_to_dict``
+        :returns: the list of created ``ReducedDatum``s
+        '''
+        from astropy.time import Time, TimezoneInfo
+
+        targets_and_alerts = list(targets_and_alerts)
+        existing = set()
+        for targets in chunked({target.pk for target, _ in targets_and_alerts}, BULK_CREATE_CHUNK_SIZE):
+            existing.update(
+                ReducedDatum.objects.filter(
+                    target__in=targets, source_name=self.name, data_type='photometry'
+                ).values_list('target_id', 'source_location')
+            )
+
+        data = {}
+        mjds = []
+        for target, alert in targets_and_alerts:
+            for locus_alert in locus_alerts(alert):
+                key = (target.pk, locus_alert['alert_id'])
+                properties = locus_alert['properties']
+                if key in existing or key in data:
+                    continue
+                value = {'filter': ZTF_FILTERS.get(properties.get('ztf_fid')), 'telescope': 'ZTF'}
+                if locus_alert['alert_id'].startswith('ztf_upper_limit'):
+                    if properties.get('ztf_diffmaglim') is None:
+                        continue
+                    value['limit'] = properties['ztf_diffmaglim']
+                else:
+                    if properties.get('ztf_magpsf') is None:
+                        continue
+                    value['magnitude'] = properties['ztf_magpsf']
+                    value['error'] = properties.get('ztf_sigmapsf')
+                data[key] = (target, value)
+                mjds.append(locus_alert['mjd'])
+
+        if not data:
+            return []
+        timestamps = Time(mjds, format='mjd', scale='utc').to_datetime(timezone=TimezoneInfo())
+        return ReducedDatum.objects.bulk_create([
+            ReducedDatum(
+                target=target,
+                data_type='photometry',
+                source_name=self.name,
+                source_location=alert_id,
+                timestamp=timestamp,
+                value=value,
+            )
+            for ((_, alert_id), (target, value)), timestamp in zip(data.items(), timestamps)
+        ], batch_size=BULK_CREATE_CHUNK_SIZE)
 
     def to_target(self, alert: dict) -> Target:
         target = Target.objects.create(
@@ -484,13 +1937,84 @@ class ANTARESBroker(GenericBroker):
             )
         return target, [], aliases
 
+    @staticmethod
+    def target_names(alert: dict) -> list:
+        '''
+        Returns the names a target created from the alert is known by: its ZTF object id,
+        its ANTARES locus id and, for solar system objects, its Horizons name.
+        '''
+        names = [alert['properties']['ztf_object_id'], alert['locus_id']]
+        if alert['properties'].get('horizons_targetname'):
+            names.append(alert['properties']['horizons_targetname'])
+        return names
+
+    def to_targets(self, alerts, chunk_size=BULK_CREATE_CHUNK_SIZE) -> list:
+        '''
+        Creates ``Target``s and their aliases for many alerts at once.
+
+        Alerts are matched to existing targets by any of their ``target_names`` against both
+        target names and aliases, using a few set-based lookups for the whole batch. Missing
+        targets and aliases are then created with ``bulk_create`` in chunks of ``chunk_size``
+        inside a single transaction. Alerts for the same object share one target.
+
+        Note that ``bulk_create`` does not run ``Target.save``, so the ``target_post_save``
+        hook and default ``EXTRA_FIELDS`` are not applied to the new targets.
+
+        :returns: a ``(target, created)`` tuple for each alert, in input order
+        '''
+        alerts = list(alerts)
+        all_names = {name for alert in alerts for name in self.target_names(alert)}
+
+        with transaction.atomic():
+            known = {}
+            for names in chunked(all_names, chunk_size):
+                known.update({target.name: target for target in Target.objects.filter(name__in=names)})
+                known.update({
+                    alias.name: alias.target
+                    for alias in TargetName.objects.filter(name__in=names).select_related('target')
+                })
+            taken_names = set(known)
+
+            results = []
+            new_targets = []
+            new_aliases = []
+            for alert in alerts:
+                names = self.target_names(alert)
+                target = next((known[name] for name in names if name in known), None)
+                created = target is None
+                if created:
+                    target = Target(name=names[0], type='SIDEREAL', ra=alert['ra'], dec=alert['dec'])
+                    new_targets.append(target)
+                    taken_names.add(target.name)
+                for name in names:
+                    known.setdefault(name, target)
+                    if name not in taken_names:
+                        taken_names.add(name)
+                        new_aliases.append(TargetName(target=target, name=name))
+                results.append((target, created))
+
+            Target.objects.bulk_create(new_targets, batch_size=chunk_size)
+            if any(target.pk is None for target in new_targets):
+                # Not every database backend returns primary keys from bulk inserts
+                pks = {}
+                for names in chunked([target.name for target in new_targets], chunk_size):
+                    pks.update(Target.objects.filter(name__in=names).values_list('name', 'pk'))
+                for target in new_targets:
+                    target.pk = pks[target.name]
+            TargetName.objects.bulk_create(new_aliases, batch_size=chunk_size)
+
+        return results
+
     def to_generic_alert(self, alert):
-        url = f'{ANTARES_BASE_URL}/loci/{alert["locus_id"]}'
-        timestamp = Time(
-            alert['properties'].get('newest_alert_observation_time'),
-            format='mjd',
-            scale='utc',
-        ).to_datetime(timezone=TimezoneInfo())
+        from astropy.time import Time, TimezoneInfo
+
+        with metrics.timer('to_generic_alert'):
+            url = f'{ANTARES_BASE_URL}/loci/{alert["locus_id"]}'
+            timestamp = Time(
+                alert['properties'].get('newest_alert_observation_time'),
+                format='mjd',
+                scale='utc',
+            ).to_datetime(timezone=TimezoneInfo())
         return GenericAlert(
             timestamp=timestamp,
             url=url,
@@ -499,5 +2023,40 @@ class ANTARESBroker(GenericBroker):
             ra=alert['ra'],
             dec=alert['dec'],
             mag=alert['properties'].get('newest_alert_magnitude', ''),
-            score=alert['alerts'][-1]['properties'].get('ztf_rb', ''),
+            score=newest_alert_property(alert, 'ztf_rb'),
         )
+
+    def to_generic_alerts(self, alerts) -> list:
+        '''
+        Converts many alerts to ``GenericAlert``s at once.
+
+        The ``newest_alert_observation_time`` of every alert is converted in a single
+        array-valued astropy ``Time`` call rather than one per alert. Alerts whose timestamp
+        is missing or NaN get a ``timestamp`` of ``None`` instead of raising. Otherwise the
+        results are the same as calling ``to_generic_alert`` on each alert.
+        '''
+        from astropy.time import Time, TimezoneInfo
+
+        alerts = list(alerts)
+        with metrics.timer('to_generic_alerts'):
+            mjds = np.array(
+                [alert['properties'].get('newest_alert_observation_time') for alert in alerts], dtype=float
+            )
+            valid = np.isfinite(mjds)
+            timestamps = np.full(len(alerts), None, dtype=object)
+            if valid.any():
+                timestamps[valid] = Time(mjds[valid], format='mjd', scale='utc').to_datetime(timezone=TimezoneInfo())
+
+        return [
+            GenericAlert(
+                timestamp=timestamp,
+                url=f'{ANTARES_BASE_URL}/loci/{alert["locus_id"]}',
+                id=alert['locus_id'],
+                name=alert['properties']['ztf_object_id'],
+                ra=alert['ra'],
+                dec=alert['dec'],
+                mag=alert['properties'].get('newest_alert_magnitude', ''),
+                score=newest_alert_property(alert, 'ztf_rb'),
+            )
+            for alert, timestamp in zip(alerts, timestamps)
+        ]
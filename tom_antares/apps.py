@@ -0,0 +1,6 @@
+from django.apps import AppConfig
+
+
+class TomAntaresConfig(AppConfig):
+    name = 'tom_antares'
+    default_auto_field = 'django.db.models.AutoField'
@@ -0,0 +1,583 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.core.cache import cache as django_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from tom_antares.aio import TransportError
+from tom_antares.utils import LazyModule, get_antares_setting
+
+antares_client = LazyModule('antares_client')
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TAG_CACHE_TTL = 3600
+DEFAULT_LOCUS_CACHE_SIZE = 1024
+DEFAULT_LOCUS_CACHE_TTL = 300
+DEFAULT_LOCUS_CACHE_NEGATIVE_TTL = 60
+DEFAULT_QUERY_CACHE_TTL = 300
+DEFAULT_QUERY_CACHE_SIZE = 128
+DEFAULT_QUERY_CACHE_MAX_RESULTS = 1000
+
+
+class TagCache:
+    '''
+    Process-level cache of the tags available on ANTARES.
+
+    Tags are kept in memory, or in the Django cache when the ``tag_cache_backend``
+    setting is ``'django'`` so that every worker shares one copy. Once an entry is older
+    than ``tag_cache_ttl`` seconds it is still served, and a single background thread
+    fetches a fresh copy (stale-while-revalidate). ANTARES is only queried in the
+    foreground when nothing has been cached yet.
+
+    Configure in ``settings.py``:
+
+        BROKERS = {
+            'ANTARES': {
+                'tag_cache_ttl': 3600,
+                'tag_cache_backend': 'django',
+            }
+        }
+    '''
+    cache_key = 'tom_antares_available_tags'
+
+    def __init__(self, fetch, ttl=None, backend=None, clock=time.time):
+        self.fetch = fetch
+        self._ttl = ttl
+        self._backend = backend
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self._entry = None
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else get_antares_setting('tag_cache_ttl', DEFAULT_TAG_CACHE_TTL)
+
+    @property
+    def backend(self):
+        return self._backend or get_antares_setting('tag_cache_backend', 'local')
+
+    def _load(self):
+        if self.backend == 'django':
+            return django_cache.get(self.cache_key)
+        return self._entry
+
+    def _store(self, entry):
+        if self.backend == 'django':
+            django_cache.set(self.cache_key, entry, timeout=None)
+        else:
+            self._entry = entry
+
+    def get(self):
+        '''
+        Returns the cached tags, fetching them if nothing is cached and scheduling a
+        background refresh if the cached copy has expired.
+        '''
+        entry = self._load()
+        if entry is None:
+            self.misses += 1
+            return self.refresh(default=[])
+        return self._cached(entry)
+
+    async def aget(self, fetch):
+        '''
+        Async version of ``get``. When nothing is cached the tags are fetched by awaiting
+        ``fetch()``; expired tags are refreshed in the background thread as by ``get``.
+        '''
+        entry = self._load()
+        if entry is None:
+            self.misses += 1
+            try:
+                return self._refreshed(await fetch())
+            except (antares_client.AntaresException, TransportError) as e:
+                return self._failed(e, default=[])
+        return self._cached(entry)
+
+    def _cached(self, entry):
+        self.hits += 1
+        fetched_at, tags = entry
+        if self.clock() - fetched_at >= self.ttl:
+            self._refresh_in_background()
+        return tags
+
+    def refresh(self, default=None):
+        '''
+        Fetches the tags from ANTARES and stores them. Returns ``default`` if ANTARES
+        could not be reached, leaving any previously cached tags in place.
+        '''
+        try:
+            return self._refreshed(self.fetch())
+        except (antares_client.AntaresException, requests.exceptions.RequestException) as e:
+            return self._failed(e, default)
+
+    def _refreshed(self, tags):
+        tags = list(tags)
+        self.refreshes += 1
+        self._store((self.clock(), tags))
+        return tags
+
+    def _failed(self, error, default):
+        self.errors += 1
+        logger.warning(f'Unable to fetch available tags from ANTARES: {error}')
+        return default
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self.refresh, daemon=True)
+            self._refresh_thread.start()
+
+    def clear(self):
+        self._entry = None
+        if self.backend == 'django':
+            django_cache.delete(self.cache_key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes, 'errors': self.errors}
+
+
+class LocusCache:
+    '''
+    Bounded, least-recently-used cache of loci looked up by ANTARES locus id or ZTF object id.
+
+    Entries expire after ``locus_cache_ttl`` seconds. Lookups that find nothing, including
+    those where ANTARES raises an ``AntaresException``, are cached as ``None`` for
+    ``locus_cache_negative_ttl`` seconds so that repeated misses do not reach ANTARES. Other
+    errors, such as connection failures, are not cached. When ``locus_cache_backend`` is
+    ``'django'``, the Django cache is used as a second tier shared between workers.
+
+    Configure in ``settings.py``:
+
+        BROKERS = {
+            'ANTARES': {
+                'locus_cache_size': 1024,
+                'locus_cache_ttl': 300,
+                'locus_cache_negative_ttl': 60,
+                'locus_cache_backend': 'django',
+            }
+        }
+    '''
+    key_prefix = 'tom_antares_locus'
+
+    def __init__(self, maxsize=None, ttl=None, negative_ttl=None, backend=None, clock=time.time):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._backend = backend
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        return self._maxsize or get_antares_setting('locus_cache_size', DEFAULT_LOCUS_CACHE_SIZE)
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else get_antares_setting('locus_cache_ttl', DEFAULT_LOCUS_CACHE_TTL)
+
+    @property
+    def negative_ttl(self):
+        if self._negative_ttl is not None:
+            return self._negative_ttl
+        return get_antares_setting('locus_cache_negative_ttl', DEFAULT_LOCUS_CACHE_NEGATIVE_TTL)
+
+    @property
+    def backend(self):
+        return self._backend or get_antares_setting('locus_cache_backend', 'local')
+
+    @staticmethod
+    def key(locus_id=None, ztf_object_id=None):
+        return f'locus:{locus_id}' if locus_id else f'ztf:{ztf_object_id}'
+
+    def get(self, key, fetch):
+        '''
+        Returns the locus cached under ``key``, calling ``fetch`` to look it up on a miss.
+        '''
+        found, locus = self._lookup(key)
+        if found:
+            return locus
+        try:
+            locus = fetch()
+        except antares_client.AntaresException as e:
+            logger.info(f'ANTARES lookup of {key} failed: {e}')
+            locus = None
+        return self._put(key, locus)
+
+    async def aget(self, key, fetch):
+        '''
+        Async version of ``get``, where ``fetch`` returns an awaitable of the locus.
+        '''
+        found, locus = self._lookup(key)
+        if found:
+            return locus
+        try:
+            locus = await fetch()
+        except antares_client.AntaresException as e:
+            logger.info(f'ANTARES lookup of {key} failed: {e}')
+            locus = None
+        return self._put(key, locus)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+        if self.backend == 'django':
+            entry = django_cache.get(f'{self.key_prefix}:{key}')
+            if entry is not None:
+                with self._lock:
+                    self.hits += 1
+                self._store(key, entry)
+                return True, entry[1]
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _put(self, key, locus):
+        ttl = self.ttl if locus is not None else self.negative_ttl
+        entry = (self.clock() + ttl, locus)
+        self._store(key, entry)
+        if self.backend == 'django':
+            django_cache.set(f'{self.key_prefix}:{key}', entry, timeout=ttl)
+        return locus
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, locus_id=None, ztf_object_id=None):
+        '''
+        Removes the entries for a locus id and/or ZTF object id, along with any other entry
+        holding the same locus.
+        '''
+        keys = {self.key(locus_id=locus_id)} if locus_id else set()
+        if ztf_object_id:
+            keys.add(self.key(ztf_object_id=ztf_object_id))
+        with self._lock:
+            for key, (_, locus) in list(self._entries.items()):
+                if locus is not None and (
+                    (locus_id and locus.locus_id == locus_id)
+                    or (ztf_object_id and locus.properties.get('ztf_object_id') == ztf_object_id)
+                ):
+                    keys.update({key, self.key(locus_id=locus.locus_id),
+                                 self.key(ztf_object_id=locus.properties.get('ztf_object_id'))})
+            for key in keys:
+                self._entries.pop(key, None)
+        if self.backend == 'django':
+            django_cache.delete_many([f'{self.key_prefix}:{key}' for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._entries),
+        }
+
+
+def canonical_query(query):
+    '''
+    Returns ``query`` with the values of ``terms`` filters sorted, so that queries which only
+    differ in the order of their tags or ids are cached together. Dictionary key order is
+    normalized when the query is hashed.
+    '''
+    if isinstance(query, dict):
+        canonical = {key: canonical_query(value) for key, value in query.items()}
+        if isinstance(canonical.get('terms'), dict):
+            canonical['terms'] = {
+                field: sorted(values, key=str) if isinstance(values, list) else values
+                for field, values in canonical['terms'].items()
+            }
+        return canonical
+    if isinstance(query, (list, tuple)):
+        return [canonical_query(value) for value in query]
+    return query
+
+
+class LocalQueryStore:
+    '''
+    In-process, least-recently-used store of query results.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        # Results are copied in and out so that callers modifying their alerts do not change the cache
+        return copy.deepcopy(entry)
+
+    def set(self, key, entry, ttl):
+        entry = copy.deepcopy(entry)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoQueryStore:
+    '''
+    Stores query results in the Django cache, which is shared between workers and bounded by
+    the cache's own eviction policy.
+    '''
+    key_prefix = 'tom_antares_query'
+
+    def __init__(self, maxsize):
+        self.evictions = 0
+        self._keys = set()
+
+    def get(self, key):
+        return django_cache.get(f'{self.key_prefix}:{key}')
+
+    def set(self, key, entry, ttl):
+        django_cache.set(f'{self.key_prefix}:{key}', entry, timeout=ttl)
+        self._keys.add(key)
+
+    def delete(self, key):
+        django_cache.delete(f'{self.key_prefix}:{key}')
+        self._keys.discard(key)
+
+    def clear(self):
+        django_cache.delete_many([f'{self.key_prefix}:{key}' for key in self._keys])
+        self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class DiskQueryStore:
+    '''
+    Stores query results as pickle files in the ``query_cache_path`` directory, which survives
+    restarts and may be shared by workers on one host. When more than ``maxsize`` results are
+    stored, the least recently read are deleted.
+
+    Loading a pickle can run arbitrary code, so the directory must be set explicitly and be
+    private: it is created with mode 0o700, and one owned by another user or writable by
+    others is refused with ``ImproperlyConfigured``.
+    '''
+
+    def __init__(self, maxsize, path=None):
+        self.maxsize = maxsize
+        self.path = path or get_antares_setting('query_cache_path')
+        if not self.path:
+            raise ImproperlyConfigured("The 'disk' query_cache_backend requires query_cache_path to be set")
+        self.evictions = 0
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self._check_private(self.path)
+
+    @staticmethod
+    def _check_private(path):
+        status = os.stat(path)
+        if hasattr(os, 'getuid') and status.st_uid != os.getuid():
+            raise ImproperlyConfigured(f'query_cache_path {path} is owned by another user')
+        if status.st_mode & 0o022:
+            raise ImproperlyConfigured(f'query_cache_path {path} is writable by other users')
+
+    def _filename(self, key):
+        return os.path.join(self.path, f'{key}.pickle')
+
+    def _filenames(self):
+        return [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.pickle')]
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(filename)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def set(self, key, entry, ttl):
+        # Written to a temporary file and renamed, so that readers never see a partial file
+        fd, temporary = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self._filename(key))
+
+        filenames = self._filenames()
+        if len(filenames) > self.maxsize:
+            filenames.sort(key=lambda filename: os.path.getmtime(filename))
+            for filename in filenames[:len(filenames) - self.maxsize]:
+                self._remove(filename)
+                self.evictions += 1
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._filename(key))
+
+    def clear(self):
+        for filename in self._filenames():
+            self._remove(filename)
+
+    def __len__(self):
+        return len(self._filenames())
+
+
+QUERY_STORES = {'local': LocalQueryStore, 'django': DjangoQueryStore, 'disk': DiskQueryStore}
+
+
+class QueryCache:
+    '''
+    Cache of search results, keyed by a hash of the Elasticsearch query sent to ANTARES
+    together with ``max_alerts`` and the serialization options.
+
+    Caching is disabled unless ``query_cache_backend`` is set to ``'local'`` (in-process),
+    ``'django'`` (the Django cache), ``'disk'`` (pickle files in the private directory
+    ``query_cache_path``, which must be set), or
+    the dotted path of a class implementing the same interface as ``LocalQueryStore``.
+    Results expire after ``query_cache_ttl`` seconds, and the local and disk stores keep at
+    most ``query_cache_size`` results, evicting the least recently used. Searches returning
+    more than ``query_cache_max_results`` loci are not cached, so that collecting them does
+    not hold a whole large result set in memory.
+
+    Configure in ``settings.py``:
+
+        BROKERS = {
+            'ANTARES': {
+                'query_cache_backend': 'local',
+                'query_cache_ttl': 300,
+                'query_cache_size': 128,
+                'query_cache_max_results': 1000,
+            }
+        }
+    '''
+
+    def __init__(self, backend=None, ttl=None, maxsize=None, clock=time.time):
+        self._backend = backend
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return self._backend or get_antares_setting('query_cache_backend')
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else get_antares_setting('query_cache_ttl', DEFAULT_QUERY_CACHE_TTL)
+
+    @property
+    def maxsize(self):
+        return self._maxsize or get_antares_setting('query_cache_size', DEFAULT_QUERY_CACHE_SIZE)
+
+    @property
+    def max_results(self):
+        return get_antares_setting('query_cache_max_results', DEFAULT_QUERY_CACHE_MAX_RESULTS)
+
+    @property
+    def enabled(self):
+        return bool(self.backend) and self.ttl > 0
+
+    @property
+    def store(self):
+        backend = self.backend
+        with self._lock:
+            if backend not in self._stores:
+                store_class = QUERY_STORES.get(backend) or import_string(backend)
+                self._stores[backend] = store_class(self.maxsize)
+            return self._stores[backend]
+
+    @staticmethod
+    def key(query, **options):
+        '''
+        Returns a hash of ``query`` and any options that change its results, such as ``max_alerts``.
+        '''
+        canonical = json.dumps({'query': canonical_query(query), **options}, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key):
+        '''
+        Returns the results cached under ``key``, or ``None``.
+        '''
+        entry = self.store.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            self.store.delete(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[1]
+
+    def set(self, key, results):
+        self.store.set(key, (self.clock() + self.ttl, results), self.ttl)
+
+    def clear(self):
+        for store in self._stores.values():
+            store.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': sum(store.evictions for store in self._stores.values()),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self.store) if self.enabled else 0,
+        }
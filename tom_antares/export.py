@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+
+from tom_antares.antares import COMPACT_ALERT_PROPERTIES, COMPACT_PROPERTIES, locus_alerts
+from tom_antares.utils import LazyModule, chunked, get_antares_setting
+
+# pyarrow is an optional dependency, installed with the 'export' extra: pip install tom-antares[export]
+pa = LazyModule('pyarrow')
+pq = LazyModule('pyarrow.parquet')
+
+logger = logging.getLogger(__name__)
+
+# Number of loci converted to each pair of record batches, and written to each Parquet row group
+DEFAULT_EXPORT_BATCH_SIZE = 1000
+
+LOCI_FILENAME = 'loci.parquet'
+ALERTS_FILENAME = 'alerts.parquet'
+
+# Properties stored in their own columns, typed as float64 unless listed in STRING_COLUMNS or
+# INTEGER_COLUMNS. The other properties of each locus and alert are kept as a JSON object in properties_json.
+LOCUS_PROPERTY_COLUMNS = COMPACT_PROPERTIES + ['oldest_alert_observation_time', 'num_alerts', 'num_mag_values']
+ALERT_PROPERTY_COLUMNS = COMPACT_ALERT_PROPERTIES
+STRING_COLUMNS = {'ztf_object_id', 'horizons_targetname'}
+INTEGER_COLUMNS = {'ztf_fid', 'num_alerts', 'num_mag_values'}
+
+
+def column_type(name):
+    if name in STRING_COLUMNS:
+        return pa.string()
+    if name in INTEGER_COLUMNS:
+        return pa.int64()
+    return pa.float64()
+
+
+def column_value(name, value):
+    # Compact alerts store every property as a float
+    return int(value) if value is not None and name in INTEGER_COLUMNS else value
+
+
+def loci_schema():
+    return pa.schema(
+        [('locus_id', pa.string()), ('ra', pa.float64()), ('dec', pa.float64()), ('tags', pa.list_(pa.string()))]
+        + [(name, column_type(name)) for name in LOCUS_PROPERTY_COLUMNS]
+        + [('properties_json', pa.string())]
+    )
+
+
+def alerts_schema():
+    return pa.schema(
+        [('locus_id', pa.string()), ('alert_id', pa.string()), ('mjd', pa.float64())]
+        + [(name, column_type(name)) for name in ALERT_PROPERTY_COLUMNS]
+        + [('properties_json', pa.string())]
+    )
+
+
+def loci_columns(alerts) -> dict:
+    '''
+    Returns the columns of the loci table for serialized loci, full or compact, as a dict of
+    lists keyed by the names in ``loci_schema``.
+    '''
+    columns = {name: [] for name in ['locus_id', 'ra', 'dec', 'tags'] + LOCUS_PROPERTY_COLUMNS + ['properties_json']}
+    for alert in alerts:
+        properties = alert['properties']
+        columns['locus_id'].append(alert['locus_id'])
+        columns['ra'].append(alert['ra'])
+        columns['dec'].append(alert['dec'])
+        columns['tags'].append(list(alert['tags']))
+        for name in LOCUS_PROPERTY_COLUMNS:
+            columns[name].append(column_value(name, properties.get(name)))
+        extra = {k: v for k, v in properties.items() if k not in LOCUS_PROPERTY_COLUMNS}
+        columns['properties_json'].append(json.dumps(extra) if extra else None)
+    return columns
+
+
+def alerts_columns(alerts) -> dict:
+    '''
+    Returns the columns of the alerts table for serialized loci, full or compact, as a dict of
+    lists keyed by the names in ``alerts_schema``. Each alert is a row, with the ``locus_id`` of
+    its locus.
+    '''
+    columns = {name: [] for name in ['locus_id', 'alert_id', 'mjd'] + ALERT_PROPERTY_COLUMNS + ['properties_json']}
+    for alert in alerts:
+        for locus_alert in locus_alerts(alert):
+            properties = locus_alert['properties']
+            columns['locus_id'].append(alert['locus_id'])
+            columns['alert_id'].append(locus_alert['alert_id'])
+            columns['mjd'].append(locus_alert['mjd'])
+            for name in ALERT_PROPERTY_COLUMNS:
+                columns[name].append(column_value(name, properties.get(name)))
+            extra = {k: v for k, v in properties.items() if k not in ALERT_PROPERTY_COLUMNS}
+            columns['properties_json'].append(json.dumps(extra) if extra else None)
+    return columns
+
+
+def to_record_batches(alerts):
+    '''
+    Converts serialized loci to a ``(loci, alerts)`` pair of Arrow ``RecordBatch``es.
+    '''
+    return (
+        pa.RecordBatch.from_pydict(loci_columns(alerts), schema=loci_schema()),
+        pa.RecordBatch.from_pydict(alerts_columns(alerts), schema=alerts_schema()),
+    )
+
+
+class ParquetExporter:
+    '''
+    Writes serialized loci, as yielded by ``ANTARESBroker.fetch_alerts``, to a dataset
+    directory of two Parquet files: ``loci.parquet``, with a row per locus, and
+    ``alerts.parquet``, with a row per alert and the ``locus_id`` it belongs to.
+
+    Loci are converted to Arrow record batches and written as a row group ``batch_size`` at a
+    time, so memory use is bounded by the size of a batch however many loci are exported:
+
+        with ParquetExporter('exports/m31') as exporter:
+            exporter.write(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 100000}))
+
+    The files are written under temporary names and only renamed once the exporter is closed
+    without an error, so a dataset directory never holds a partial export.
+    '''
+
+    def __init__(self, directory, batch_size=None, compression='zstd'):
+        self.directory = directory
+        self.batch_size = batch_size or get_antares_setting('export_batch_size', DEFAULT_EXPORT_BATCH_SIZE)
+        self.compression = compression
+        self.num_loci = 0
+        self.num_alerts = 0
+        self._writers = None
+
+    def _path(self, filename, partial=False):
+        return os.path.join(self.directory, f'.{filename}.partial' if partial else filename)
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._writers = (
+            pq.ParquetWriter(self._path(LOCI_FILENAME, partial=True), loci_schema(), compression=self.compression),
+            pq.ParquetWriter(self._path(ALERTS_FILENAME, partial=True), alerts_schema(), compression=self.compression),
+        )
+        return self
+
+    def write_batch(self, alerts):
+        loci_batch, alerts_batch = to_record_batches(alerts)
+        loci_writer, alerts_writer = self._writers
+        loci_writer.write_batch(loci_batch)
+        alerts_writer.write_batch(alerts_batch)
+        self.num_loci += loci_batch.num_rows
+        self.num_alerts += alerts_batch.num_rows
+
+    def write(self, alerts):
+        '''
+        Writes loci from any iterable, consuming it ``batch_size`` loci at a time.
+        '''
+        for batch in chunked(alerts, self.batch_size):
+            self.write_batch(batch)
+
+    def close(self, discard=False):
+        for writer in self._writers:
+            writer.close()
+        for filename in (LOCI_FILENAME, ALERTS_FILENAME):
+            if discard:
+                os.remove(self._path(filename, partial=True))
+            else:
+                os.replace(self._path(filename, partial=True), self._path(filename))
+        self._writers = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(discard=exc_type is not None)
+
+
+def export_query(broker, parameters, directory, batch_size=None):
+    '''
+    Runs a query with ``broker.fetch_alerts`` and exports the loci found to ``directory``
+    with ``ParquetExporter``. The loci are streamed straight to the exporter, bypassing the
+    query cache.
+
+    :returns: the ``ParquetExporter``, with the number of loci and alerts written
+    '''
+    with ParquetExporter(directory, batch_size=batch_size) as exporter:
+        exporter.write(broker.fetch_alerts(parameters, use_query_cache=False))
+    logger.info(f'Exported {exporter.num_loci} loci and {exporter.num_alerts} alerts to {directory}')
+    return exporter
@@ -0,0 +1,220 @@
+import math
+import operator
+import time
+from collections import namedtuple
+
+from tom_antares.utils import LazyModule, numeric_or_nan
+
+np = LazyModule('numpy')
+
+# The ztf_fid of each ZTF passband
+ZTF_G = 1
+ZTF_R = 2
+
+# g and r detections are only combined into a color when observed at most this many days apart
+COLOR_MAX_GAP = 1.0
+
+# The MJD of the Unix epoch
+UNIX_EPOCH_MJD = 40587.0
+
+# Features computed by compute_features. Magnitudes are ztf_magpsf, and rates are in magnitudes
+# per day, positive when the locus brightens before its peak and fades after it.
+FEATURE_NAMES = [
+    'num_detections',
+    'first_detection_mjd',
+    'last_detection_mjd',
+    'days_since_first_detection',
+    'last_nondetection_mjd',
+    'peak_magnitude',
+    'peak_mjd',
+    'rise_rate',
+    'fade_rate',
+    'g_minus_r',
+]
+
+# Comparisons understood by feature_mask, as suffixes of the feature names
+FEATURE_COMPARISONS = {'gt': operator.gt, 'gte': operator.ge, 'lt': operator.lt, 'lte': operator.le}
+
+AlertArrays = namedtuple('AlertArrays', ['locus_index', 'mjd', 'fid', 'magnitude', 'limit'])
+
+
+def current_mjd():
+    return time.time() / 86400 + UNIX_EPOCH_MJD
+
+
+def alert_arrays(alerts) -> AlertArrays:
+    '''
+    Flattens the alerts of many serialized loci, full or compact, into NumPy arrays of the
+    index of their locus in ``alerts``, ``mjd``, passband (``ztf_fid``), magnitude
+    (``ztf_magpsf``, NaN for non-detections) and limiting magnitude (``ztf_diffmaglim``),
+    sorted by locus and then by ``mjd``.
+    '''
+    names = ['ztf_fid', 'ztf_magpsf', 'ztf_diffmaglim']
+    columns = {name: [np.empty(0)] for name in ['locus_index', 'mjd'] + names}
+    for i, alert in enumerate(alerts):
+        if isinstance(alert['alerts'], dict):
+            mjd = alert['alerts']['mjd']
+            properties = alert['alerts']['properties']
+            for name in names:
+                columns[name].append(properties[name] if name in properties else np.full(len(mjd), np.nan))
+        else:
+            mjd = np.array([locus_alert['mjd'] for locus_alert in alert['alerts']], dtype=float)
+            for name in names:
+                columns[name].append(np.array([
+                    numeric_or_nan(locus_alert['properties'].get(name)) for locus_alert in alert['alerts']
+                ], dtype=float))
+        columns['mjd'].append(mjd)
+        columns['locus_index'].append(np.full(len(mjd), i))
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+    locus_index = columns['locus_index'].astype(np.intp)
+    order = np.lexsort((columns['mjd'], locus_index))
+    return AlertArrays(
+        locus_index[order], columns['mjd'][order], columns['ztf_fid'][order],
+        columns['ztf_magpsf'][order], columns['ztf_diffmaglim'][order],
+    )
+
+
+def group_bounds(locus_index):
+    '''
+    Returns the locus indices of the runs of equal values in a sorted array, with the first and
+    last row of each run.
+    '''
+    if not len(locus_index):
+        return locus_index, locus_index, locus_index
+    starts = np.flatnonzero(np.concatenate([[True], locus_index[1:] != locus_index[:-1]]))
+    ends = np.concatenate([starts[1:], [len(locus_index)]]) - 1
+    return locus_index[starts], starts, ends
+
+
+def compute_features(alerts, now=None) -> dict:
+    '''
+    Computes light-curve features of many serialized loci at once, from their alerts
+    flattened by ``alert_arrays``. Each feature in ``FEATURE_NAMES`` is returned as an array
+    with a value per locus, NaN where it cannot be computed:
+
+    - ``num_detections``, ``first_detection_mjd``, ``last_detection_mjd`` and
+      ``days_since_first_detection``, counted to ``now``, an MJD defaulting to the current time
+    - ``last_nondetection_mjd``: the last alert with only a limiting magnitude before the
+      first detection
+    - ``peak_magnitude`` and ``peak_mjd``: the brightest detection, in any passband
+    - ``rise_rate`` and ``fade_rate``: the mean rate from the first detection to the peak, and
+      from the peak to the last detection, in the passband of the peak
+    - ``g_minus_r``: the color of the last g and r detections, if at most ``COLOR_MAX_GAP``
+      days apart
+
+    Every step is a vectorized operation over the alerts of all the loci, so computing
+    features for thousands of loci together costs little more than for one.
+    '''
+    num_loci = len(alerts)
+    arrays = alert_arrays(alerts)
+    features = {name: np.full(num_loci, np.nan) for name in FEATURE_NAMES}
+
+    detected = ~np.isnan(arrays.magnitude)
+    locus_index, mjd = arrays.locus_index[detected], arrays.mjd[detected]
+    fid, magnitude = arrays.fid[detected], arrays.magnitude[detected]
+    features['num_detections'] = np.bincount(locus_index, minlength=num_loci).astype(float)
+    loci, first, last = group_bounds(locus_index)
+    features['first_detection_mjd'][loci] = mjd[first]
+    features['last_detection_mjd'][loci] = mjd[last]
+    features['days_since_first_detection'] = (now if now is not None else current_mjd()) - (
+        features['first_detection_mjd']
+    )
+
+    # Limits are compared with no detection at all as False, so every limit of an undetected locus counts
+    before_detection = ~(arrays.mjd >= features['first_detection_mjd'][arrays.locus_index])
+    nondetected = ~detected & ~np.isnan(arrays.limit) & before_detection
+    loci, _, last = group_bounds(arrays.locus_index[nondetected])
+    features['last_nondetection_mjd'][loci] = arrays.mjd[nondetected][last]
+
+    by_magnitude = np.lexsort((mjd, magnitude, locus_index))
+    loci, first, _ = group_bounds(locus_index[by_magnitude])
+    peak = by_magnitude[first]
+    features['peak_magnitude'][loci] = magnitude[peak]
+    features['peak_mjd'][loci] = mjd[peak]
+    peak_fid = np.full(num_loci, np.nan)
+    peak_fid[loci] = fid[peak]
+
+    in_band = fid == peak_fid[locus_index]
+    band_mjd, band_magnitude = mjd[in_band], magnitude[in_band]
+    loci, first, last = group_bounds(locus_index[in_band])
+    peak_mjd, peak_magnitude = features['peak_mjd'][loci], features['peak_magnitude'][loci]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rise_time = peak_mjd - band_mjd[first]
+        features['rise_rate'][loci] = np.where(
+            rise_time > 0, (band_magnitude[first] - peak_magnitude) / rise_time, np.nan
+        )
+        fade_time = band_mjd[last] - peak_mjd
+        features['fade_rate'][loci] = np.where(
+            fade_time > 0, (band_magnitude[last] - peak_magnitude) / fade_time, np.nan
+        )
+
+    latest = {}
+    for band in (ZTF_G, ZTF_R):
+        in_band = fid == band
+        loci, _, last = group_bounds(locus_index[in_band])
+        latest[band] = (np.full(num_loci, np.nan), np.full(num_loci, np.nan))
+        latest[band][0][loci] = mjd[in_band][last]
+        latest[band][1][loci] = magnitude[in_band][last]
+    (g_mjd, g_magnitude), (r_mjd, r_magnitude) = latest[ZTF_G], latest[ZTF_R]
+    with np.errstate(invalid='ignore'):
+        features['g_minus_r'] = np.where(
+            np.abs(g_mjd - r_mjd) <= COLOR_MAX_GAP, g_magnitude - r_magnitude, np.nan
+        )
+    return features
+
+
+def add_features(alerts, now=None) -> list:
+    '''
+    Computes the features of serialized loci with ``compute_features`` and attaches them to
+    each as a ``features`` dict, with ``None`` for the features that could not be computed.
+
+    :returns: the loci, as a list
+    '''
+    alerts = list(alerts)
+    attach_features(alerts, compute_features(alerts, now=now))
+    return alerts
+
+
+def attach_features(alerts, features):
+    columns = {name: values.tolist() for name, values in features.items()}
+    for i, alert in enumerate(alerts):
+        alert['features'] = {name: None if math.isnan(values[i]) else values[i] for name, values in columns.items()}
+        alert['features']['num_detections'] = int(alert['features']['num_detections'])
+
+
+def feature_mask(features, conditions) -> 'np.ndarray':
+    '''
+    Returns a boolean array selecting the loci whose ``features``, as returned by
+    ``compute_features``, meet every condition. Conditions map a feature name and a
+    comparison from ``FEATURE_COMPARISONS`` to a value, e.g. ``{'rise_rate__gt': 0.1}``. A
+    feature that could not be computed meets no condition.
+    '''
+    mask = np.ones(len(next(iter(features.values()))), dtype=bool)
+    for condition, value in conditions.items():
+        name, comparison = condition.rsplit('__', 1)
+        with np.errstate(invalid='ignore'):
+            mask &= FEATURE_COMPARISONS[comparison](features[name], value)
+    return mask
+
+
+def select_by_features(alerts, conditions=None, order_by=None, now=None) -> list:
+    '''
+    Filters and orders serialized loci, e.g. the output of ``ANTARESBroker.fetch_alerts``, by
+    their light-curve features, which are computed for all of them at once and attached as
+    by ``add_features``:
+
+        alerts = select_by_features(broker.fetch_alerts(parameters), {'g_minus_r__lt': 0.2}, '-rise_rate')
+
+    :param conditions: conditions on the features, as described in ``feature_mask``
+    :param order_by: a feature name to sort by, prefixed with ``-`` for descending order. Loci
+                     lacking the feature come last.
+    '''
+    alerts = list(alerts)
+    features = compute_features(alerts, now=now)
+    attach_features(alerts, features)
+    indices = np.flatnonzero(feature_mask(features, conditions or {}))
+    if order_by:
+        values = features[order_by.lstrip('-')][indices]
+        # NaN sorts last either way
+        indices = indices[np.argsort(-values if order_by.startswith('-') else values, kind='stable')]
+    return [alerts[i] for i in indices]
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tom_alerts.models import BrokerQuery
+from tom_antares.antares import ANTARESBroker
+from tom_antares.export import export_query
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs a saved ANTARES query and writes the loci found, and their alerts, to a dataset '
+        'directory of Parquet files'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('query_name', help='Name of the saved query to run.')
+        parser.add_argument('directory', help='Directory to write loci.parquet and alerts.parquet to.')
+        parser.add_argument(
+            '--max-alerts',
+            type=float,
+            help='Maximum number of loci to export. Defaults to the max_alerts of the saved query.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of loci written at a time. Defaults to the export_batch_size setting, or 1000.'
+        )
+
+    def handle(self, *args, **options):
+        broker = ANTARESBroker()
+        try:
+            query = BrokerQuery.objects.get(broker=broker.name, name=options['query_name'])
+        except BrokerQuery.DoesNotExist:
+            raise CommandError(f'No saved ANTARES query is named {options["query_name"]}')
+
+        parameters = dict(query.parameters)
+        if options['max_alerts']:
+            parameters['max_alerts'] = options['max_alerts']
+        exporter = export_query(broker, parameters, options['directory'], batch_size=options['batch_size'])
+        self.stdout.write(
+            f'{query.name}: exported {exporter.num_loci} loci and {exporter.num_alerts} alerts '
+            f'to {options["directory"]}'
+        )
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from tom_alerts.models import BrokerQuery
+from tom_antares.antares import ANTARESBroker
+
+
+class Command(BaseCommand):
+    help = (
+        'Polls saved ANTARES queries for loci that are new or updated since the last poll, '
+        'and saves them as Targets with their photometry'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'query_names',
+            nargs='*',
+            help='Names of the saved queries to poll. Defaults to every saved ANTARES query.'
+        )
+        parser.add_argument(
+            '--no-save',
+            action='store_true',
+            help='Only report the new loci, without creating Targets or photometry.'
+        )
+
+    def handle(self, *args, **options):
+        broker = ANTARESBroker()
+        queries = BrokerQuery.objects.filter(broker=broker.name)
+        if options['query_names']:
+            queries = queries.filter(name__in=options['query_names'])
+
+        for query in queries:
+            alerts = broker.poll_query(query)
+            if options['no_save'] or not alerts:
+                self.stdout.write(f'{query.name}: {len(alerts)} new or updated loci')
+                continue
+            results = broker.ingest_alerts(alerts)
+            num_created = sum(created for _, created in results)
+            self.stdout.write(f'{query.name}: {len(alerts)} new or updated loci, {num_created} new targets')
@@ -0,0 +1,35 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from tom_antares.stream import StreamConsumer, get_streaming_client
+
+
+class Command(BaseCommand):
+    help = (
+        'Consumes ANTARES Kafka topics and saves the loci as Targets with their photometry. '
+        'Requires api_key and api_secret in settings.BROKERS["ANTARES"].'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('topics', nargs='+', help='ANTARES topics to subscribe to')
+        parser.add_argument('--group', help='Kafka consumer group. Defaults to the hostname.')
+        parser.add_argument('--batch-size', type=int, help='Maximum number of loci saved together')
+        parser.add_argument('--batch-timeout', type=float,
+                            help='Maximum number of seconds to wait for a batch to fill before saving it')
+
+    def handle(self, *args, **options):
+        consumer = StreamConsumer(
+            get_streaming_client(options['topics'], group=options['group']),
+            batch_size=options['batch_size'],
+            batch_timeout=options['batch_timeout'],
+        )
+
+        def stop(signum, frame):
+            self.stdout.write('Finishing the current batch and exiting...')
+            consumer.stop()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        consumer.run()
+        self.stdout.write(f'Saved {consumer.num_loci} loci in {consumer.num_batches} batches')
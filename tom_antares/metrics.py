@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from tom_antares.utils import get_antares_setting
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def logging_sink(kind, name, value, labels):
+    '''
+    Logs each observation at DEBUG level to the ``tom_antares.metrics`` logger.
+    '''
+    label_text = ','.join(f'{key}={value}' for key, value in sorted(labels.items()))
+    logger.debug(f'{kind} {name}{{{label_text}}} {value}')
+
+
+# Sinks that can be named in the metrics_sinks setting. 'prometheus' only keeps the totals,
+# which every enabled configuration does, for prometheus_view to serve.
+SINKS = {'logging': logging_sink, 'prometheus': None}
+
+
+def endpoint(url):
+    '''
+    Returns the kind of ANTARES API endpoint requested by ``url``.
+    '''
+    path = urlsplit(url).path.rstrip('/')
+    if path.endswith('/loci'):
+        return 'search'
+    if path.endswith('/statistics'):
+        return 'statistics'
+    if path.endswith('/alerts'):
+        return 'alerts'
+    return 'locus'
+
+
+class Metrics:
+    '''
+    Counters and latency histograms for the stages of a query: fetching the tags, HTTP requests
+    to ANTARES, deserialization of loci by ``antares_client``, ``alert_to_dict`` and the
+    conversion to ``GenericAlert``.
+
+    Metrics are disabled unless ``metrics_sinks`` lists where to send them: ``'logging'``,
+    ``'prometheus'`` (served by ``prometheus_view``), or the dotted path of a callable, which
+    is called with the kind (``'counter'`` or ``'histogram'``), name, value and labels of every
+    observation. When disabled, each instrumented call costs a single settings lookup.
+
+    Configure in ``settings.py``:
+
+        BROKERS = {
+            'ANTARES': {
+                'metrics_sinks': ['prometheus', 'logging'],
+            }
+        }
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sink_names = None
+        self._sinks = []
+
+    @property
+    def enabled(self):
+        return bool(get_antares_setting('metrics_sinks'))
+
+    @property
+    def sinks(self):
+        names = tuple(get_antares_setting('metrics_sinks', ()))
+        if names != self._sink_names:
+            self._sinks = [SINKS[name] if name in SINKS else import_string(name) for name in names]
+            self._sink_names = names
+        return [sink for sink in self._sinks if sink is not None]
+
+    @property
+    def http_seconds(self):
+        '''
+        The time this thread has spent in HTTP requests to ANTARES while metrics were enabled.
+        '''
+        return getattr(self._local, 'http_seconds', 0.0)
+
+    def _emit(self, kind, name, value, labels):
+        for sink in self.sinks:
+            try:
+                sink(kind, name, value, labels)
+            except Exception as e:
+                logger.warning(f'Metrics sink {sink} failed: {e}')
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._emit('counter', name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+            bucket = bisect_left(LATENCY_BUCKETS, seconds)
+            if bucket < len(LATENCY_BUCKETS):
+                histogram['buckets'][bucket] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        self._emit('histogram', name, seconds, labels)
+
+    @contextmanager
+    def timer(self, stage, exclude_http=False):
+        '''
+        Records the time spent in the block in the ``tom_antares_stage_seconds`` histogram. With
+        ``exclude_http``, time spent waiting for ANTARES, e.g. when ``antares_client`` fetches the
+        next page of a search, is left out, so that only processing is measured.
+        '''
+        if not self.enabled:
+            yield
+            return
+        http_start = self.http_seconds
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if exclude_http:
+                elapsed -= self.http_seconds - http_start
+            self.observe('tom_antares_stage_seconds', max(elapsed, 0.0), stage=stage)
+
+    def record_request(self, url, seconds, response=None):
+        '''
+        Records an HTTP request to ANTARES, and its response, or ``None`` if it failed.
+        '''
+        self._local.http_seconds = self.http_seconds + seconds
+        kind = endpoint(url)
+        self.increment('tom_antares_requests_total', endpoint=kind)
+        self.observe('tom_antares_request_seconds', seconds, endpoint=kind)
+        if kind == 'search':
+            self.increment('tom_antares_pages_total')
+        if response is None or response.status_code >= 400:
+            self.increment('tom_antares_request_errors_total', endpoint=kind)
+        else:
+            self.increment('tom_antares_response_bytes_total', len(response.content), endpoint=kind)
+
+    def to_prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        def label_text(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        names = set()
+        for (name, labels), value in counters:
+            if name not in names:
+                lines.append(f'# TYPE {name} counter')
+                names.add(name)
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            if name not in names:
+                lines.append(f'# TYPE {name} histogram')
+                names.add(name)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{label_text(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{label_text(labels, le="+Inf")} {histogram["count"]}')
+            lines.append(f'{name}_sum{label_text(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{label_text(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+metrics = Metrics()
+
+
+class InstrumentedRequests:
+    '''
+    Stands in for the ``requests`` module used by ``antares_client``, recording every GET to
+    ANTARES in ``metrics``. Everything else is passed through to the wrapped module, which
+    ``tom_antares.transport.route_antares_client`` sets to ``http_transport``.
+    '''
+
+    def __init__(self, requests_module):
+        self._requests = requests_module
+
+    def __getattr__(self, name):
+        return getattr(self._requests, name)
+
+    def get(self, url, *args, **kwargs):
+        if not metrics.enabled:
+            return self._requests.get(url, *args, **kwargs)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self._requests.get(url, *args, **kwargs)
+            return response
+        finally:
+            metrics.record_request(url, time.perf_counter() - start, response)
+
+
+def prometheus_view(request):
+    '''
+    Serves ``metrics`` to Prometheus. Add it to your TOM's ``urls.py``:
+
+        path('antares/metrics/', prometheus_view),
+    '''
+    return HttpResponse(metrics.to_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('tom_alerts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('newest_alert_observation_time', models.FloatField(blank=True, default=None, null=True)),
+                ('locus_ids', models.JSONField(default=list)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('query', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='antares_watermark', to='tom_alerts.brokerquery')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import models
+
+
+class QueryWatermark(models.Model):
+    """
+    Class recording how far a saved ANTARES ``BrokerQuery`` has been polled.
+
+    :param query: The ``BrokerQuery`` this watermark belongs to.
+
+    :param newest_alert_observation_time: The largest ``properties.newest_alert_observation_time`` (MJD) of
+                                          the loci returned by the previous polls, or ``None`` if the query
+                                          has not been polled yet.
+    :type newest_alert_observation_time: float
+
+    :param locus_ids: The ids of the loci seen at exactly ``newest_alert_observation_time``, which the next
+                      poll returns again and skips.
+    :type locus_ids: list
+
+    :param modified: The time at which this watermark last advanced.
+    :type modified: datetime
+    """
+    query = models.OneToOneField('tom_alerts.BrokerQuery', on_delete=models.CASCADE, related_name='antares_watermark')
+    newest_alert_observation_time = models.FloatField(null=True, blank=True, default=None)
+    locus_ids = models.JSONField(default=list)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.query} polled up to MJD {self.newest_alert_observation_time}'
@@ -0,0 +1,462 @@
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from tom_antares.utils import LazyModule, angular_separation, get_antares_setting
+
+np = LazyModule('numpy')
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SKY_INDEX_NSIDE = 256
+DEFAULT_SKY_INDEX_TTL = 3600
+
+# Loci added since the index was last merged are kept in a dict until there are this many, or
+# until the index is saved, which happens at most every SKY_INDEX_SAVE_INTERVAL seconds
+SKY_INDEX_MERGE_SIZE = 10000
+SKY_INDEX_SAVE_INTERVAL = 60
+
+# Arrays of the index, sorted by pixel, each saved to a .npy file of this name
+COLUMNS = ('pixels', 'ra', 'dec', 'locus_ids', 'ztf_object_ids')
+
+# Each save writes a new snapshot directory of .npy files, named in the CURRENT_SNAPSHOT file.
+# Snapshots replaced more than SKY_INDEX_SNAPSHOT_GRACE seconds ago, which no process can still
+# be loading or saving, are deleted.
+CURRENT_SNAPSHOT = 'current'
+SNAPSHOT_PREFIX = 'snapshot-'
+SKY_INDEX_SNAPSHOT_GRACE = 300
+
+
+def spread_bits(values):
+    '''
+    Interleaves zeros between the bits of non-negative integers below 2**32.
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    values = (values | (values << 16)) & 0x0000FFFF0000FFFF
+    values = (values | (values << 8)) & 0x00FF00FF00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F0F0F0F0F
+    values = (values | (values << 2)) & 0x3333333333333333
+    return (values | (values << 1)) & 0x5555555555555555
+
+
+def ang2pix(nside, ra, dec):
+    '''
+    Returns the HEALPix pixels, in the NESTED scheme, containing positions given in degrees.
+    ``nside`` must be a power of two. Follows ``loc2pix`` of the HEALPix C++ library.
+    '''
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.mod(np.radians(ra) / (np.pi / 2), 4.0)
+    face = np.empty(len(ra), dtype=np.int64)
+    ix = np.empty(len(ra), dtype=np.int64)
+    iy = np.empty(len(ra), dtype=np.int64)
+
+    equatorial = za <= 2 / 3
+    temp1 = nside * (0.5 + tt[equatorial])
+    temp2 = nside * z[equatorial] * 0.75
+    jp = (temp1 - temp2).astype(np.int64)  # index of the ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # index of the descending edge line
+    ifp = jp // nside
+    ifm = jm // nside
+    face[equatorial] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[equatorial] = jm & (nside - 1)
+    iy[equatorial] = nside - (jp & (nside - 1)) - 1
+
+    polar = ~equatorial
+    ntt = np.minimum(tt[polar].astype(np.int64), 3)
+    tp = tt[polar] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[polar]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[polar] >= 0
+    face[polar] = np.where(north, ntt, ntt + 8)
+    ix[polar] = np.where(north, nside - jm - 1, jp)
+    iy[polar] = np.where(north, nside - jp - 1, jm)
+
+    return face * nside * nside + spread_bits(ix) + (spread_bits(iy) << 1)
+
+
+def pixel_size(nside):
+    '''
+    The side, in degrees, of a square with the area of a HEALPix pixel.
+    '''
+    return math.degrees(math.sqrt(4 * math.pi / (12 * nside * nside)))
+
+
+def max_pixel_radius(nside):
+    '''
+    An upper bound, in degrees, on the distance from any point of a pixel to its center.
+    '''
+    return 1.5 * pixel_size(nside)
+
+
+def disc_pixels(nside, ra, dec, radius):
+    '''
+    Returns the sorted pixels containing the points of a grid sampling the disc of ``radius``
+    degrees around (``ra``, ``dec``), with a quarter of ``pixel_size`` between points. Every pixel
+    lying entirely within the disc is included.
+    '''
+    step = pixel_size(nside) / 4
+    sin_dec, cos_dec = math.sin(math.radians(dec)), math.cos(math.radians(dec))
+    rows = np.append(np.arange(max(dec - radius, -90.0), min(dec + radius, 90.0), step), min(dec + radius, 90.0))
+    points_ra = [np.array([ra])]
+    points_dec = [np.array([dec])]
+    for row in rows:
+        cos_row = math.cos(math.radians(row))
+        denominator = cos_row * cos_dec
+        if denominator <= 1e-12:
+            half_width = 180.0
+        else:
+            cos_width = (math.cos(math.radians(radius)) - math.sin(math.radians(row)) * sin_dec) / denominator
+            half_width = math.degrees(math.acos(min(max(cos_width, -1.0), 1.0)))
+        offsets = np.arange(-half_width, half_width, step / max(cos_row, 1e-12))
+        points_ra.append(ra + np.append(offsets, half_width))
+        points_dec.append(np.full(len(offsets) + 1, row))
+    points_ra = np.concatenate(points_ra)
+    points_dec = np.concatenate(points_dec)
+    inside = angular_separation(ra, dec, points_ra, points_dec) <= radius
+    return np.unique(ang2pix(nside, points_ra[inside], points_dec[inside]))
+
+
+class SkyIndex:
+    '''
+    A local index of the positions of the loci seen by ``ANTARESBroker.fetch_alerts``,
+    ``fetch_projected`` and ``StreamConsumer``, which answers cone searches and cross-matches
+    without contacting ANTARES.
+
+    Loci are partitioned into HEALPix pixels of ``nside`` (NESTED scheme). Their pixels,
+    positions, locus ids and ZTF object ids are kept as NumPy arrays sorted by pixel, so the
+    loci of any pixel are found by binary search. The arrays are saved as ``.npy`` files in a
+    snapshot directory within ``path`` and memory-mapped when loaded, so a large index costs
+    no memory until it is used. A save writes a new snapshot and then names it in the
+    ``current`` file with a single ``os.replace``, so the arrays are always loaded together
+    from one save.
+
+    The index also records when each pixel was last covered by a complete cone search of
+    ANTARES, i.e. one constrained by nothing but the cone, which returned every locus. Only
+    regions covered within the last ``ttl`` seconds are answered from the index by
+    ``ANTARESBroker.cone_search``.
+
+    The index is disabled unless ``sky_index_path`` is set. Configure in ``settings.py``:
+
+        BROKERS = {
+            'ANTARES': {
+                'sky_index_path': '/var/lib/tom/antares_sky_index',
+                'sky_index_nside': 256,
+                'sky_index_ttl': 3600,
+            }
+        }
+
+    ``nside`` only applies when a new index is created. Processes sharing a path merge their
+    additions with those already saved whenever they save.
+    '''
+
+    def __init__(self, path=None, nside=None, ttl=None, clock=time.time):
+        self._path = path
+        self._nside = nside
+        self._ttl = ttl
+        self.clock = clock
+        self._lock = threading.RLock()
+        self._loaded_path = None
+        self._saved_snapshot = None
+        self._last_save = 0.0
+        self._dirty = False
+        self._pending = {}
+        self.columns = None
+        self.covered_at = None
+
+    @property
+    def path(self):
+        return self._path or get_antares_setting('sky_index_path')
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else get_antares_setting('sky_index_ttl', DEFAULT_SKY_INDEX_TTL)
+
+    @property
+    def nside(self):
+        self._ensure_loaded()
+        return int(math.sqrt(len(self.covered_at) // 12))
+
+    def __len__(self):
+        self._ensure_loaded()
+        with self._lock:
+            self._merge()
+            return len(self.columns['pixels'])
+
+    @staticmethod
+    def _snapshot(path):
+        '''Returns the name of the current snapshot in ``path``, or ``None``.'''
+        try:
+            with open(os.path.join(path, CURRENT_SNAPSHOT)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _read(self, path):
+        '''
+        Returns the name, columns and coverage of the current snapshot in ``path``, or ``None``
+        if there is none. Raises ``ValueError`` if its arrays do not belong together.
+        '''
+        while True:
+            snapshot = self._snapshot(path)
+            if snapshot is None:
+                return None
+            directory = os.path.join(path, snapshot)
+            try:
+                columns = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='c') for name in COLUMNS}
+                covered_at = np.load(os.path.join(directory, 'covered_at.npy'), mmap_mode='c')
+            except FileNotFoundError:
+                # Deleted after being replaced by another save: read the one replacing it
+                if self._snapshot(path) == snapshot:
+                    raise
+                continue
+            lengths = {name: len(values) for name, values in columns.items()}
+            nside = math.isqrt(len(covered_at) // 12)
+            if len(set(lengths.values())) != 1 or len(covered_at) != 12 * nside * nside or not nside:
+                raise ValueError(
+                    f'Sky index snapshot {directory} is inconsistent: columns of lengths {lengths} '
+                    f'and coverage of {len(covered_at)} pixels'
+                )
+            return snapshot, columns, covered_at
+
+    def _remove_snapshots(self, path, current):
+        # Snapshots are removed once no other process can still be loading or saving them
+        cutoff = time.time() - SKY_INDEX_SNAPSHOT_GRACE
+        for name in os.listdir(path):
+            directory = os.path.join(path, name)
+            if name.startswith(SNAPSHOT_PREFIX) and name != current and os.path.getmtime(directory) < cutoff:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _ensure_loaded(self):
+        path = self.path
+        with self._lock:
+            if path == self._loaded_path and self.columns is not None:
+                return
+            self._pending = {}
+            saved = self._read(path) if path else None
+            if saved is not None:
+                self._saved_snapshot, self.columns, self.covered_at = saved
+            else:
+                self._saved_snapshot = None
+                nside = self._nside or get_antares_setting('sky_index_nside', DEFAULT_SKY_INDEX_NSIDE)
+                self.columns = {
+                    'pixels': np.empty(0, dtype=np.int64),
+                    'ra': np.empty(0, dtype=float),
+                    'dec': np.empty(0, dtype=float),
+                    'locus_ids': np.empty(0, dtype='U1'),
+                    'ztf_object_ids': np.empty(0, dtype='U1'),
+                }
+                self.covered_at = np.zeros(12 * nside * nside, dtype=float)
+            self._loaded_path = path
+
+    def add(self, alerts):
+        '''
+        Adds serialized loci, e.g. from ``alert_to_dict`` or ``fetch_projected``, to the index,
+        replacing any previous entries for the same loci.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            for alert in alerts:
+                if alert.get('ra') is None or alert.get('dec') is None:
+                    continue
+                self._pending[alert['locus_id']] = (
+                    alert['ra'], alert['dec'], alert['properties'].get('ztf_object_id') or ''
+                )
+            if len(self._pending) >= SKY_INDEX_MERGE_SIZE:
+                self._merge()
+
+    def add_positions(self, locus_ids, ra, dec, ztf_object_ids=None):
+        '''
+        Adds many loci at once from arrays of their ids, positions and ZTF object ids.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            self._merge()
+            ztf_object_ids = ztf_object_ids if ztf_object_ids is not None else [''] * len(locus_ids)
+            self._combine({
+                'pixels': ang2pix(self.nside, ra, dec),
+                'ra': np.asarray(ra, dtype=float),
+                'dec': np.asarray(dec, dtype=float),
+                'locus_ids': np.asarray(locus_ids, dtype=str),
+                'ztf_object_ids': np.asarray(ztf_object_ids, dtype=str),
+            })
+
+    def _merge(self):
+        if not self._pending:
+            return
+        locus_ids = list(self._pending)
+        ra, dec, ztf_object_ids = zip(*self._pending.values())
+        self._pending = {}
+        self._combine({
+            'pixels': ang2pix(self.nside, ra, dec),
+            'ra': np.asarray(ra, dtype=float),
+            'dec': np.asarray(dec, dtype=float),
+            'locus_ids': np.asarray(locus_ids, dtype=str),
+            'ztf_object_ids': np.asarray(ztf_object_ids, dtype=str),
+        })
+
+    def _combine(self, new):
+        # Entries in new replace those with the same locus_id
+        keep = ~np.isin(self.columns['locus_ids'], new['locus_ids'])
+        combined = {name: np.concatenate([self.columns[name][keep], new[name]]) for name in COLUMNS}
+        order = np.argsort(combined['pixels'], kind='stable')
+        self.columns = {name: values[order] for name, values in combined.items()}
+        self._dirty = True
+
+    def _candidates(self, ra, dec, radius):
+        '''Returns the indices of the loci in the pixels that may intersect the cone.'''
+        pixels = disc_pixels(self.nside, ra, dec, radius + 2 * max_pixel_radius(self.nside))
+        starts = np.searchsorted(self.columns['pixels'], pixels, side='left')
+        ends = np.searchsorted(self.columns['pixels'], pixels, side='right')
+        nonempty = ends > starts
+        if not nonempty.any():
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts[nonempty], ends[nonempty])])
+
+    def cone(self, ra, dec, radius) -> list:
+        '''
+        Returns the indexed loci within ``radius`` degrees of (``ra``, ``dec``), nearest first,
+        as dicts of their ``locus_id``, ``ztf_object_id``, ``ra``, ``dec`` and ``separation``.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            self._merge()
+            candidates = self._candidates(ra, dec, radius)
+            separations = angular_separation(ra, dec, self.columns['ra'][candidates], self.columns['dec'][candidates])
+            inside = separations <= radius
+            matches = [
+                {
+                    'locus_id': str(self.columns['locus_ids'][i]),
+                    'ztf_object_id': str(self.columns['ztf_object_ids'][i]),
+                    'ra': float(self.columns['ra'][i]),
+                    'dec': float(self.columns['dec'][i]),
+                    'separation': float(separation),
+                }
+                for i, separation in zip(candidates[inside], separations[inside])
+            ]
+        return sorted(matches, key=lambda match: match['separation'])
+
+    def cross_match(self, ra, dec, radius) -> list:
+        '''
+        Returns the indexed loci within ``radius`` degrees of each of the given positions, as a
+        list of ``cone`` results in the same order.
+        '''
+        return [self.cone(ra_, dec_, radius) for ra_, dec_ in zip(ra, dec)]
+
+    def match_targets(self, radius, targets=None) -> list:
+        '''
+        Cross-matches sidereal ``Target``s, by default all of them, with the indexed loci.
+
+        :returns: a ``(target, match)`` tuple for each locus within ``radius`` degrees of a
+                  target, where ``match`` is as returned by ``cone``
+        '''
+        from tom_targets.models import Target
+
+        targets = list((targets if targets is not None else Target.objects.all()).filter(
+            type='SIDEREAL', ra__isnull=False, dec__isnull=False
+        ))
+        matches = self.cross_match([target.ra for target in targets], [target.dec for target in targets], radius)
+        return [(target, match) for target, target_matches in zip(targets, matches) for match in target_matches]
+
+    def covers(self, ra, dec, radius) -> bool:
+        '''
+        Whether every pixel intersecting the cone was covered by a complete search within the
+        last ``ttl`` seconds.
+        '''
+        self._ensure_loaded()
+        pixels = disc_pixels(self.nside, ra, dec, radius + 2 * max_pixel_radius(self.nside))
+        with self._lock:
+            covered_at = self.covered_at[pixels]
+            return bool(((covered_at > 0) & (covered_at >= self.clock() - self.ttl)).all())
+
+    def mark_covered(self, ra, dec, radius):
+        '''
+        Records that every locus within the cone is indexed, as it was found by a complete
+        search. Only the pixels lying entirely within the cone are marked.
+        '''
+        self._ensure_loaded()
+        inner_radius = radius - 2 * max_pixel_radius(self.nside)
+        if inner_radius <= 0:
+            return
+        pixels = disc_pixels(self.nside, ra, dec, inner_radius)
+        with self._lock:
+            self.covered_at[pixels] = self.clock()
+            self._dirty = True
+
+    def save(self):
+        '''
+        Writes the index to a new snapshot in ``path``, first merging any loci and coverage
+        saved there by other processes since it was loaded, and then makes it the current
+        snapshot with a single ``os.replace``.
+        '''
+        self._ensure_loaded()
+        path = self.path
+        with self._lock:
+            self._merge()
+            saved = self._read(path) if self._snapshot(path) != self._saved_snapshot else None
+            if saved is not None:
+                _, saved_columns, saved_covered_at = saved
+                keep = ~np.isin(saved_columns['locus_ids'], self.columns['locus_ids'])
+                if keep.any():
+                    ours = self.columns
+                    self.columns = {name: saved_columns[name][keep] for name in COLUMNS}
+                    self._combine(ours)
+                self.covered_at = np.maximum(self.covered_at, saved_covered_at)
+
+            os.makedirs(path, exist_ok=True)
+            snapshot = f'{SNAPSHOT_PREFIX}{uuid.uuid4().hex}'
+            os.mkdir(os.path.join(path, snapshot))
+            for name, values in list(self.columns.items()) + [('covered_at', self.covered_at)]:
+                np.save(os.path.join(path, snapshot, f'{name}.npy'), values)
+            partial = os.path.join(path, f'.{CURRENT_SNAPSHOT}.{snapshot}')
+            with open(partial, 'w') as f:
+                f.write(snapshot)
+            os.replace(partial, os.path.join(path, CURRENT_SNAPSHOT))
+            self._remove_snapshots(path, snapshot)
+            self._saved_snapshot = snapshot
+            self._last_save = self.clock()
+            self._dirty = False
+            self._loaded_path = None
+            self._ensure_loaded()
+
+    def flush(self):
+        '''
+        Saves the index if it has changed and was last saved more than
+        ``SKY_INDEX_SAVE_INTERVAL`` seconds ago, or has many unmerged loci.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            due = (
+                len(self._pending) >= SKY_INDEX_MERGE_SIZE
+                or self.clock() - self._last_save >= SKY_INDEX_SAVE_INTERVAL
+            )
+            if (self._dirty or self._pending) and due:
+                self.save()
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            self.columns = None
+            self._loaded_path = None
+            if self.path and os.path.isdir(self.path):
+                current = os.path.join(self.path, CURRENT_SNAPSHOT)
+                if os.path.exists(current):
+                    os.remove(current)
+                for name in os.listdir(self.path):
+                    if name.startswith(SNAPSHOT_PREFIX):
+                        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+sky_index = SkyIndex()
@@ -0,0 +1,160 @@
+import logging
+import time
+from collections import deque
+
+from django.db import DatabaseError
+
+from tom_antares.antares import ANTARESBroker, antares_client
+from tom_antares.features import add_features
+from tom_antares.sky_index import sky_index
+from tom_antares.utils import get_antares_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STREAM_BATCH_SIZE = 100
+DEFAULT_STREAM_BATCH_TIMEOUT = 10.0
+POLL_TIMEOUT = 1.0
+MAX_RETRY_DELAY = 60.0
+DEAD_LETTER_SIZE = 1000
+
+
+def get_streaming_client(topics, group=None):
+    '''
+    Returns an ``antares_client.StreamingClient`` subscribed to ``topics``, using the
+    ``api_key`` and ``api_secret`` settings. Auto commit is disabled, as ``StreamConsumer``
+    commits only once a batch has been saved.
+    '''
+    kwargs = {'enable_auto_commit': False}
+    if group:
+        kwargs['group'] = group
+    return antares_client.StreamingClient(
+        topics, get_antares_setting('api_key'), get_antares_setting('api_secret'), **kwargs
+    )
+
+
+class StreamConsumer:
+    '''
+    Consumes loci from ANTARES Kafka topics and saves them to the TOM in micro-batches.
+
+    Loci are collected until ``batch_size`` have arrived, or ``batch_timeout`` seconds have
+    passed since the first of the batch arrived. They are then serialized with
+    ``alert_to_dict`` and saved with ``ANTARESBroker.ingest_alerts``. The stream is only
+    committed once a batch has been saved, so every locus is ingested at least once: database
+    errors are retried with exponential backoff, and anything uncommitted is redelivered
+    after a restart. Ingestion skips existing targets and photometry, so redelivery is
+    harmless.
+
+    A locus that cannot be converted to a target, e.g. one without a ZTF object id, is logged
+    and skipped, and kept with its error in ``dead_letters``, which holds the last
+    ``DEAD_LETTER_SIZE`` of them. The rest of its batch is saved and committed as usual, so
+    one bad locus cannot stop the stream.
+
+    No messages are polled while a batch is being saved, which applies backpressure:
+    unconsumed loci wait in Kafka rather than in memory. ``stop`` may be called from a signal
+    handler, after which the current batch is saved and committed and the client closed.
+    '''
+
+    def __init__(self, client, broker=None, batch_size=None, batch_timeout=None, poll_timeout=POLL_TIMEOUT,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.client = client
+        self.broker = broker or ANTARESBroker()
+        self.batch_size = batch_size or get_antares_setting('stream_batch_size', DEFAULT_STREAM_BATCH_SIZE)
+        self.batch_timeout = batch_timeout or get_antares_setting(
+            'stream_batch_timeout', DEFAULT_STREAM_BATCH_TIMEOUT
+        )
+        self.poll_timeout = poll_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.stopped = False
+        self.num_batches = 0
+        self.num_loci = 0
+        self.dead_letters = deque(maxlen=DEAD_LETTER_SIZE)
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self, max_batches=None):
+        '''
+        Consumes and saves batches until ``stop`` is called, or ``max_batches`` have been saved.
+        '''
+        try:
+            while not self.stopped and (max_batches is None or self.num_batches < max_batches):
+                batch = self.collect_batch()
+                if batch:
+                    self.ingest(batch)
+        finally:
+            self.client.close()
+
+    def collect_batch(self):
+        '''
+        Polls the stream until a batch is full, has timed out, or the consumer is stopped.
+
+        :returns: a list of ``(topic, locus)`` tuples
+        '''
+        batch = []
+        started = None
+        while not self.stopped and len(batch) < self.batch_size:
+            timeout = self.poll_timeout
+            if started is not None:
+                remaining = self.batch_timeout - (self.clock() - started)
+                if remaining <= 0:
+                    break
+                timeout = min(timeout, remaining)
+            topic, locus = self.client.poll(timeout=timeout)
+            if locus is None:
+                continue
+            if started is None:
+                started = self.clock()
+            batch.append((topic, locus))
+        return batch
+
+    def ingest(self, batch):
+        '''
+        Saves a batch of ``(topic, locus)`` tuples and commits the stream.
+
+        :returns: a ``(target, created)`` tuple for each locus saved
+        '''
+        alerts = []
+        for topic, locus in batch:
+            alert = self.convert(topic, locus)
+            if alert is not None:
+                alerts.append(alert)
+        if get_antares_setting('lightcurve_features', False):
+            add_features(alerts)
+        delay = 1.0
+        while True:
+            try:
+                results = self.broker.ingest_alerts(alerts)
+                break
+            except DatabaseError as e:
+                if self.stopped:
+                    raise
+                logger.warning(f'Failed to save a batch of {len(alerts)} loci, retrying in {delay}s: {e}')
+                self.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        self.client.commit()
+        if sky_index.enabled:
+            sky_index.add(alerts)
+            sky_index.flush()
+        self.num_batches += 1
+        self.num_loci += len(batch)
+        logger.info(
+            f'Saved {len(alerts)} loci from {sorted({topic for topic, _ in batch})}, '
+            f'{sum(created for _, created in results)} new targets'
+        )
+        return results
+
+    def convert(self, topic, locus):
+        '''
+        Serializes a locus with ``alert_to_dict``, or returns ``None`` and adds it to
+        ``dead_letters`` if it cannot be saved as a target.
+        '''
+        try:
+            alert = self.broker.alert_to_dict(locus, features=False)
+            self.broker.target_names(alert)
+            return alert
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            locus_id = getattr(locus, 'locus_id', None)
+            logger.error(f'Skipping locus {locus_id} from {topic}, which cannot be saved: {e!r}')
+            self.dead_letters.append((topic, locus, e))
+            return None
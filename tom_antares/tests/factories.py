@@ -17,6 +17,8 @@ class AlertFactory(factory.Factory):
          # ztf_pid sample value: 1372493490015
          'ztf_pid': factory.Faker('pyint', min_value=1000000000000, max_value=9999999999999),
          'ztf_diffmaglim': factory.Faker('pyfloat', min_value=15, max_value=23),  # sample value: 19.29050064086914,
+         'ztf_magpsf': factory.Faker('pyfloat', min_value=15, max_value=22),  # sample value: 18.615400314331055,
+         'ztf_sigmapsf': factory.Faker('pyfloat', min_value=0.01, max_value=0.3),  # sample value: 0.0873,
          # NOTE: the remaining properties are unused by our code
          # 'ztf_pdiffimfilename':
          # sample: '/ztf/archive/sci/2020/1004/493495/ztf_20201004493495_000817_zg_c01_o_q1_scimrefdiffimg.fits.fz',
@@ -0,0 +1,118 @@
+import json
+import os
+import time
+from collections import defaultdict
+from unittest import mock
+from urllib.parse import urlsplit
+
+import requests
+
+from tom_antares.transport import http_transport, route_antares_client
+
+
+class CassetteMiss(LookupError):
+    """Raised when a request is replayed that was not recorded."""
+
+
+class Cassette:
+    """
+    Records the HTTP responses ``antares_client`` receives, such as search pages, loci from
+    ``get_by_id`` and the tag statistics, to a JSON file, and replays them without network
+    access.
+
+    In ``'record'`` mode requests are sent as usual and saved when the context exits. In
+    ``'replay'`` mode they are answered from the file, after waiting ``latency`` seconds, or as
+    long as the original request took when ``latency='recorded'``. ``'auto'`` replays the file
+    if it exists and records it otherwise:
+
+        with Cassette('tom_antares/tests/cassettes/in_m31.json', latency='recorded'):
+            alerts = list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 100}))
+
+    The cassette stands in for ``tom_antares.transport.http_transport``, through which
+    ``antares_client`` and the async client send their requests, routing ``antares_client``
+    first if it was not imported yet.
+
+    Requests are matched on their path and parameters, so a cassette recorded against
+    ``ANTARESStandInServer`` replays against any base URL. Identical requests are answered
+    with their recorded responses in order, repeating the last one.
+    """
+
+    def __init__(self, path, mode='auto', latency=0.0, sleep=time.sleep):
+        if mode == 'auto':
+            mode = 'replay' if os.path.exists(path) else 'record'
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode {mode}')
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.sleep = sleep
+        self.interactions = []
+        self.played = 0
+        self._responses = defaultdict(list)
+        self._patcher = None
+        self._send = None
+
+    @staticmethod
+    def request_key(url, params=None):
+        url = urlsplit(url)
+        return json.dumps([url.path, url.query, params or {}], sort_keys=True)
+
+    def load(self):
+        with open(self.path) as f:
+            self.interactions = json.load(f)
+        self._responses.clear()
+        for interaction in self.interactions:
+            self._responses[self.request_key(interaction['url'], interaction['params'])].append(interaction)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.interactions, f)
+
+    def get(self, url, params=None, **kwargs):
+        if self.mode == 'record':
+            return self.record(url, params, **kwargs)
+        return self.replay(url, params)
+
+    def record(self, url, params=None, **kwargs):
+        start = time.perf_counter()
+        response = self._send(url, params=params, **kwargs)
+        self.interactions.append({
+            'url': url,
+            'params': params,
+            'status': response.status_code,
+            'body': response.text,
+            'elapsed': time.perf_counter() - start,
+        })
+        return response
+
+    def replay(self, url, params=None):
+        responses = self._responses.get(self.request_key(url, params))
+        if not responses:
+            raise CassetteMiss(f'No response to GET {url} {params} was recorded in {self.path}')
+        interaction = responses.pop(0) if len(responses) > 1 else responses[0]
+        self.sleep(interaction['elapsed'] if self.latency == 'recorded' else self.latency)
+        self.played += 1
+
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response._content = interaction['body'].encode()
+        response.encoding = 'utf-8'
+        response.url = url
+        response.headers['Content-Type'] = 'application/vnd.api+json'
+        return response
+
+    def __enter__(self):
+        if self.mode == 'replay':
+            self.load()
+        # Routed now, so that importing antares_client later cannot bypass the cassette
+        route_antares_client()
+        self._send = http_transport.get
+        self._patcher = mock.patch.object(http_transport, 'get', self.get)
+        self._patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._patcher.stop()
+        if self.mode == 'record':
+            self.save()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# run_benchmarks.py
+
+import argparse
+import json
+import os
+import sys
+
+from django.core.management import call_command
+from boot_django import boot_django, APP_NAME  # noqa
+
+parser = argparse.ArgumentParser(description=f'Runs the benchmarks for {APP_NAME}')
+parser.add_argument('--scale', type=float, default=1,
+                    help='multiplies the number of loci each benchmark uses, e.g. 10 for 20k loci')
+parser.add_argument('--save', help='write the results to this JSON file')
+parser.add_argument('--baseline', help='compare the results with those in this JSON file')
+parser.add_argument('--threshold', type=float, default=0.25,
+                    help='fraction by which throughput may fall, or peak memory rise, before failing')
+args = parser.parse_args()
+
+os.environ['ANTARES_BENCHMARK_SCALE'] = str(args.scale)
+boot_django()
+print(f'running benchmarks for {APP_NAME}')
+call_command('test', APP_NAME, '--tag=benchmark', verbosity=2)
+
+from tom_antares.tests.tests_benchmark import compare_to_baseline, results, save_results  # noqa: E402
+
+if args.save:
+    save_results(args.save)
+    print(f'saved {len(results)} results to {args.save}')
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['scale'] != args.scale:
+        sys.exit(f'{args.baseline} was recorded with --scale {baseline["scale"]}')
+    regressions = compare_to_baseline(results, baseline['results'], args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+    print(f'no regressions against {args.baseline}')
@@ -0,0 +1,263 @@
+import json
+import math
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import requests
+from antares_client.config import config
+
+
+def locus_document(locus):
+    """Returns the JSON:API resource ANTARES serves for a locus, without its alerts."""
+    return {
+        'type': 'locus',
+        'id': locus.locus_id,
+        'attributes': {
+            'ra': locus.ra,
+            'dec': locus.dec,
+            'properties': locus.properties,
+            'tags': locus.tags,
+            'catalogs': locus.catalogs,
+        },
+    }
+
+
+def alert_document(alert):
+    """Returns the JSON:API resource ANTARES serves for an alert."""
+    return {
+        'type': 'alert',
+        'id': alert.alert_id,
+        'attributes': {'mjd': alert.mjd, 'properties': alert.properties},
+    }
+
+
+def field_values(document, field):
+    """Returns the values of a dotted field of a locus's attributes as a list."""
+    value = document
+    for name in field.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return []
+        value = value[name]
+    return value if isinstance(value, list) else [value]
+
+
+def separation(ra1, dec1, ra2, dec2):
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    a = math.sin((dec2 - dec1) / 2) ** 2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2) ** 2
+    return math.degrees(2 * math.asin(min(1.0, math.sqrt(a))))
+
+
+def matches(query, document):
+    """
+    Returns whether the attributes of a locus document match an Elasticsearch query.
+
+    Only the clauses the broker sends are understood: ``bool``, ``term``, ``match``, ``terms``,
+    ``range`` and ``sky_distance``. Other clauses match every locus.
+    """
+    if isinstance(query, list):
+        return all(matches(clause, document) for clause in query)
+    if 'query' in query:
+        return matches(query['query'], document)
+    if 'bool' in query:
+        clauses = query['bool']
+
+        def as_list(clause):
+            return clause if isinstance(clause, list) else [clause]
+
+        should = as_list(clauses.get('should', []))
+        return (
+            all(matches(clause, document) for key in ('must', 'filter') for clause in as_list(clauses.get(key, [])))
+            and not any(matches(clause, document) for clause in as_list(clauses.get('must_not', [])))
+            and (not should or sum(matches(clause, document) for clause in should)
+                 >= int(clauses.get('minimum_should_match', 1)))
+        )
+    for key in ('term', 'match'):
+        if key in query:
+            ((field, value),) = query[key].items()
+            value = value.get('query', value.get('value')) if isinstance(value, dict) else value
+            return value in field_values(document, field)
+    if 'terms' in query:
+        ((field, values),) = query['terms'].items()
+        return bool(set(values) & set(field_values(document, field)))
+    if 'range' in query:
+        ((field, bounds),) = query['range'].items()
+        comparisons = {
+            'gte': lambda x, y: x >= y, 'gt': lambda x, y: x > y,
+            'lte': lambda x, y: x <= y, 'lt': lambda x, y: x < y,
+        }
+        return any(
+            all(comparisons[op](value, float(bound)) for op, bound in bounds.items() if op in comparisons)
+            for value in field_values(document, field) if isinstance(value, (int, float))
+        )
+    if 'sky_distance' in query:
+        ra, dec = map(float, query['sky_distance']['htm16']['center'].split())
+        radius = float(query['sky_distance']['distance'].split()[0])
+        return separation(ra, dec, document['ra'], document['dec']) <= radius
+    return True
+
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Connections from a pool of lookups arrive at once: with the default backlog of 5, the
+    # rest would be dropped and retried a second later
+    request_queue_size = 128
+
+
+class ANTARESStandInServer:
+    """
+    A local HTTP server implementing the parts of the ANTARES API used by ``antares_client``,
+    serving the given loci, e.g. from ``LocusFactory``.
+
+    Searches are evaluated with ``matches``, sorted by ``newest_alert_observation_time`` like
+    ANTARES, or by the locus property given as ``sort``, with loci lacking it last, and
+    paginated with ``page_size`` loci per page unless ``page[limit]`` is given.
+    ``fields[locus_listing]`` limits the attributes returned, as a JSON:API sparse fieldset.
+    ``latency`` seconds are added to every response. While the server is in use as a context
+    manager, ``antares_client`` sends its requests to it rather than to ANTARES:
+
+        with ANTARESStandInServer([LocusFactory.create() for i in range(0, 1000)]):
+            alerts = list(ANTARESBroker().fetch_alerts({'max_alerts': 500}))
+
+    ``requests`` counts the requests served to each kind of endpoint. Setting ``failures`` to
+    a number of requests makes the server answer that many with HTTP 503, to simulate an outage.
+    """
+
+    def __init__(self, loci, page_size=100, latency=0.0, tags=None):
+        self.page_size = page_size
+        self.latency = latency
+        self.requests = Counter()
+        self.failures = 0
+        self._lock = threading.Lock()
+        self.documents = {}
+        self.alerts = {}
+        for locus in sorted(
+            loci, key=lambda locus: locus.properties.get('newest_alert_observation_time', 0), reverse=True
+        ):
+            self.documents[locus.locus_id] = locus_document(locus)
+            self.alerts[locus.locus_id] = [alert_document(alert) for alert in locus.alerts]
+        self.tags = tags if tags is not None else sorted({tag for locus in loci for tag in locus.tags})
+        self._httpd = None
+        self._thread = None
+        self._previous_base_url = None
+
+    @property
+    def base_url(self):
+        if self._httpd is None:
+            return config['ANTARES_API_BASE_URL']
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/v1/'
+
+    def get(self, url, params=None, **kwargs):
+        """
+        Answers a ``requests.get`` in-process, without a socket. Patch
+        ``antares_client._api.api.requests`` with an object having this as its ``get`` to
+        time the client and broker without HTTP overhead.
+        """
+        url = urlsplit(url)
+        status, body = self.handle(f'{url.path}?{url.query or urlencode(params or {})}')
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode()
+        response.encoding = 'utf-8'
+        return response
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Connections are kept alive between requests, as by ANTARES. Without Nagle's
+            # algorithm, the body is not held back waiting for the headers to be acknowledged.
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                status, body = server.handle(self.path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/vnd.api+json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = StandInHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        self._previous_base_url = config['ANTARES_API_BASE_URL']
+        config['ANTARES_API_BASE_URL'] = self.base_url
+        return self
+
+    def stop(self):
+        config['ANTARES_API_BASE_URL'] = self._previous_base_url
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, path):
+        """Returns the status and JSON body of the response to a GET of ``path``."""
+        url = urlsplit(path)
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                self.requests['failed'] += 1
+                return 503, {'errors': [{'status': '503', 'title': 'Service Unavailable'}]}
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part][1:]  # without the /v1 prefix
+        if parts == ['loci']:
+            self._count('search')
+            return 200, self.search(params)
+        if parts == ['loci', 'statistics']:
+            self._count('statistics')
+            return 200, {'data': {'type': 'locus_statistics', 'id': 'statistics',
+                                  'attributes': {'tags': {tag: 1 for tag in self.tags}}}}
+        if len(parts) == 2 and parts[0] == 'loci' and parts[1] in self.documents:
+            self._count('locus')
+            return 200, {'data': self.documents[parts[1]]}
+        if len(parts) == 3 and parts[0] == 'loci' and parts[2] == 'alerts' and parts[1] in self.alerts:
+            self._count('alerts')
+            return 200, {'data': self.alerts[parts[1]]}
+        self._count('not_found')
+        return 404, {'errors': [{'status': '404', 'title': 'Not Found', 'detail': url.path}]}
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def search(self, params):
+        query = json.loads(params.get('elasticsearch_query[locus_listing]', '{}'))
+        offset = int(params.get('page[offset]', 0))
+        limit = int(params.get('page[limit]', self.page_size))
+        fields = params.get('fields[locus_listing]')
+        # The results are recomputed for each page, as ANTARES does
+        results = [document for document in self.documents.values() if matches(query, document['attributes'])]
+        sort = params.get('sort')
+        if sort:
+            field = sort.lstrip('-')
+            present = [document for document in results if field_values(document['attributes'], field)]
+            present.sort(key=lambda document: field_values(document['attributes'], field)[0],
+                         reverse=sort.startswith('-'))
+            results = present + [document for document in results if not field_values(document['attributes'], field)]
+        page = []
+        for document in results[offset:offset + limit]:
+            attributes = document['attributes']
+            if fields is not None:
+                attributes = {key: value for key, value in attributes.items() if key in fields.split(',')}
+            page.append({**document, 'type': 'locus_listing', 'attributes': attributes})
+        body = {'data': page, 'links': {}, 'meta': {'count': len(results)}}
+        if offset + limit < len(results):
+            next_params = {**params, 'page[offset]': offset + limit, 'page[limit]': limit}
+            body['links']['next'] = f'{self.base_url}loci?{urlencode(next_params)}'
+        return body
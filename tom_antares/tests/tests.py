@@ -1,11 +1,50 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
 from datetime import datetime, timezone
+from importlib.util import find_spec
 
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from unittest import mock
 
-from tom_antares.antares import ANTARESBroker
-from tom_antares.tests.factories import LocusFactory
-from tom_targets.models import Target
+import marshmallow
+import numpy as np
+import requests
+from antares_client.exceptions import AntaresException
+from astropy.time import Time
+from django.core.management import call_command
+
+from tom_antares.aio import AsyncANTARESClient
+from tom_antares.antares import (
+    ANTARESBroker, ANTARESBrokerForm, ShardedSearch, aget_tag_choices, angular_separation, asearch_pages,
+    cone_search_filters, count_loci, get_available_tags, get_tag_choices, locus_alerts, locus_cache, merge_alerts,
+    query_cache, search_loci, shard_ranges, tag_cache, top_alerts
+)
+from tom_antares.cache import DiskQueryStore, LocusCache, QueryCache, TagCache
+from tom_antares.features import FEATURE_NAMES, add_features, compute_features, select_by_features
+from tom_antares.export import ALERT_PROPERTY_COLUMNS, alerts_columns, loci_columns
+from tom_antares.sky_index import SkyIndex, ang2pix, sky_index
+from tom_alerts.models import BrokerQuery
+from tom_antares.metrics import metrics, prometheus_view
+from tom_antares.models import QueryWatermark
+from tom_antares.stream import StreamConsumer
+from tom_antares.tests.factories import AlertFactory, LocusFactory
+from tom_antares.tests.replay import Cassette, CassetteMiss
+from tom_antares.tests.server import ANTARESStandInServer
+from tom_antares.transport import PooledTransport, http_transport, route_antares_client
+from tom_antares.utils import RateLimiter
+from tom_dataproducts.models import ReducedDatum
+from tom_targets.models import Target, TargetName
 
 
 class TestANTARESBrokerClass(TestCase):
@@ -40,6 +79,56 @@ class TestANTARESBrokerClass(TestCase):
         alerts = ANTARESBroker().fetch_alerts({'max_alerts': 4})
         self.assertEqual(len(list(alerts)), 4)
 
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_fetch_alerts_streams_lazily(self, mock_client):
+        """Tests that the first alert is yielded before the rest of the query is pulled from ANTARES"""
+        pulled = []
+
+        def slow_search(query):
+            for locus in self.loci:
+                time.sleep(0.05)
+                pulled.append(locus)
+                yield locus
+
+        mock_client.search.search.side_effect = slow_search
+        alerts = ANTARESBroker().fetch_alerts({'max_alerts': 5})
+        self.assertEqual(len(pulled), 0)
+
+        start = time.perf_counter()
+        first_alert = next(alerts)
+        time_to_first = time.perf_counter() - start
+
+        self.assertEqual(first_alert['locus_id'], self.loci[0].locus_id)
+        self.assertEqual(len(pulled), 1)
+        self.assertLess(time_to_first, 0.05 * len(self.loci))
+
+        # Nothing more is requested once the consumer stops iterating
+        alerts.close()
+        self.assertEqual(len(pulled), 1)
+
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_fetch_alerts_streaming_peak_memory(self, mock_client):
+        """Tests that consuming the stream one alert at a time does not hold every locus in memory"""
+        def large_search(query):
+            for i in range(50):
+                locus = LocusFactory.create()
+                locus.properties['payload'] = 'x' * 100000
+                yield locus
+
+        mock_client.search.search.side_effect = large_search
+
+        tracemalloc.start()
+        for alert in ANTARESBroker().fetch_alerts({'max_alerts': 50}):
+            pass
+        _, streaming_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        all_alerts = list(ANTARESBroker().fetch_alerts({'max_alerts': 50}))
+        _, list_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertEqual(len(all_alerts), 50)
+        self.assertLess(streaming_peak, list_peak / 5)
+
     def test_to_target_with_horizons_targetname(self):
         """
         Test that the expected names are created.
@@ -64,9 +153,1736 @@ class TestANTARESBrokerClass(TestCase):
         self.assertEqual(generic_alert.url, f'https://antares.noirlab.edu/loci/{self.locus.locus_id}')
         self.assertEqual(generic_alert.timestamp, datetime(2020, 10, 12, tzinfo=timezone.utc))
 
+    def test_to_generic_alerts(self):
+        """Test that batch conversion matches converting the alerts one at a time"""
+        for i, locus in enumerate(self.loci):
+            locus.properties['newest_alert_observation_time'] = 59134 + i / 7
+            locus.properties['newest_alert_magnitude'] = 18 + i
+        alerts = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci]
+
+        generic_alerts = ANTARESBroker().to_generic_alerts(alerts)
+
+        self.assertEqual(generic_alerts, [ANTARESBroker().to_generic_alert(alert) for alert in alerts])
+
+    def test_to_generic_alerts_without_timestamps(self):
+        self.loci[0].properties['newest_alert_observation_time'] = 59134
+        self.loci[1].properties['newest_alert_observation_time'] = float('nan')
+        alerts = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci[:3]]
+
+        generic_alerts = ANTARESBroker().to_generic_alerts(alerts)
+
+        self.assertEqual(
+            [generic_alert.timestamp for generic_alert in generic_alerts],
+            [datetime(2020, 10, 12, tzinfo=timezone.utc), None, None]
+        )
+
+    @mock.patch('tom_antares.antares.get_by_id')
     @mock.patch('tom_antares.antares.antares_client')
-    def test_fetch_alerts_by_locus_id(self, mock_client):
+    def test_fetch_alerts_by_locus_id(self, mock_client, mock_get_by_id):
         """Test that a query by locus identifier parses the alert properly"""
+        locus_cache.clear()
         mock_client.search.search.side_effect = lambda loci: iter(self.loci)
+        mock_get_by_id.return_value = self.locus
         alerts = ANTARESBroker().fetch_alerts({'antid': 'ANT2025v5k9wxb6vzbe'})
         self.assertEqual(len(list(alerts)), 1)
+
+
+class TestTagCache(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.fetch = mock.Mock(return_value=['in_m31', 'high_amp'])
+        self.tag_cache = TagCache(self.fetch, ttl=60, backend='local', clock=lambda: self.now)
+
+    def test_get_fetches_once(self):
+        """Test that repeated lookups within the TTL are served from the cache"""
+        for _ in range(3):
+            self.assertEqual(self.tag_cache.get(), ['in_m31', 'high_amp'])
+        self.fetch.assert_called_once()
+        self.assertEqual(self.tag_cache.stats(), {'hits': 2, 'misses': 1, 'refreshes': 1, 'errors': 0})
+
+    def test_get_serves_stale_while_refreshing(self):
+        """Test that an expired entry is returned immediately and refreshed in the background"""
+        self.tag_cache.get()
+        self.fetch.return_value = ['in_m31']
+        self.now += 61
+
+        self.assertEqual(self.tag_cache.get(), ['in_m31', 'high_amp'])
+        self.tag_cache._refresh_thread.join()
+        self.assertEqual(self.tag_cache.get(), ['in_m31'])
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_get_when_antares_unavailable(self):
+        """Test that a failed fetch leaves previously cached tags in place"""
+        self.fetch.side_effect = AntaresException('unavailable')
+        self.assertEqual(self.tag_cache.get(), [])
+        self.assertEqual(self.tag_cache.errors, 1)
+
+        self.fetch.side_effect = None
+        self.tag_cache.refresh()
+        self.fetch.side_effect = AntaresException('unavailable')
+        self.assertIsNone(self.tag_cache.refresh())
+        self.assertEqual(self.tag_cache.get(), ['in_m31', 'high_amp'])
+
+    def test_django_backend_is_shared(self):
+        """Test that caches using the Django backend share their entries"""
+        self.tag_cache._backend = 'django'
+        self.tag_cache.clear()
+        self.tag_cache.get()
+        other_fetch = mock.Mock()
+        other_cache = TagCache(other_fetch, ttl=60, backend='django', clock=lambda: self.now)
+
+        self.assertEqual(other_cache.get(), ['in_m31', 'high_amp'])
+        other_fetch.assert_not_called()
+        other_cache.clear()
+
+
+class TestConeSearch(TestCase):
+
+    def setUp(self):
+        # Synthetic loci around the RA=0/360 meridian and the north celestial pole
+        positions = [(359.95, 10.0), (0.05, 10.0), (1.0, 10.0), (10.0, 89.95), (190.0, 89.95), (0.0, 88.0)]
+        self.loci = [LocusFactory.create(ra=ra, dec=dec) for ra, dec in positions]
+
+    def test_angular_separation(self):
+        self.assertAlmostEqual(angular_separation(359.9, 0, 0.1, 0), 0.2)
+        self.assertAlmostEqual(angular_separation(0, 89.9, 180, 89.9), 0.2)
+        separations = angular_separation(0, 0, [0, 90, 180], [90, 0, 0])
+        self.assertTrue(all(abs(separations - [90, 90, 180]) < 1e-9))
+
+    def test_cone_search_filters_widened_by_declination(self):
+        dec_range, ra_range = cone_search_filters(100.0, 60.0, 1.0)
+        self.assertEqual(dec_range, {'range': {'dec': {'gte': 59.0, 'lte': 61.0}}})
+        self.assertAlmostEqual(ra_range['range']['ra']['lte'] - 100.0, 2.0, places=3)
+
+    def test_cone_search_filters_across_meridian(self):
+        _, ra_range = cone_search_filters(0.1, 10.0, 0.2)
+        lower, upper = ra_range['bool']['should']
+        self.assertAlmostEqual(lower['range']['ra']['gte'], 359.897, places=3)
+        self.assertAlmostEqual(upper['range']['ra']['lte'], 0.303, places=3)
+
+    def test_cone_search_filters_around_pole(self):
+        self.assertEqual(cone_search_filters(10.0, 89.9, 0.2), [{'range': {'dec': {'gte': 89.7, 'lte': 90.0}}}])
+
+    def test_build_query_uses_server_side_cone(self):
+        query = ANTARESBroker().build_query({'ra': 0.0, 'dec': -30.0, 'sr': 0.5})
+        self.assertEqual(
+            query['query']['bool']['filter'],
+            [{'sky_distance': {'distance': '0.5 degree', 'htm16': {'center': '0.0 -30.0'}}}]
+        )
+
+    def test_build_query_without_cone(self):
+        query = ANTARESBroker().build_query({'tag': ['in_m31']})
+        self.assertEqual(query['query']['bool']['filter'], [{'terms': {'tags': ['in_m31']}}])
+
+    @override_settings(BROKERS={'ANTARES': {'cone_search_method': 'box'}})
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_fetch_alerts_box_cone_across_meridian(self, mock_client):
+        mock_client.search.search.side_effect = lambda query: iter(self.loci)
+        alerts = ANTARESBroker().fetch_alerts({'ra': 0.0, 'dec': 10.0, 'sr': 0.1, 'max_alerts': 10})
+        self.assertEqual([(a['ra'], a['dec']) for a in alerts], [(359.95, 10.0), (0.05, 10.0)])
+
+    @override_settings(BROKERS={'ANTARES': {'cone_search_method': 'box'}})
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_fetch_alerts_box_cone_around_pole(self, mock_client):
+        mock_client.search.search.side_effect = lambda query: iter(self.loci)
+        alerts = ANTARESBroker().fetch_alerts({'ra': 100.0, 'dec': 90.0, 'sr': 0.1, 'max_alerts': 10})
+        self.assertEqual([(a['ra'], a['dec']) for a in alerts], [(10.0, 89.95), (190.0, 89.95)])
+
+    @mock.patch('tom_antares.antares.get_available_tags', return_value=['in_m31'])
+    def test_form_without_cone(self, mock_tags):
+        form = ANTARESBrokerForm({'query_name': 'test', 'broker': 'ANTARES', 'last_day': True, 'max_alerts': 20})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertIsNone(form.cleaned_data['ra'])
+        self.assertIsNone(form.cleaned_data['sr'])
+
+    @mock.patch('tom_antares.antares.get_available_tags', return_value=['in_m31'])
+    def test_form_accepts_zero_ra_and_negative_dec(self, mock_tags):
+        form = ANTARESBrokerForm({'query_name': 'test', 'broker': 'ANTARES', 'last_day': True, 'max_alerts': 20,
+                                  'ra': 0.0, 'dec': -45.0, 'sr': 1.0})
+        self.assertTrue(form.is_valid(), form.errors)
+
+
+class TestBulkTargetIngestion(TestCase):
+
+    def setUp(self):
+        self.alerts = [ANTARESBroker.alert_to_dict(LocusFactory.create()) for i in range(0, 10)]
+
+    def test_to_targets_creates_targets_and_aliases(self):
+        self.alerts[0]['properties']['horizons_targetname'] = 'test targetname'
+        results = ANTARESBroker().to_targets(self.alerts)
+
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(created for _, created in results))
+        self.assertEqual(Target.objects.count(), 10)
+        self.assertEqual(TargetName.objects.count(), 11)
+        target = results[0][0]
+        self.assertEqual(target.name, self.alerts[0]['properties']['ztf_object_id'])
+        self.assertEqual(
+            set(target.aliases.values_list('name', flat=True)),
+            {self.alerts[0]['locus_id'], 'test targetname'}
+        )
+
+    def test_to_targets_matches_existing_targets(self):
+        by_name = Target.objects.create(name=self.alerts[0]['properties']['ztf_object_id'])
+        by_alias = Target.objects.create(name='existing target')
+        TargetName.objects.create(target=by_alias, name=self.alerts[1]['locus_id'])
+        duplicate = dict(self.alerts[2])
+
+        results = ANTARESBroker().to_targets(self.alerts + [duplicate])
+
+        self.assertEqual(results[0], (by_name, False))
+        self.assertEqual(results[1], (by_alias, False))
+        self.assertTrue(results[2][1])
+        self.assertEqual(results[-1], (results[2][0], False))
+        self.assertEqual(Target.objects.count(), 10)
+        # Matched targets gain whichever of the alert's names they were missing
+        self.assertTrue(by_name.aliases.filter(name=self.alerts[0]['locus_id']).exists())
+        self.assertTrue(by_alias.aliases.filter(name=self.alerts[1]['properties']['ztf_object_id']).exists())
+
+    def test_to_targets_query_count_is_constant(self):
+        alerts = [ANTARESBroker.alert_to_dict(LocusFactory.create()) for i in range(0, 200)]
+        with CaptureQueriesContext(connection) as context:
+            ANTARESBroker().to_targets(alerts)
+        selects = [query for query in context.captured_queries if query['sql'].startswith('SELECT')]
+
+        self.assertEqual(len(selects), 2)
+        # Inserts are batched, although SQLite limits how many rows fit in each statement
+        self.assertLess(len(context.captured_queries), len(alerts) / 10)
+
+
+class TestProcessReducedData(TestCase):
+
+    def setUp(self):
+        self.target = Target.objects.create(name='ZTF20achooum')
+        self.detection = AlertFactory.create(alert_id='ztf_candidate:1375506740015015002', mjd=59134.0)
+        self.detection.properties.update({'ztf_fid': 2, 'ztf_magpsf': 18.6, 'ztf_sigmapsf': 0.1})
+        self.upper_limit = AlertFactory.create(alert_id='ztf_upper_limit:ZTF20achooum-1372493490015', mjd=59133.5)
+        self.upper_limit.properties.update({'ztf_fid': 1, 'ztf_diffmaglim': 19.3})
+        self.locus = LocusFactory.create(alerts=[self.detection, self.upper_limit])
+
+    def test_process_reduced_data(self):
+        ANTARESBroker().process_reduced_data(self.target, ANTARESBroker.alert_to_dict(self.locus))
+
+        detection = ReducedDatum.objects.get(source_location=self.detection.alert_id)
+        self.assertEqual(detection.target, self.target)
+        self.assertEqual(detection.data_type, 'photometry')
+        self.assertEqual(detection.timestamp, datetime(2020, 10, 12, tzinfo=timezone.utc))
+        self.assertEqual(detection.value, {'filter': 'r', 'telescope': 'ZTF', 'magnitude': 18.6, 'error': 0.1})
+        upper_limit = ReducedDatum.objects.get(source_location=self.upper_limit.alert_id)
+        self.assertEqual(upper_limit.value, {'filter': 'g', 'telescope': 'ZTF', 'limit': 19.3})
+
+    def test_process_reduced_data_skips_existing(self):
+        alert = ANTARESBroker.alert_to_dict(self.locus)
+        ANTARESBroker().process_reduced_data(self.target, alert)
+        with self.assertNumQueries(1):
+            created = ANTARESBroker().process_reduced_data(self.target, alert)
+
+        self.assertEqual(created, [])
+        self.assertEqual(ReducedDatum.objects.count(), 2)
+
+    def test_process_reduced_data_query_count_is_constant(self):
+        alerts = [AlertFactory.create() for i in range(0, 2000)]
+        alert = ANTARESBroker.alert_to_dict(LocusFactory.create(alerts=alerts))
+        with CaptureQueriesContext(connection) as context:
+            created = ANTARESBroker().process_reduced_data(self.target, alert)
+
+        self.assertEqual(len(created), 2000)
+        # Inserts are batched, although SQLite limits how many rows fit in each statement
+        self.assertLess(len(context.captured_queries), len(alerts) / 50)
+
+
+class TestCompactAlerts(TestCase):
+
+    def setUp(self):
+        self.locus = LocusFactory.create()
+        self.locus.properties.update({'newest_alert_observation_time': 59134, 'newest_alert_magnitude': 18.6,
+                                      'num_alerts': 5})
+        self.locus.alerts[-1].properties['ztf_rb'] = 0.8
+        self.locus.alerts[-1].properties['ztf_programpi'] = 'Kulkarni'
+        self.full = ANTARESBroker.alert_to_dict(self.locus)
+        self.compact = ANTARESBroker.alert_to_dict(self.locus, compact=True)
+
+    def test_compact_alert_to_dict(self):
+        self.assertNotIn('num_alerts', self.compact['properties'])
+        self.assertNotIn('catalogs', self.compact)
+        self.assertEqual(self.compact['alerts']['mjd'].tolist(), [alert.mjd for alert in self.locus.alerts])
+        self.assertEqual(self.compact['alerts']['properties']['ztf_rb'][-1], 0.8)
+        self.assertNotIn('ztf_programpi', self.compact['alerts']['properties'])
+
+    @override_settings(BROKERS={'ANTARES': {'compact_properties': ['num_alerts'],
+                                            'compact_alert_properties': ['ztf_pid']}})
+    def test_compact_alert_to_dict_whitelist(self):
+        compact = ANTARESBroker.alert_to_dict(self.locus, compact=True)
+        self.assertEqual(compact['properties']['num_alerts'], 5)
+        self.assertIn('ztf_pid', compact['alerts']['properties'])
+
+    def test_compact_locus_alerts(self):
+        expanded = locus_alerts(self.compact)
+        self.assertEqual([alert['alert_id'] for alert in expanded], [alert.alert_id for alert in self.locus.alerts])
+        self.assertEqual(expanded[-1]['properties']['ztf_rb'], 0.8)
+        self.assertNotIn('ztf_rb', expanded[0]['properties'])
+
+    def test_compact_alert_conversions_match_full(self):
+        broker = ANTARESBroker()
+        self.assertEqual(broker.to_generic_alert(self.compact), broker.to_generic_alert(self.full))
+        self.assertEqual(broker.to_generic_alerts([self.compact]), broker.to_generic_alerts([self.full]))
+
+        target = Target.objects.create(name='ZTF20achooum')
+        created = broker.process_reduced_data(target, self.compact)
+        self.assertEqual(len(created), len(self.locus.alerts))
+        self.assertEqual(broker.process_reduced_data(target, self.full), [])
+
+    @mock.patch('tom_antares.antares.get_by_id')
+    def test_expand_alert(self, mock_get_by_id):
+        locus_cache.clear()
+        mock_get_by_id.return_value = self.locus
+        self.assertEqual(ANTARESBroker().expand_alert(self.compact), self.full)
+        mock_get_by_id.assert_called_once_with(self.locus.locus_id)
+
+
+class TestLocusCache(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.loci = [LocusFactory.create() for i in range(0, 3)]
+        self.locus_cache = LocusCache(maxsize=2, ttl=60, negative_ttl=10, backend='local', clock=lambda: self.now)
+
+    def lookup(self, locus):
+        return self.locus_cache.get(LocusCache.key(locus_id=locus.locus_id), lambda: locus)
+
+    def test_get_caches_lookups(self):
+        fetch = mock.Mock(return_value=self.loci[0])
+        for _ in range(3):
+            self.assertEqual(self.locus_cache.get('locus:a', fetch), self.loci[0])
+        fetch.assert_called_once()
+        self.assertEqual(self.locus_cache.stats()['hit_rate'], 2 / 3)
+
+        self.now += 61
+        self.locus_cache.get('locus:a', fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_get_caches_misses(self):
+        fetch = mock.Mock(side_effect=AntaresException('not found'))
+        self.assertIsNone(self.locus_cache.get('locus:a', fetch))
+        self.assertIsNone(self.locus_cache.get('locus:a', fetch))
+        fetch.assert_called_once()
+
+        self.now += 11
+        self.locus_cache.get('locus:a', fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_get_evicts_least_recently_used(self):
+        self.lookup(self.loci[0])
+        self.lookup(self.loci[1])
+        self.lookup(self.loci[0])
+        self.lookup(self.loci[2])
+
+        self.assertEqual(self.locus_cache.stats()['evictions'], 1)
+        fetch = mock.Mock(return_value=self.loci[1])
+        self.locus_cache.get(LocusCache.key(locus_id=self.loci[1].locus_id), fetch)
+        fetch.assert_called_once()
+
+    def test_invalidate(self):
+        locus = self.loci[0]
+        ztf_object_id = locus.properties['ztf_object_id']
+        self.lookup(locus)
+        self.locus_cache.get(LocusCache.key(ztf_object_id=ztf_object_id), lambda: locus)
+
+        self.locus_cache.invalidate(ztf_object_id=ztf_object_id)
+
+        self.assertEqual(self.locus_cache.stats()['size'], 0)
+
+    def test_django_backend_is_shared(self):
+        self.locus_cache._backend = 'django'
+        self.lookup(self.loci[0])
+        other_cache = LocusCache(ttl=60, backend='django', clock=lambda: self.now)
+        fetch = mock.Mock()
+
+        self.assertEqual(other_cache.get(LocusCache.key(locus_id=self.loci[0].locus_id), fetch).locus_id,
+                         self.loci[0].locus_id)
+        fetch.assert_not_called()
+        self.locus_cache.invalidate(locus_id=self.loci[0].locus_id)
+
+    @mock.patch('tom_antares.antares.get_by_id')
+    def test_fetch_locus_uses_cache(self, mock_get_by_id):
+        locus_cache.clear()
+        mock_get_by_id.return_value = self.loci[0]
+        broker = ANTARESBroker()
+        broker.fetch_locus(self.loci[0].locus_id)
+        alerts = list(broker.fetch_alerts({'antid': self.loci[0].locus_id}))
+
+        self.assertEqual(alerts, [ANTARESBroker.alert_to_dict(self.loci[0])])
+        mock_get_by_id.assert_called_once_with(self.loci[0].locus_id)
+        locus_cache.clear()
+
+
+class TestBatchLookup(TestCase):
+
+    def setUp(self):
+        locus_cache.clear()
+        self.loci = [LocusFactory.create() for i in range(0, 5)]
+        self.loci_by_id = {locus.locus_id: locus for locus in self.loci}
+
+    def tearDown(self):
+        locus_cache.clear()
+
+    def get_by_id(self, locus_id):
+        if locus_id == 'slow':
+            time.sleep(1)
+        if locus_id == 'error':
+            raise ConnectionError('ANTARES unavailable')
+        return self.loci_by_id.get(locus_id)
+
+    @mock.patch('tom_antares.antares.get_by_id')
+    def test_fetch_loci(self, mock_get_by_id):
+        mock_get_by_id.side_effect = self.get_by_id
+        ids = [self.loci[2].locus_id, 'missing', 'error', 'slow', self.loci[0].locus_id]
+
+        results = ANTARESBroker().fetch_loci(ids, max_workers=4, timeout=0.2)
+
+        self.assertEqual([result.id for result in results], ids)
+        self.assertEqual(results[0].locus, self.loci[2])
+        self.assertEqual(results[1].error, 'Not found')
+        self.assertIsInstance(results[2].error, ConnectionError)
+        self.assertIsInstance(results[3].error, TimeoutError)
+        self.assertEqual(results[4].locus, self.loci[0])
+
+    @mock.patch('tom_antares.antares.ZTF_ID_CHUNK_SIZE', 2)
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_fetch_loci_by_ztf_object_id(self, mock_client):
+        def search(query):
+            ztf_object_ids = query['query']['bool']['filter']['terms']['properties.ztf_object_id']
+            return iter([locus for locus in self.loci if locus.properties['ztf_object_id'] in ztf_object_ids])
+
+        mock_client.search.search.side_effect = search
+        ids = [locus.properties['ztf_object_id'] for locus in reversed(self.loci)] + ['missing']
+
+        results = ANTARESBroker().fetch_loci_by_ztf_object_id(ids)
+
+        self.assertEqual(mock_client.search.search.call_count, 3)
+        self.assertEqual([result.locus for result in results], list(reversed(self.loci)) + [None])
+        self.assertEqual(results[-1].error, 'Not found')
+
+    @mock.patch('tom_antares.antares.get_by_id')
+    def test_fetch_alerts_with_several_locus_ids(self, mock_get_by_id):
+        mock_get_by_id.side_effect = self.get_by_id
+        antid = f'{self.loci[1].locus_id}, missing {self.loci[3].locus_id}'
+
+        alerts = list(ANTARESBroker().fetch_alerts({'antid': antid, 'max_alerts': 20}))
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], [self.loci[1].locus_id, self.loci[3].locus_id])
+
+    @override_settings(BROKERS={'ANTARES': {'lookup_max_workers': 20, 'http_max_connections': 20}})
+    def test_alerts_are_loaded_concurrently(self):
+        """Test that the alerts of many loci looked up by id are fetched on the pool, not one at a time."""
+        loci = [LocusFactory.create() for i in range(0, 20)]
+        latency = 0.1
+        with ANTARESStandInServer(loci, latency=latency) as server:
+            for parameters in [
+                {'antid': ' '.join(locus.locus_id for locus in loci)},
+                {'ztfid': ' '.join(locus.properties['ztf_object_id'] for locus in loci)},
+            ]:
+                locus_cache.clear()
+                start = time.perf_counter()
+                alerts = list(ANTARESBroker().fetch_alerts({**parameters, 'max_alerts': 20}))
+                elapsed = time.perf_counter() - start
+
+                self.assertEqual([alert['locus_id'] for alert in alerts], [locus.locus_id for locus in loci])
+                self.assertEqual(alerts, [ANTARESBroker.alert_to_dict(locus) for locus in loci])
+                # A round trip for the loci and one for their alerts, rather than one per locus
+                self.assertLess(elapsed, 5 * latency)
+        self.assertEqual(server.requests['alerts'], 40)
+
+
+class TestQueryPolling(TestCase):
+
+    def setUp(self):
+        self.query = BrokerQuery.objects.create(
+            name='m31', broker='ANTARES', parameters={'tag': ['in_m31'], 'max_alerts': 20}
+        )
+        self.loci = [LocusFactory.create() for i in range(0, 4)]
+        for locus, observation_time in zip(self.loci, [59003, 59002, 59002, 59001]):
+            locus.properties['newest_alert_observation_time'] = observation_time
+        self.results = self.loci[1:]
+
+    def search(self, query):
+        self.queries.append(query)
+        return iter(self.results)
+
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_poll_query(self, mock_client):
+        self.queries = []
+        mock_client.search.search.side_effect = self.search
+
+        first_poll = ANTARESBroker().poll_query(self.query)
+        self.assertEqual([alert['locus_id'] for alert in first_poll], [locus.locus_id for locus in self.loci[1:]])
+        watermark = QueryWatermark.objects.get(query=self.query)
+        self.assertEqual(watermark.newest_alert_observation_time, 59002)
+        self.assertEqual(set(watermark.locus_ids), {self.loci[1].locus_id, self.loci[2].locus_id})
+
+        # ANTARES returns everything at or after the watermark: a new locus and the two already seen
+        self.results = self.loci[:3]
+        second_poll = ANTARESBroker().poll_query(self.query)
+        self.assertEqual([alert['locus_id'] for alert in second_poll], [self.loci[0].locus_id])
+        self.assertEqual(
+            self.queries[-1]['query']['bool']['filter'][1],
+            {'range': {'properties.newest_alert_observation_time': {'gte': 59002}}}
+        )
+        watermark.refresh_from_db()
+        self.assertEqual(watermark.newest_alert_observation_time, 59003)
+        self.assertEqual(watermark.locus_ids, [self.loci[0].locus_id])
+
+        self.results = self.loci[:1]
+        self.assertEqual(ANTARESBroker().poll_query(self.query), [])
+
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_poll_query_concurrently(self, mock_client):
+        self.queries = []
+        mock_client.search.search.side_effect = self.search
+        watermark = QueryWatermark.objects.create(query=self.query, newest_alert_observation_time=59000)
+
+        def concurrent_poll(query):
+            QueryWatermark.objects.filter(pk=watermark.pk).update(modified=datetime.now(tz=timezone.utc))
+            return self.search(query)
+
+        mock_client.search.search.side_effect = concurrent_poll
+        self.assertEqual(ANTARESBroker().poll_query(self.query), [])
+
+    def test_merge_alerts(self):
+        previous = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci[1:]]
+        self.loci[3].properties['newest_alert_observation_time'] = 59004
+        updates = [ANTARESBroker.alert_to_dict(self.loci[3])]
+
+        merged = merge_alerts(previous, updates)
+
+        self.assertEqual([alert['locus_id'] for alert in merged],
+                         [self.loci[3].locus_id, self.loci[1].locus_id, self.loci[2].locus_id])
+
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_poll_query_merges_previous_results(self, mock_client):
+        self.queries = []
+        mock_client.search.search.side_effect = self.search
+        previous = ANTARESBroker().poll_query(self.query)
+
+        # The oldest locus has a new alert, and a new locus appears
+        self.loci[3].properties['newest_alert_observation_time'] = 59004
+        self.results = [self.loci[3], self.loci[0]]
+        merged = ANTARESBroker().poll_query(self.query, previous=previous)
+
+        self.assertEqual([alert['locus_id'] for alert in merged], [
+            self.loci[3].locus_id, self.loci[0].locus_id, self.loci[1].locus_id, self.loci[2].locus_id
+        ])
+        self.results = []
+        self.assertEqual(ANTARESBroker().poll_query(self.query, previous=merged), merged)
+
+    def test_first_polls_race_to_create_the_watermark(self):
+        get = QueryWatermark.objects.get
+
+        def get_concurrently(**kwargs):
+            # Another poller creates the watermark between this one's get and create
+            if not QueryWatermark.objects.filter(**kwargs).exists():
+                QueryWatermark.objects.create(**kwargs)
+                raise QueryWatermark.DoesNotExist
+            return get(**kwargs)
+
+        with mock.patch.object(QueryWatermark.objects, 'get', side_effect=get_concurrently):
+            watermark = ANTARESBroker.query_watermark(self.query)
+
+        self.assertEqual(watermark, QueryWatermark.objects.get(query=self.query))
+
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_pollantaresqueries(self, mock_client):
+        self.queries = []
+        mock_client.search.search.side_effect = self.search
+
+        call_command('pollantaresqueries', stdout=mock.MagicMock())
+        self.assertEqual(Target.objects.count(), 3)
+        self.assertEqual(ReducedDatum.objects.count(), 15)
+
+        call_command('pollantaresqueries', 'm31', stdout=mock.MagicMock())
+        self.assertEqual(Target.objects.count(), 3)
+
+
+class FakeStreamingClient:
+    """An in-process stand-in for antares_client.StreamingClient."""
+
+    def __init__(self, messages, clock=None):
+        self.messages = list(messages)
+        self.clock = clock
+        self.delivered = 0
+        self.committed = 0
+        self.closed = False
+
+    def poll(self, timeout=None):
+        if not self.messages:
+            if self.clock:
+                self.clock.now += timeout
+            return None, None
+        self.delivered += 1
+        return self.messages.pop(0)
+
+    def commit(self):
+        self.committed = self.delivered
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStreamConsumer(TestCase):
+
+    def setUp(self):
+        self.loci = [LocusFactory.create() for i in range(0, 5)]
+        self.messages = [('in_m31', locus) for locus in self.loci]
+        self.clock = FakeClock()
+
+    def test_batches_by_size(self):
+        client = FakeStreamingClient(self.messages)
+        consumer = StreamConsumer(client, batch_size=2, batch_timeout=10, clock=self.clock)
+        with mock.patch.object(ANTARESBroker, 'ingest_alerts', return_value=[]) as mock_ingest:
+            consumer.run(max_batches=2)
+
+        self.assertEqual([len(call.args[0]) for call in mock_ingest.call_args_list], [2, 2])
+        self.assertEqual(client.committed, 4)
+        self.assertTrue(client.closed)
+
+    def test_batches_by_timeout(self):
+        client = FakeStreamingClient(self.messages[:3], clock=self.clock)
+        consumer = StreamConsumer(client, batch_size=100, batch_timeout=5, clock=self.clock)
+        with mock.patch.object(ANTARESBroker, 'ingest_alerts', return_value=[]) as mock_ingest:
+            consumer.run(max_batches=1)
+
+        self.assertEqual(len(mock_ingest.call_args.args[0]), 3)
+        self.assertEqual(client.committed, 3)
+        self.assertEqual(self.clock.now, 5)
+
+    def test_saves_targets_and_photometry(self):
+        client = FakeStreamingClient(self.messages)
+        StreamConsumer(client, batch_size=5, clock=self.clock).run(max_batches=1)
+
+        self.assertEqual(Target.objects.count(), 5)
+        self.assertEqual(ReducedDatum.objects.count(), 25)
+        self.assertEqual(client.committed, 5)
+
+    def test_skips_loci_that_cannot_be_saved(self):
+        del self.loci[2].properties['ztf_object_id']
+        client = FakeStreamingClient(self.messages)
+        consumer = StreamConsumer(client, batch_size=5, clock=self.clock)
+        with self.assertLogs('tom_antares.stream', level='ERROR'):
+            consumer.run(max_batches=1)
+
+        self.assertEqual(Target.objects.count(), 4)
+        self.assertFalse(Target.objects.filter(name=self.loci[2].locus_id).exists())
+        self.assertEqual(client.committed, 5)
+        ((topic, locus, error),) = consumer.dead_letters
+        self.assertIs(locus, self.loci[2])
+        self.assertIsInstance(error, KeyError)
+
+    def test_retries_before_committing(self):
+        client = FakeStreamingClient(self.messages[:2])
+        sleep = mock.MagicMock()
+        consumer = StreamConsumer(client, batch_size=2, clock=self.clock, sleep=sleep)
+        attempts = []
+
+        def ingest_alerts(alerts):
+            attempts.append(client.committed)
+            if len(attempts) < 3:
+                raise OperationalError('database is locked')
+            return []
+
+        with mock.patch.object(ANTARESBroker, 'ingest_alerts', side_effect=ingest_alerts):
+            consumer.run(max_batches=1)
+
+        self.assertEqual(attempts, [0, 0, 0])
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1.0, 2.0])
+        self.assertEqual(client.committed, 2)
+
+    def test_stop_saves_current_batch(self):
+        client = FakeStreamingClient(self.messages)
+        consumer = StreamConsumer(client, batch_size=100, clock=self.clock)
+        poll = client.poll
+
+        def poll_then_stop(timeout=None):
+            message = poll(timeout)
+            if client.delivered == 3:
+                consumer.stop()
+            return message
+
+        client.poll = poll_then_stop
+        with mock.patch.object(ANTARESBroker, 'ingest_alerts', return_value=[]) as mock_ingest:
+            consumer.run()
+
+        self.assertEqual(len(mock_ingest.call_args.args[0]), 3)
+        self.assertEqual(client.committed, 3)
+        self.assertTrue(client.closed)
+
+
+class TestQueryCache(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.query_cache = QueryCache(backend='local', ttl=60, maxsize=2, clock=lambda: self.now)
+        self.loci = [LocusFactory.create() for i in range(0, 3)]
+        query_cache.clear()
+
+    def tearDown(self):
+        query_cache.clear()
+
+    def test_key_is_canonical(self):
+        query = {'query': {'bool': {'filter': [{'terms': {'tags': ['in_m31', 'young']}}, {'range': {'x': {}}}]}}}
+        reordered = {'query': {'bool': {'filter': [{'terms': {'tags': ['young', 'in_m31']}}, {'range': {'x': {}}}]}}}
+        self.assertEqual(QueryCache.key(query, max_alerts=20), QueryCache.key(reordered, max_alerts=20))
+        self.assertNotEqual(QueryCache.key(query, max_alerts=20), QueryCache.key(query, max_alerts=10))
+
+    def test_entries_expire(self):
+        self.query_cache.set('a', [1])
+        self.assertEqual(self.query_cache.get('a'), [1])
+        self.now += 60
+        self.assertIsNone(self.query_cache.get('a'))
+        self.assertEqual(self.query_cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.query_cache.set('a', [1])
+        self.query_cache.set('b', [2])
+        self.query_cache.get('a')
+        self.query_cache.set('c', [3])
+        self.assertIsNone(self.query_cache.get('b'))
+        self.assertEqual(self.query_cache.get('a'), [1])
+        self.assertEqual(self.query_cache.stats()['evictions'], 1)
+
+    def test_disk_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = DiskQueryStore(maxsize=2, path=path)
+            for i, key in enumerate(['a', 'b', 'c']):
+                store.set(key, (self.now + 60, [i]), 60)
+                time.sleep(0.01)
+            self.assertEqual(len(store), 2)
+            self.assertIsNone(store.get('a'))
+            self.assertEqual(DiskQueryStore(maxsize=2, path=path).get('c'), (self.now + 60, [2]))
+
+    def test_disk_store_requires_a_private_directory(self):
+        with self.assertRaises(ImproperlyConfigured):
+            DiskQueryStore(maxsize=2)
+
+        with tempfile.TemporaryDirectory() as path:
+            store_path = os.path.join(path, 'queries')
+            DiskQueryStore(maxsize=2, path=store_path)
+            self.assertEqual(os.stat(store_path).st_mode & 0o777, 0o700)
+
+            os.chmod(store_path, 0o777)
+            with self.assertRaises(ImproperlyConfigured):
+                DiskQueryStore(maxsize=2, path=store_path)
+
+            os.chmod(store_path, 0o700)
+            with mock.patch('os.getuid', return_value=os.getuid() + 1):
+                with self.assertRaises(ImproperlyConfigured):
+                    DiskQueryStore(maxsize=2, path=store_path)
+
+    @override_settings(BROKERS={'ANTARES': {'query_cache_backend': 'local'}})
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_fetch_alerts_uses_cache(self, mock_client):
+        mock_client.search.search.side_effect = lambda query: iter(self.loci)
+        parameters = {'tag': ['in_m31'], 'max_alerts': 20}
+
+        alerts = list(ANTARESBroker().fetch_alerts(parameters))
+        alerts[0]['properties']['ztf_object_id'] = 'modified'
+        cached = list(ANTARESBroker().fetch_alerts(parameters))
+
+        self.assertEqual(mock_client.search.search.call_count, 1)
+        self.assertEqual([alert['locus_id'] for alert in cached], [locus.locus_id for locus in self.loci])
+        self.assertNotEqual(cached[0]['properties']['ztf_object_id'], 'modified')
+
+        list(ANTARESBroker().fetch_alerts({**parameters, 'max_alerts': 2}))
+        self.assertEqual(mock_client.search.search.call_count, 2)
+
+    @override_settings(BROKERS={'ANTARES': {'query_cache_backend': 'local'}})
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_partial_results_are_not_cached(self, mock_client):
+        mock_client.search.search.side_effect = lambda query: iter(self.loci)
+        parameters = {'tag': ['in_m31'], 'max_alerts': 20}
+
+        next(ANTARESBroker().fetch_alerts(parameters))
+        list(ANTARESBroker().fetch_alerts(parameters))
+        list(ANTARESBroker().fetch_alerts({**parameters, 'newest_alert_observation_time__gte': 59000}))
+        list(ANTARESBroker().fetch_alerts({**parameters, 'newest_alert_observation_time__gte': 59000}))
+
+        self.assertEqual(mock_client.search.search.call_count, 4)
+
+    @override_settings(BROKERS={'ANTARES': {'query_cache_backend': 'local', 'query_cache_max_results': 2}})
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_large_and_unbounded_results_are_not_cached(self, mock_client):
+        mock_client.search.search.side_effect = lambda query: iter(self.loci)
+
+        for parameters in [{'tag': ['in_m31'], 'max_alerts': 20}, {'tag': ['in_m31'], 'max_alerts': float('inf')}]:
+            list(ANTARESBroker().fetch_alerts(parameters))
+            list(ANTARESBroker().fetch_alerts(parameters))
+        list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 2}, use_query_cache=False))
+
+        self.assertEqual(mock_client.search.search.call_count, 5)
+        self.assertEqual(len(query_cache.store), 0)
+
+    @override_settings(BROKERS={'ANTARES': {'query_cache_backend': 'local'}})
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_key_depends_on_features(self, mock_client):
+        mock_client.search.search.side_effect = lambda query: iter(self.loci)
+        parameters = {'tag': ['in_m31'], 'max_alerts': 20}
+
+        self.assertNotIn('features', next(ANTARESBroker().fetch_alerts(parameters)))
+        list(ANTARESBroker().fetch_alerts(parameters))
+        with override_settings(BROKERS={'ANTARES': {'query_cache_backend': 'local', 'lightcurve_features': True}}):
+            self.assertIn('features', list(ANTARESBroker().fetch_alerts(parameters))[0])
+
+    def test_last_day_is_bucketed(self):
+        parameters = {'last_day': True}
+        with mock.patch('tom_antares.antares.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2024, 1, 1, 12, 1, tzinfo=timezone.utc)
+            first = ANTARESBroker().build_query(parameters)
+            mock_datetime.now.return_value = datetime(2024, 1, 1, 12, 4, tzinfo=timezone.utc)
+            second = ANTARESBroker().build_query(parameters)
+        self.assertEqual(first, second)
+        window = first['query']['bool']['filter'][0]['range']['properties.newest_alert_observation_time']
+        self.assertAlmostEqual(window['lte'], Time(datetime(2024, 1, 1, 12, 5, tzinfo=timezone.utc)).mjd)
+        self.assertAlmostEqual(window['lte'] - window['gte'], 1.0)
+
+
+class TestStandInServer(TestCase):
+    """Exercises the broker and antares_client end to end against a local ANTARES stand-in."""
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31'] if i % 2 else []) for i in range(0, 250)]
+        for i, locus in enumerate(self.loci):
+            locus.properties['newest_alert_observation_time'] = 59000 + i
+        self.newest_tagged = [locus.locus_id for locus in reversed(self.loci) if 'in_m31' in locus.tags]
+        locus_cache.clear()
+        tag_cache.clear()
+
+    def tearDown(self):
+        locus_cache.clear()
+        tag_cache.clear()
+
+    def test_fetch_alerts(self):
+        with ANTARESStandInServer(self.loci, page_size=50) as server:
+            alerts = list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 60}))
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], self.newest_tagged[:60])
+        self.assertEqual(len(alerts[0]['alerts']), 5)
+        # Pages are only requested as they are needed; each locus's alerts are a further request
+        self.assertEqual(server.requests['search'], 2)
+        self.assertEqual(server.requests['alerts'], 60)
+
+    def test_lookups(self):
+        with ANTARESStandInServer(self.loci) as server:
+            locus = ANTARESBroker().fetch_locus(self.loci[3].locus_id)
+            missing = ANTARESBroker().fetch_locus('ANT2020missing')
+            by_ztf_id = ANTARESBroker().fetch_alert(self.loci[4].properties['ztf_object_id'])
+            tags = get_tag_choices()
+
+        self.assertEqual(locus.properties, self.loci[3].properties)
+        self.assertIsNone(missing)
+        self.assertEqual(by_ztf_id.locus_id, self.loci[4].locus_id)
+        self.assertEqual(tags, [('in_m31', 'in_m31')])
+        self.assertEqual(server.requests['not_found'], 1)
+
+    def test_record_and_replay(self):
+        parameters = {'tag': ['in_m31'], 'max_alerts': 10}
+        with tempfile.TemporaryDirectory() as path:
+            cassette_path = f'{path}/in_m31.json'
+            with ANTARESStandInServer(self.loci, page_size=5):
+                with Cassette(cassette_path) as cassette:
+                    recorded = list(ANTARESBroker().fetch_alerts(parameters))
+            self.assertEqual(cassette.mode, 'record')
+
+            sleep = mock.MagicMock()
+            with Cassette(cassette_path, latency=0.25, sleep=sleep) as cassette:
+                replayed = list(ANTARESBroker().fetch_alerts(parameters))
+                with self.assertRaises(CassetteMiss):
+                    ANTARESBroker().fetch_locus('ANT2020missing')
+
+        self.assertEqual(cassette.mode, 'replay')
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(cassette.played, len(cassette.interactions))
+        self.assertEqual(sleep.call_args_list, [mock.call(0.25)] * cassette.played)
+
+    def test_cassette_routes_antares_client(self):
+        from antares_client._api import api
+        with tempfile.TemporaryDirectory() as path:
+            cassette_path = f'{path}/tags.json'
+            with ANTARESStandInServer(self.loci):
+                with Cassette(cassette_path):
+                    recorded = get_available_tags()
+            # As when antares_client is first imported, and so routed, inside the cassette
+            with mock.patch.object(api, 'requests', requests):
+                with Cassette(cassette_path) as cassette:
+                    route_antares_client()
+                    self.assertEqual(get_available_tags(), recorded)
+
+        self.assertEqual(cassette.played, 1)
+
+
+observations = []
+
+
+def record_observation(kind, name, value, labels):
+    observations.append((kind, name, value, labels))
+
+
+@override_settings(BROKERS={'ANTARES': {'metrics_sinks': ['prometheus', 'tom_antares.tests.tests.record_observation']}})
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31']) for i in range(0, 30)]
+        metrics.reset()
+        observations.clear()
+        locus_cache.clear()
+
+    def tearDown(self):
+        metrics.reset()
+        locus_cache.clear()
+
+    def counter(self, name, **labels):
+        return metrics.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return metrics.histograms.get((name, tuple(sorted(labels.items()))), {'count': 0})
+
+    def test_stages(self):
+        with ANTARESStandInServer(self.loci, page_size=10):
+            alerts = list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 25}))
+            ANTARESBroker().fetch_locus('ANT2020missing')
+        ANTARESBroker().to_generic_alerts(alerts)
+
+        self.assertEqual(self.counter('tom_antares_pages_total'), 3)
+        self.assertEqual(self.counter('tom_antares_requests_total', endpoint='alerts'), 25)
+        self.assertEqual(self.counter('tom_antares_request_errors_total', endpoint='locus'), 1)
+        self.assertGreater(self.counter('tom_antares_response_bytes_total', endpoint='search'), 0)
+        self.assertEqual(self.counter('tom_antares_loci_total'), 25)
+        self.assertEqual(self.histogram('tom_antares_stage_seconds', stage='deserialize')['count'], 25)
+        self.assertEqual(self.histogram('tom_antares_stage_seconds', stage='alert_to_dict')['count'], 25)
+        self.assertEqual(self.histogram('tom_antares_stage_seconds', stage='to_generic_alerts')['count'], 1)
+        self.assertIn(('counter', 'tom_antares_loci_total', 1, {}), observations)
+
+    @mock.patch('tom_antares.antares.antares_client')
+    def test_dropped_loci(self, mock_client):
+        def search(query):
+            yield self.loci[0]
+            raise marshmallow.exceptions.ValidationError('invalid')
+
+        mock_client.search.search.side_effect = search
+        self.assertEqual(len(list(ANTARESBroker().fetch_alerts({'tag': ['in_m31']}))), 1)
+        self.assertEqual(self.counter('tom_antares_dropped_loci_total', reason='invalid'), 1)
+
+    def test_prometheus_view(self):
+        metrics.increment('tom_antares_pages_total', 2)
+        metrics.observe('tom_antares_stage_seconds', 0.02, stage='tags')
+        response = prometheus_view(None)
+        lines = response.content.decode().splitlines()
+
+        self.assertIn('tom_antares_pages_total 2', lines)
+        self.assertIn('# TYPE tom_antares_stage_seconds histogram', lines)
+        self.assertIn('tom_antares_stage_seconds_bucket{stage="tags",le="0.01"} 0', lines)
+        self.assertIn('tom_antares_stage_seconds_bucket{stage="tags",le="0.05"} 1', lines)
+        self.assertIn('tom_antares_stage_seconds_count{stage="tags"} 1', lines)
+
+    @override_settings(BROKERS={'ANTARES': {}})
+    def test_disabled(self):
+        with ANTARESStandInServer(self.loci):
+            list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 5}))
+        self.assertEqual(metrics.counters, {})
+        self.assertEqual(metrics.histograms, {})
+        self.assertEqual(observations, [])
+
+
+class TestResilientSearch(TestCase):
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31']) for i in range(0, 30)]
+        for i, locus in enumerate(self.loci):
+            locus.properties['newest_alert_observation_time'] = 59030 - i
+        self.invalid_ids = [self.loci[3].locus_id, self.loci[12].locus_id]
+        self.server = ANTARESStandInServer(self.loci, page_size=10)
+        for locus_id in self.invalid_ids:
+            self.server.documents[locus_id]['attributes']['ra'] = 'invalid'
+        self.valid_ids = [locus.locus_id for locus in self.loci if locus.locus_id not in self.invalid_ids]
+        self.parameters = {'tag': ['in_m31'], 'max_alerts': 20}
+
+    def test_search_stops_at_invalid_locus(self):
+        broker = ANTARESBroker()
+        with self.server:
+            alerts = list(broker.fetch_alerts(self.parameters))
+        self.assertEqual(len(alerts), 0)
+        self.assertFalse(broker.search_report.complete)
+
+    @override_settings(BROKERS={'ANTARES': {'resilient_search': True}})
+    def test_resilient_search_skips_invalid_loci(self):
+        broker = ANTARESBroker()
+        with self.server:
+            alerts = list(broker.fetch_alerts(self.parameters))
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], self.valid_ids[:20])
+        self.assertEqual(broker.search_report.skipped_ids, self.invalid_ids)
+        self.assertEqual(broker.search_report.loci, 20)
+        self.assertEqual(broker.search_report.pages, 3)
+        self.assertTrue(broker.search_report.complete)
+
+    def test_retries_failed_pages(self):
+        sleep = mock.MagicMock()
+        with self.server:
+            loci = search_loci({'query': {}}, retries=0, sleep=sleep)
+            first_page = [next(loci) for i in range(0, 8)]
+            self.server.failures = 1
+            with self.assertRaises(AntaresException):
+                list(loci)
+
+            loci = search_loci({'query': {}}, retries=3, backoff=0.5, sleep=sleep)
+            first_page = [next(loci) for i in range(0, 8)]
+            self.server.failures = 2
+            rest = list(loci)
+
+        self.assertEqual([locus.locus_id for locus in first_page + rest], self.valid_ids)
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5), mock.call(1.0)])
+        # Only the failed page was requested again
+        self.assertEqual(self.server.requests['search'], 1 + 3)
+        self.assertEqual(self.server.requests['failed'], 1 + 2)
+
+    def test_client_errors_are_not_retried(self):
+        response = requests.Response()
+        response.status_code = 400
+        response._content = b'<html>Bad Request</html>'
+        sleep = mock.MagicMock()
+        with mock.patch.object(http_transport, 'get', return_value=response) as mock_get:
+            with self.assertRaisesRegex(AntaresException, 'HTTP 400 response from ANTARES is not JSON'):
+                list(search_loci({'query': {}}, retries=3, sleep=sleep))
+
+        self.assertEqual(mock_get.call_count, 1)
+        sleep.assert_not_called()
+
+        client = mock.MagicMock()
+        client.get = mock.AsyncMock(return_value=response)
+
+        async def search():
+            return [page async for page in asearch_pages({'query': {}}, client, retries=3)]
+
+        with self.assertRaises(AntaresException):
+            asyncio.run(search())
+        self.assertEqual(client.get.call_count, 1)
+
+
+class TestCountAndProjectedSearch(TestCase):
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31'] if i % 3 else ['young_extragalactic_candidate'])
+                     for i in range(0, 60)]
+        self.m31_loci = [locus for locus in self.loci if 'in_m31' in locus.tags]
+        self.server = ANTARESStandInServer(self.loci, page_size=10)
+        self.broker = ANTARESBroker()
+
+    def test_count_alerts_reads_count_from_one_request(self):
+        with self.server:
+            count = self.broker.count_alerts({'tag': ['in_m31'], 'max_alerts': 5})
+        self.assertEqual(count, len(self.m31_loci))
+        self.assertEqual(self.server.requests, {'search': 1})
+
+    def test_count_loci_without_reported_count(self):
+        search = self.server.search
+        self.server.search = lambda params: {**search(params), 'meta': {}}
+        with self.server:
+            count = count_loci({'query': {'bool': {'filter': [{'terms': {'tags': ['in_m31']}}]}}})
+        self.assertEqual(count, len(self.m31_loci))
+        self.assertEqual(self.server.requests, {'search': 2})
+
+    @override_settings(BROKERS={'ANTARES': {'cone_search_method': 'box'}})
+    def test_count_alerts_filters_box_cone_search(self):
+        positions = [(359.95, 10.0), (0.05, 10.0), (0.09, 10.09), (1.0, 10.0)]
+        server = ANTARESStandInServer([LocusFactory.create(ra=ra, dec=dec) for ra, dec in positions])
+        with server:
+            count = self.broker.count_alerts({'ra': 0.0, 'dec': 10.0, 'sr': 0.1})
+        # The third locus is in the corner of the box
+        self.assertEqual(count, 2)
+
+    def test_count_alerts_by_antares_id(self):
+        with self.server:
+            count = self.broker.count_alerts({'antid': f'{self.loci[0].locus_id}, ANT2020missing'})
+        self.assertEqual(count, 1)
+        self.assertEqual(self.server.requests['alerts'], 0)
+
+    def test_fetch_projected_skips_alert_history(self):
+        with self.server:
+            alerts = list(self.broker.fetch_projected({'tag': ['in_m31'], 'max_alerts': 25}))
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], [locus.locus_id for locus in self.m31_loci[:25]])
+        self.assertEqual(set(alerts[0]), {'locus_id', 'ra', 'dec', 'properties', 'tags', 'alerts'})
+        self.assertEqual(alerts[0]['alerts'], [])
+        self.assertEqual(
+            alerts[0]['properties']['ztf_object_id'], self.m31_loci[0].properties['ztf_object_id']
+        )
+        self.assertNotIn('brightest_alert_magnitude', alerts[0]['properties'])
+        self.assertEqual(self.server.requests, {'search': 1})
+        self.assertEqual(self.broker.search_report.loci, 25)
+
+    def test_fetch_projected_alerts_convert_to_targets(self):
+        with self.server:
+            alerts = list(self.broker.fetch_projected(
+                {'tag': ['in_m31'], 'max_alerts': 5}, properties=['ztf_object_id']
+            ))
+        generic_alerts = self.broker.to_generic_alerts(alerts)
+        self.broker.to_targets(alerts)
+
+        self.assertEqual([alert.score for alert in generic_alerts], [''] * 5)
+        self.assertEqual(Target.objects.count(), 5)
+
+
+class TestShardedSearch(TestCase):
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31'], ra=i * 6.0) for i in range(0, 60)]
+        for i, locus in enumerate(self.loci):
+            locus.properties['oldest_alert_observation_time'] = 59000 + i
+            locus.properties['newest_alert_observation_time'] = 59000 + i
+        self.server = ANTARESStandInServer(self.loci, page_size=4)
+        self.query = {'query': {'bool': {'filter': [{'terms': {'tags': ['in_m31']}}]}}}
+        self.locus_ids = sorted(locus.locus_id for locus in self.loci)
+
+    def test_shard_ranges_are_disjoint(self):
+        self.assertEqual(
+            shard_ranges(0.0, 360.0, 3),
+            [{'gte': 0.0, 'lt': 120.0}, {'gte': 120.0, 'lt': 240.0}, {'gte': 240.0, 'lte': 360.0}]
+        )
+
+    def test_finds_every_locus_once(self):
+        search = ShardedSearch(self.query, 'properties.newest_alert_observation_time', 59000, 59059, 4)
+        with self.server:
+            loci = list(search)
+
+        self.assertEqual(sorted(locus.locus_id for locus in loci), self.locus_ids)
+        self.assertTrue(all(shard['done'] for shard in search.state))
+        self.assertEqual([shard['offset'] for shard in search.state], [15, 15, 15, 15])
+        self.assertEqual(search.report.pages, 4 * 4)
+
+    def test_stops_at_max_alerts(self):
+        search = ShardedSearch(self.query, 'ra', 0.0, 360.0, 3, max_workers=2)
+        with self.server:
+            loci = list(search.search(max_alerts=10))
+        self.assertEqual(len(loci), 10)
+        self.assertEqual(sum(shard['offset'] for shard in search.state), 10)
+        # The shards have stopped, so their reports are no longer being updated
+        self.assertFalse([thread for thread in threading.enumerate() if thread.name.startswith('tom_antares_shard')])
+
+    @override_settings(BROKERS={'ANTARES': {'search_retries': 0}})
+    def test_resumes_failed_shards(self):
+        search = ShardedSearch(self.query, 'ra', 0.0, 360.0, 4)
+        with self.server:
+            self.server.failures = 2
+            loci = list(search)
+            self.assertFalse(search.report.complete)
+            self.assertEqual(sum(1 for shard in search.state if shard['error']), 2)
+
+            state = json.loads(json.dumps(search.state))
+            resumed = ShardedSearch(self.query, state=state)
+            loci += list(resumed)
+
+        self.assertTrue(resumed.report.complete)
+        self.assertEqual(sorted(locus.locus_id for locus in loci), self.locus_ids)
+
+    @override_settings(BROKERS={'ANTARES': {'search_retries': 0}})
+    def test_offsets_count_skipped_loci(self):
+        invalid_ids = {self.loci[i].locus_id for i in (1, 2, 50)}
+        for locus_id in invalid_ids:
+            self.server.documents[locus_id]['attributes']['ra'] = 'invalid'
+        search = ShardedSearch(self.query, 'properties.newest_alert_observation_time', 59000, 59059, 2)
+        with self.server:
+            loci = list(search.search(max_alerts=20))
+            resumed = ShardedSearch(self.query, state=json.loads(json.dumps(search.state)))
+            loci += list(resumed)
+
+        locus_ids = [locus.locus_id for locus in loci]
+        self.assertEqual(len(locus_ids), len(set(locus_ids)))
+        self.assertEqual(sorted(locus_ids), sorted(set(self.locus_ids) - invalid_ids))
+        self.assertEqual([shard['offset'] for shard in resumed.state], [30, 30])
+
+    @override_settings(BROKERS={'ANTARES': {'search_shards': 4}})
+    def test_narrowed_queries_are_not_sharded(self):
+        broker = ANTARESBroker()
+        locus = self.loci[7]
+        with self.server:
+            everything = {'max_alerts': float('inf')}
+            by_ztf_id = list(broker.fetch_alerts({**everything, 'ztfid': locus.properties['ztf_object_id']}))
+            in_cone = list(broker.fetch_alerts({**everything, 'ra': locus.ra, 'dec': locus.dec, 'sr': 0.01}))
+
+        self.assertEqual([alert['locus_id'] for alert in by_ztf_id + in_cone], [locus.locus_id] * 2)
+        self.assertIsNone(broker.search_report.shards)
+        self.assertEqual(self.server.requests['search'], 2)
+
+    @override_settings(BROKERS={'ANTARES': {'search_shards': 4}})
+    def test_finite_max_alerts_returns_the_newest_loci(self):
+        broker = ANTARESBroker()
+        with self.server:
+            alerts = list(broker.fetch_alerts({'tag': ['in_m31'], 'max_alerts': 25}))
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], [locus.locus_id for locus in self.loci[::-1][:25]])
+        self.assertIsNone(broker.search_report.shards)
+
+    @override_settings(BROKERS={'ANTARES': {'search_shards': 3, 'search_rate_limit': 1000}})
+    def test_fetch_alerts_shards_by_observation_time(self):
+        broker = ANTARESBroker()
+        parameters = {'tag': ['in_m31'], 'mjd__gt': 59010, 'mjd__lt': 59040, 'max_alerts': float('inf')}
+        with self.server:
+            alerts = list(broker.fetch_alerts(parameters))
+
+        times = sorted(alert['properties']['newest_alert_observation_time'] for alert in alerts)
+        self.assertEqual(times, list(range(59010, 59041)))
+        shards = broker.search_report.shards
+        self.assertEqual([shard['field'] for shard in shards], ['properties.newest_alert_observation_time'] * 3)
+        self.assertEqual(shards[0]['range'], {'gte': 59010, 'lt': 59020})
+        self.assertTrue(broker.search_report.complete)
+
+    @override_settings(BROKERS={'ANTARES': {'search_shards': 4}})
+    def test_fetch_alerts_shards_by_ra_without_time_bounds(self):
+        broker = ANTARESBroker()
+        with self.server:
+            alerts = list(broker.fetch_alerts({'tag': ['in_m31'], 'max_alerts': float('inf')}))
+        self.assertEqual(sorted(alert['locus_id'] for alert in alerts), self.locus_ids)
+        self.assertEqual({shard['field'] for shard in broker.search_report.shards}, {'ra'})
+
+    def test_rate_limiter_spaces_calls(self):
+        clock = FakeClock()
+        sleep = mock.MagicMock(side_effect=lambda seconds: setattr(clock, "now", clock.now + seconds))
+        limiter = RateLimiter(4, clock=clock, sleep=sleep)
+        for i in range(0, 3):
+            limiter.wait()
+        clock.now += 1.0
+        limiter.wait()
+        self.assertEqual(sleep.call_args_list, [mock.call(0.25), mock.call(0.25)])
+
+
+class TestParquetExport(TestCase):
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31']) for i in range(0, 7)]
+        for locus in self.loci:
+            locus.properties.update({'newest_alert_observation_time': 59000.5, 'ztf_ssnamenr': 'null'})
+        self.alerts = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci]
+
+    def test_loci_columns(self):
+        columns = loci_columns(self.alerts)
+        self.assertEqual(columns['locus_id'], [locus.locus_id for locus in self.loci])
+        self.assertEqual(columns['ztf_object_id'], [locus.properties['ztf_object_id'] for locus in self.loci])
+        self.assertEqual(columns['newest_alert_magnitude'], [None] * 7)
+        self.assertEqual(columns['tags'], [['in_m31']] * 7)
+        self.assertEqual(json.loads(columns['properties_json'][0]), {'ztf_ssnamenr': 'null'})
+
+    def test_alerts_columns_of_full_and_compact_loci(self):
+        columns = alerts_columns(self.alerts)
+        self.assertEqual(len(columns['alert_id']), 7 * 5)
+        self.assertEqual(columns['locus_id'][:6], [self.loci[0].locus_id] * 5 + [self.loci[1].locus_id])
+        self.assertEqual(columns['ztf_fid'][0], self.loci[0].alerts[0].properties['ztf_fid'])
+        self.assertIn('ztf_jd', json.loads(columns['properties_json'][0]))
+
+        compact_columns = alerts_columns([ANTARESBroker.alert_to_dict(locus, compact=True) for locus in self.loci])
+        for name in ['locus_id', 'alert_id', 'mjd'] + ALERT_PROPERTY_COLUMNS:
+            self.assertEqual(compact_columns[name], columns[name])
+        self.assertTrue(all(isinstance(fid, int) for fid in compact_columns['ztf_fid']))
+
+    @unittest.skipUnless(find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_exportantaresquery(self):
+        import pyarrow.parquet as pq
+
+        BrokerQuery.objects.create(name='m31', broker='ANTARES', parameters={'tag': ['in_m31'], 'max_alerts': 20})
+        with tempfile.TemporaryDirectory() as directory, ANTARESStandInServer(self.loci):
+            call_command('exportantaresquery', 'm31', directory, '--batch-size', '3', stdout=mock.MagicMock())
+            loci = pq.read_table(os.path.join(directory, 'loci.parquet'))
+            alerts = pq.read_table(os.path.join(directory, 'alerts.parquet'))
+            self.assertEqual(sorted(os.listdir(directory)), ['alerts.parquet', 'loci.parquet'])
+            self.assertEqual(pq.ParquetFile(os.path.join(directory, 'loci.parquet')).num_row_groups, 3)
+
+        self.assertEqual(loci.column('locus_id').to_pylist(), [locus.locus_id for locus in self.loci])
+        self.assertEqual(alerts.num_rows, 7 * 5)
+
+
+class TestSkyIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'sky_index')
+        self.clock = FakeClock()
+        self.clock.now = 1000.0
+        self.loci = [LocusFactory.create(ra=10.0 + i * 0.01, dec=-20.0 + i * 0.01) for i in range(0, 50)]
+        self.alerts = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_ang2pix(self):
+        self.assertEqual(ang2pix(1, [0, 0, 0, 90], [0, 90, -90, 0]).tolist(), [4, 0, 8, 5])
+        ra = np.random.default_rng(0).uniform(0, 360, 10000)
+        dec = np.degrees(np.arcsin(np.random.default_rng(1).uniform(-1, 1, 10000)))
+        # NESTED pixels contain the four pixels of the next order, and are equal in area
+        self.assertTrue((ang2pix(4, ra, dec) == ang2pix(8, ra, dec) // 4).all())
+        counts = np.bincount(ang2pix(4, ra, dec), minlength=192)
+        self.assertLess(counts.std(), 2 * np.sqrt(counts.mean()))
+
+    def test_cone_matches_brute_force(self):
+        index = SkyIndex(self.path, nside=64)
+        index.add(self.alerts)
+        matches = index.cone(10.1, -19.9, 0.05)
+
+        separations = angular_separation(10.1, -19.9, [a['ra'] for a in self.alerts], [a['dec'] for a in self.alerts])
+        expected = [alert['locus_id'] for alert, separation in zip(self.alerts, separations) if separation <= 0.05]
+        self.assertEqual(sorted(match['locus_id'] for match in matches), sorted(expected))
+        self.assertEqual(matches[0]['locus_id'], self.loci[10].locus_id)
+        self.assertEqual(matches[0]['ztf_object_id'], self.loci[10].properties['ztf_object_id'])
+
+    def test_save_and_load_memory_mapped(self):
+        index = SkyIndex(self.path, nside=64)
+        index.add(self.alerts)
+        index.add([{**self.alerts[0], 'ra': 200.0, 'dec': 45.0}])
+        index.save()
+
+        loaded = SkyIndex(self.path)
+        self.assertEqual(len(loaded), 50)
+        self.assertEqual(loaded.nside, 64)
+        self.assertIsInstance(loaded.columns['ra'], np.memmap)
+        self.assertEqual([match['locus_id'] for match in loaded.cone(200.0, 45.0, 0.01)], [self.loci[0].locus_id])
+
+    def test_save_merges_other_processes(self):
+        first, second = SkyIndex(self.path), SkyIndex(self.path)
+        first.add(self.alerts[:30])
+        first.save()
+        second.add(self.alerts[20:])
+        second.mark_covered(10.0, -20.0, 5.0)
+        second.save()
+
+        merged = SkyIndex(self.path)
+        self.assertEqual(len(merged), 50)
+        self.assertTrue(SkyIndex(self.path).covers(10.0, -20.0, 1.0))
+
+    @mock.patch('tom_antares.sky_index.SKY_INDEX_SNAPSHOT_GRACE', -1)
+    def test_saves_replace_the_whole_snapshot(self):
+        first = SkyIndex(self.path)
+        first.add(self.alerts[:30])
+        first.save()
+        stale = first._snapshot(self.path)
+        second = SkyIndex(self.path)
+        second.add(self.alerts[30:])
+        second.save()
+        current = second._snapshot(self.path)
+        self.assertEqual([name for name in os.listdir(self.path) if name.startswith('snapshot-')], [current])
+
+        # A reader that found the replaced snapshot, deleted before it was loaded, loads the new one
+        reader = SkyIndex(self.path)
+        with mock.patch.object(SkyIndex, '_snapshot', side_effect=[stale, current, current]):
+            self.assertEqual(len(reader), 50)
+
+    def test_inconsistent_snapshot_is_refused(self):
+        index = SkyIndex(self.path)
+        index.add(self.alerts)
+        index.save()
+        np.save(os.path.join(self.path, index._snapshot(self.path), 'ra.npy'), np.zeros(49))
+
+        with self.assertRaises(ValueError):
+            len(SkyIndex(self.path))
+
+    def test_coverage_expires(self):
+        index = SkyIndex(self.path, ttl=3600, clock=self.clock)
+        self.assertFalse(index.covers(10.0, -20.0, 1.0))
+        index.mark_covered(10.0, -20.0, 5.0)
+        self.assertTrue(index.covers(10.0, -20.0, 1.0))
+        self.assertFalse(index.covers(10.0, -20.0, 5.0))
+        self.clock.now += 3601
+        self.assertFalse(index.covers(10.0, -20.0, 1.0))
+
+    def test_match_targets(self):
+        index = SkyIndex(self.path, nside=64)
+        index.add(self.alerts)
+        target = Target.objects.create(name='near', type='SIDEREAL', ra=10.2, dec=-19.8)
+        Target.objects.create(name='far', type='SIDEREAL', ra=100.0, dec=20.0)
+
+        matches = index.match_targets(1 / 3600)
+        self.assertEqual([(t, match['locus_id']) for t, match in matches], [(target, self.loci[20].locus_id)])
+
+    def test_cone_search_falls_back_to_antares(self):
+        loci = [LocusFactory.create(ra=10.0 + i * 0.2, dec=-20.0) for i in range(0, 20)]
+        broker = ANTARESBroker()
+        with self.settings(BROKERS={'ANTARES': {'sky_index_path': self.path}}), \
+                ANTARESStandInServer(loci) as server:
+            first = broker.cone_search(11.0, -20.0, 2.0)
+            self.assertEqual(server.requests['search'], 1)
+            second = broker.cone_search(11.0, -20.0, 0.5)
+            self.assertEqual(server.requests['search'], 1)
+            sky_index.save()
+
+        self.assertEqual(len(first), 16)
+        self.assertEqual({match['locus_id'] for match in second}, {match['locus_id'] for match in first[:5]})
+        self.assertEqual(len(SkyIndex(self.path)), 16)
+
+
+# Maximum time, in seconds, importing the broker may add to the start-up of a TOM, and the
+# dependencies it should only import when they are first used
+# Modules tom_antares.antares imports lazily which Django and tom_alerts do not import already.
+# astropy and numpy are also imported lazily, but tom_alerts has imported them by then.
+LAZY_MODULES = ['antares_client', 'marshmallow', 'pandas']
+
+
+class TestAsyncBroker(TestCase):
+    """Runs the async broker API against the ANTARES stand-in."""
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31'] if i % 2 else []) for i in range(0, 100)]
+        for i, locus in enumerate(self.loci):
+            locus.properties['newest_alert_observation_time'] = 59000 + i
+        self.newest_tagged = [locus.locus_id for locus in reversed(self.loci) if 'in_m31' in locus.tags]
+        self.server = ANTARESStandInServer(self.loci, page_size=20)
+        locus_cache.clear()
+        tag_cache.clear()
+
+    def tearDown(self):
+        locus_cache.clear()
+        tag_cache.clear()
+
+    def fetch_alerts(self, parameters, **kwargs):
+        async def fetch():
+            async with AsyncANTARESClient(**kwargs) as client:
+                return [alert async for alert in ANTARESBroker().afetch_alerts(parameters, client=client)]
+        return asyncio.run(fetch())
+
+    def test_afetch_alerts(self):
+        with self.server:
+            alerts = self.fetch_alerts({'tag': ['in_m31'], 'max_alerts': 30}, transport='threads')
+            expected = list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 30}))
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], self.newest_tagged[:30])
+        self.assertEqual(alerts, expected)
+        # Alerts are only fetched for the loci yielded
+        self.assertEqual(self.server.requests, {'search': 2 * 2, 'alerts': 2 * 30})
+
+    def test_concurrent_lookups(self):
+        self.server.latency = 0.1
+        antids = [locus.locus_id for locus in self.loci[:10]] + ['ANT2020missing']
+        with self.server:
+            start = time.perf_counter()
+            alerts = self.fetch_alerts({'antid': ','.join(antids)}, max_connections=11, transport='threads')
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([alert['locus_id'] for alert in alerts], antids[:10])
+        self.assertEqual(self.server.requests, {'locus': 10, 'alerts': 10, 'not_found': 1})
+        # Two rounds of concurrent requests rather than 21 in turn
+        self.assertLess(elapsed, 1.0)
+
+    def test_lookups_and_tags(self):
+        async def lookups():
+            broker = ANTARESBroker()
+            return await asyncio.gather(
+                broker.afetch_locus(self.loci[3].locus_id),
+                broker.afetch_locus('ANT2020missing'),
+                broker.afetch_alert(self.loci[4].properties['ztf_object_id']),
+                aget_tag_choices(),
+            )
+
+        with self.server:
+            locus, missing, by_ztf_id, tags = asyncio.run(lookups())
+
+        self.assertEqual(locus.properties, self.loci[3].properties)
+        # The alerts were loaded while the server was running
+        self.assertEqual([alert.alert_id for alert in locus.alerts], [a.alert_id for a in self.loci[3].alerts])
+        self.assertIsNone(missing)
+        self.assertEqual(by_ztf_id.locus_id, self.loci[4].locus_id)
+        self.assertEqual(len(by_ztf_id.alerts), 5)
+        self.assertEqual(tags, [('in_m31', 'in_m31')])
+
+    def test_asearch_pages_retries(self):
+        async def pages():
+            async with AsyncANTARESClient(transport='threads') as client:
+                return [body async for body in asearch_pages({'query': {}}, client, retries=2, backoff=0.01)]
+
+        self.server.failures = 2
+        with self.server:
+            bodies = asyncio.run(pages())
+
+        self.assertEqual(sum(len(body['data']) for body in bodies), 100)
+        self.assertEqual(self.server.requests, {'failed': 2, 'search': 5})
+
+    @unittest.skipUnless(find_spec('httpx'), 'httpx is not installed')
+    def test_httpx_transport(self):
+        with self.server:
+            alerts = self.fetch_alerts({'tag': ['in_m31'], 'max_alerts': 5}, transport='httpx')
+        self.assertEqual([alert['locus_id'] for alert in alerts], self.newest_tagged[:5])
+
+
+class TestHTTPTransport(TestCase):
+    """Checks the connection pool and rate limiter ANTARES requests are routed through."""
+
+    def setUp(self):
+        self.loci = [LocusFactory.create(tags=['in_m31']) for i in range(0, 20)]
+        self.server = ANTARESStandInServer(self.loci, page_size=10)
+        http_transport.close()
+        locus_cache.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        http_transport.close()
+        locus_cache.clear()
+        metrics.reset()
+
+    @override_settings(BROKERS={'ANTARES': {'metrics_sinks': ['prometheus']}})
+    def test_reuses_connections(self):
+        before = http_transport.stats()
+        with self.server:
+            list(ANTARESBroker().fetch_alerts({'tag': ['in_m31'], 'max_alerts': 15}))
+        after = http_transport.stats()
+
+        # Two pages and the alerts of 15 loci, all sent on one connection
+        self.assertEqual(after['requests'] - before['requests'], 17)
+        self.assertEqual(after['new_connections'] - before['new_connections'], 1)
+        self.assertEqual(metrics.counters[('tom_antares_http_connections_total', (('connection', 'reused'),))], 16)
+
+    @override_settings(BROKERS={'ANTARES': {'http_max_connections': 2}})
+    def test_limits_concurrent_requests(self):
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+        handle = self.server.handle
+
+        def counting_handle(path):
+            with lock:
+                in_flight.append(path)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(path)
+            return handle(path)
+
+        self.server.handle = counting_handle
+        before = http_transport.stats()
+        with self.server:
+            lookups = ANTARESBroker().fetch_loci([locus.locus_id for locus in self.loci[:8]], max_workers=8)
+
+        self.assertTrue(all(result.locus for result in lookups))
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(http_transport.stats()['new_connections'] - before['new_connections'], 2)
+
+    @override_settings(BROKERS={'ANTARES': {'http_connect_timeout': 5, 'http_read_timeout': 60}})
+    def test_timeouts_from_settings(self):
+        requests_module = mock.MagicMock()
+        transport = PooledTransport(requests_module)
+        transport.get('https://antares.example/v1/loci', timeout=30)
+        requests_module.Session.return_value.get.assert_called_once_with(
+            'https://antares.example/v1/loci', params=None, timeout=(5, 60)
+        )
+        self.assertEqual(PooledTransport.timeout(30), (5, 60))
+        with override_settings(BROKERS={'ANTARES': {}}):
+            self.assertEqual(PooledTransport.timeout(30), (30, 30))
+
+    def test_rate_limiter_allows_bursts(self):
+        clock = FakeClock()
+        sleep = mock.MagicMock(side_effect=lambda seconds: setattr(clock, "now", clock.now + seconds))
+        limiter = RateLimiter(2, burst=3, clock=clock, sleep=sleep)
+        for i in range(0, 5):
+            limiter.wait()
+        # Three calls go ahead at once, and the bucket then refills at two tokens a second
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5), mock.call(0.5)])
+        clock.now += 10
+        for i in range(0, 3):
+            limiter.wait()
+        self.assertEqual(sleep.call_count, 2)
+
+    @override_settings(BROKERS={'ANTARES': {'http_rate_limit': 5, 'http_rate_burst': 2}})
+    def test_rate_limiter_from_settings(self):
+        limiter = http_transport.rate_limiter
+        self.assertEqual((limiter.interval, limiter.burst), (0.2, 2))
+        self.assertIs(http_transport.rate_limiter, limiter)
+        with override_settings(BROKERS={'ANTARES': {}}):
+            self.assertIsNone(http_transport.rate_limiter)
+
+
+def light_curve_alert(mjd, fid, magnitude=None, limit=20.0):
+    properties = {'ztf_fid': fid, 'ztf_diffmaglim': limit}
+    if magnitude is not None:
+        properties['ztf_magpsf'] = magnitude
+    return AlertFactory.create(mjd=mjd, properties=properties)
+
+
+class TestLightCurveFeatures(TestCase):
+
+    def setUp(self):
+        self.rising = LocusFactory.create(alerts=[
+            light_curve_alert(59010.0, 2),
+            light_curve_alert(59011.0, 1, 19.0),
+            light_curve_alert(59012.0, 2, 18.5),
+            light_curve_alert(59013.0, 1, 18.0),
+            light_curve_alert(59013.5, 2, 17.8),
+            light_curve_alert(59015.0, 1, 18.5),
+            light_curve_alert(59015.2, 2, 18.6),
+        ])
+        self.undetected = LocusFactory.create(alerts=[light_curve_alert(59005.0, 1)])
+        self.faint = LocusFactory.create(alerts=[
+            light_curve_alert(59001.0, 1, 20.5),
+            light_curve_alert(59003.0, 2, 19.5),
+        ])
+        self.loci = [self.rising, self.undetected, self.faint]
+
+    def test_compute_features(self):
+        alerts = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci]
+        features = compute_features(alerts, now=59020.0)
+
+        np.testing.assert_array_equal(features['num_detections'], [6, 0, 2])
+        np.testing.assert_array_equal(features['first_detection_mjd'], [59011.0, np.nan, 59001.0])
+        np.testing.assert_array_equal(features['days_since_first_detection'], [9.0, np.nan, 19.0])
+        np.testing.assert_array_equal(features['last_nondetection_mjd'], [59010.0, 59005.0, np.nan])
+        np.testing.assert_array_equal(features['peak_magnitude'], [17.8, np.nan, 19.5])
+        # The rates are measured in r, the passband of the peak
+        np.testing.assert_allclose(features['rise_rate'], [0.7 / 1.5, np.nan, np.nan])
+        np.testing.assert_allclose(features['fade_rate'], [0.8 / 1.7, np.nan, np.nan])
+        # The last g and r detections of the faint locus are two days apart
+        np.testing.assert_allclose(features['g_minus_r'], [-0.1, np.nan, np.nan])
+
+    def test_compact_and_batched_features_agree(self):
+        loci = self.loci + [LocusFactory.create() for i in range(0, 20)]
+        full = compute_features([ANTARESBroker.alert_to_dict(locus) for locus in loci], now=60000.0)
+        compact = compute_features([ANTARESBroker.alert_to_dict(locus, compact=True) for locus in loci], now=60000.0)
+        one_at_a_time = [compute_features([ANTARESBroker.alert_to_dict(locus)], now=60000.0) for locus in loci]
+
+        for name in FEATURE_NAMES:
+            np.testing.assert_array_equal(compact[name], full[name])
+            np.testing.assert_array_equal(np.concatenate([features[name] for features in one_at_a_time]), full[name])
+
+    def test_select_by_features(self):
+        alerts = [ANTARESBroker.alert_to_dict(locus) for locus in self.loci]
+        by_peak = select_by_features(alerts, order_by='peak_magnitude', now=59020.0)
+        detected = select_by_features(alerts, {'num_detections__gte': 1, 'peak_magnitude__lt': 19.0}, '-rise_rate')
+
+        # Loci without the feature come last
+        self.assertEqual([alert['locus_id'] for alert in by_peak], [locus.locus_id for locus in self.loci[::2]] + [
+            self.undetected.locus_id
+        ])
+        self.assertEqual([alert['locus_id'] for alert in detected], [self.rising.locus_id])
+        self.assertEqual(by_peak[0]['features']['num_detections'], 6)
+        self.assertIsNone(by_peak[2]['features']['peak_magnitude'])
+
+    @override_settings(BROKERS={'ANTARES': {'lightcurve_features': True}})
+    def test_features_are_computed_a_page_at_a_time(self):
+        loci = self.loci + [LocusFactory.create() for i in range(0, 150)]
+        with mock.patch('tom_antares.antares.add_features', wraps=add_features) as mock_add_features:
+            with ANTARESStandInServer(loci):
+                alerts = list(ANTARESBroker().fetch_alerts({'max_alerts': 120}))
+
+        self.assertEqual([len(call.args[0]) for call in mock_add_features.call_args_list], [100, 20])
+        self.assertEqual(len(alerts), 120)
+        self.assertTrue(all('features' in alert for alert in alerts))
+
+    @override_settings(BROKERS={'ANTARES': {'lightcurve_features': True}})
+    def test_alert_to_dict_attaches_features(self):
+        alert = ANTARESBroker.alert_to_dict(self.rising, compact=True)
+        self.assertEqual(alert['features']['peak_mjd'], 59013.5)
+        with override_settings(BROKERS={'ANTARES': {}}):
+            self.assertNotIn('features', ANTARESBroker.alert_to_dict(self.rising))
+
+
+class TestSortedSearch(TestCase):
+    """Sorts search results on ANTARES, or client-side for properties it cannot sort on."""
+
+    def setUp(self):
+        self.loci = [LocusFactory.create() for i in range(0, 60)]
+        for i, locus in enumerate(self.loci):
+            locus.properties['newest_alert_observation_time'] = 59000 + i
+            locus.properties['brightest_alert_magnitude'] = 15 + (i * 7) % 60 / 10
+            for alert in locus.alerts:
+                alert.properties['ztf_rb'] = (i * 13) % 60 / 60
+        # Two loci ANTARES has no magnitude for
+        del self.loci[0].properties['brightest_alert_magnitude']
+        del self.loci[1].properties['brightest_alert_magnitude']
+        self.server = ANTARESStandInServer(self.loci, page_size=20)
+
+    def test_server_sort(self):
+        with self.server:
+            alerts = list(ANTARESBroker().fetch_alerts({'sort': 'brightest_alert_magnitude', 'max_alerts': 5}))
+
+        expected = sorted(self.loci[2:], key=lambda locus: locus.properties['brightest_alert_magnitude'])[:5]
+        self.assertEqual([alert['locus_id'] for alert in alerts], [locus.locus_id for locus in expected])
+        # The brightest loci come on the first page
+        self.assertEqual(self.server.requests, {'search': 1, 'alerts': 5})
+
+    @override_settings(BROKERS={'ANTARES': {'sort_scan_limit': 50}})
+    def test_client_side_top_k(self):
+        with self.server:
+            alerts = list(ANTARESBroker().fetch_alerts({'sort': '-ztf_rb', 'max_alerts': 5}))
+
+        # Only the newest 50 loci are scanned
+        expected = sorted(reversed(self.loci[10:]), key=lambda locus: -locus.alerts[0].properties['ztf_rb'])[:5]
+        self.assertEqual([alert['locus_id'] for alert in alerts], [locus.locus_id for locus in expected])
+        self.assertEqual(self.server.requests, {'search': 3, 'alerts': 50})
+
+    def test_top_alerts_puts_missing_values_last(self):
+        alerts = [{'locus_id': i, 'properties': {'num_mag_values': value}} for i, value in enumerate(
+            [3, None, 5, 1, float('nan'), 5]
+        )]
+
+        self.assertEqual([alert['locus_id'] for alert in top_alerts(alerts, 4, '-num_mag_values')], [2, 5, 0, 3])
+        self.assertEqual(
+            [alert['locus_id'] for alert in top_alerts(alerts, float('inf'), 'num_mag_values')], [3, 0, 2, 5, 1, 4]
+        )
+
+    def test_feature_sort_computes_features_in_batches(self):
+        alerts = [ANTARESBroker.alert_to_dict(locus, compact=True) for locus in self.loci * 3]
+        expected = select_by_features([dict(alert) for alert in alerts], order_by='-rise_rate')[:5]
+
+        with mock.patch('tom_antares.antares.add_features', wraps=add_features) as mock_add_features:
+            top = top_alerts(iter(alerts), 5, '-rise_rate')
+
+        self.assertEqual([len(call.args[0]) for call in mock_add_features.call_args_list], [100, 80])
+        self.assertEqual([alert['locus_id'] for alert in top], [alert['locus_id'] for alert in expected])
+
+    def test_async_sort(self):
+        async def fetch(parameters):
+            async with AsyncANTARESClient(transport='threads') as client:
+                return [alert async for alert in ANTARESBroker().afetch_alerts(parameters, client=client)]
+
+        with self.server:
+            for sort in ['brightest_alert_magnitude', '-ztf_rb']:
+                parameters = {'sort': sort, 'max_alerts': 5}
+                self.assertEqual(asyncio.run(fetch(parameters)), list(ANTARESBroker().fetch_alerts(parameters)))
+
+    def test_form_sort_choices(self):
+        data = {'query_name': 'sorted', 'broker': 'ANTARES', 'ztfid': 'ZTF20achooum', 'max_alerts': 5}
+        form = ANTARESBrokerForm({**data, 'sort': '-rise_rate'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['sort'], '-rise_rate')
+        self.assertIn('sort', ANTARESBrokerForm({**data, 'sort': 'ztf_object_id'}).errors)
+
+
+class TestImportTime(TestCase):
+
+    def test_import_time(self):
+        """Test that loading the broker, as Django does for TOM_ALERT_CLASSES, stays cheap."""
+        tests_dir = os.path.dirname(os.path.abspath(__file__))
+        script = (
+            'import json, sys\n'
+            'from boot_django import boot_django\n'
+            'boot_django()\n'
+            'import tom_alerts.alerts\n'
+            'before = set(sys.modules)\n'
+            'import tom_antares.antares\n'
+            'print(json.dumps([sorted(before), sorted(set(sys.modules) - before)]))\n'
+            'import antares_client\n'
+        )
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join([tests_dir, os.path.dirname(os.path.dirname(tests_dir))])}
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                                cwd=tests_dir, env=env, capture_output=True, text=True, check=True)
+
+        before, imported = json.loads(result.stdout.splitlines()[-1])
+        # Otherwise the check below would pass whatever tom_antares.antares imports
+        self.assertEqual([name for name in before if name.split('.')[0] in LAZY_MODULES], [])
+        self.assertEqual([name for name in imported if name.split('.')[0] in LAZY_MODULES], [])
+        cumulative = {
+            line.split('|')[2].strip(): int(line.split('|')[1])
+            for line in result.stderr.splitlines() if line.startswith('import time:') and 'cumulative' not in line
+        }
+        # Measured against the import it defers, in the same process, so that a loaded machine slows both
+        self.assertLess(cumulative['tom_antares.antares'], cumulative['antares_client'] / 2)
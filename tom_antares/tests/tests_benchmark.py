@@ -0,0 +1,319 @@
+import json
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from django.db import connection
+from django.test import tag, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from tom_antares.antares import ANTARESBroker, ANTARESBrokerForm, locus_cache, tag_cache
+from tom_antares.features import compute_features
+from tom_antares.tests.factories import AlertFactory, LocusFactory
+from tom_antares.sky_index import SkyIndex
+from tom_antares.tests.server import ANTARESStandInServer
+from tom_antares.utils import angular_separation
+from tom_targets.models import Target
+
+# Multiplies the number of loci each benchmark uses, e.g. 10 for 20k loci
+SCALE = float(os.getenv('ANTARES_BENCHMARK_SCALE', 1))
+
+# Number of loci serialized by the alert_to_dict benchmark for each number of alerts per locus
+ALERTS_PER_LOCUS = {1: 1000, 10: 200, 100: 50, 1000: 10, 5000: 2}
+
+# Results of the benchmarks run so far, by name, saved by run_benchmarks.py
+results = {}
+
+# Throughput of reference_workload on this machine, measured before the first benchmark
+_reference_throughput = None
+
+
+def reference_workload():
+    """A fixed mix of dict building, JSON encoding and NumPy sorting, independent of the broker."""
+    for i in range(0, 5000):
+        json.dumps({'locus_id': f'ANT{i}', 'ra': i / 3, 'dec': -i / 7, 'properties': {'tags': ['in_m31'] * 5}})
+    np.sort(np.random.default_rng(0).random(10000))
+
+
+def reference_throughput():
+    """
+    Returns the best throughput of ``reference_workload`` over five runs. Benchmark throughputs
+    are also recorded relative to it, so that they can be compared between machines.
+    """
+    global _reference_throughput
+    if _reference_throughput is None:
+        durations = []
+        for i in range(0, 5):
+            start = time.perf_counter()
+            reference_workload()
+            durations.append(time.perf_counter() - start)
+        _reference_throughput = 1 / min(durations)
+    return _reference_throughput
+
+
+def measured_memory(func, *args, **kwargs):
+    """Returns the result of calling func and the memory still allocated by it afterwards."""
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+# A sample of the alert properties ANTARES returns that this broker does not use
+EXTRA_ALERT_PROPERTIES = {
+    'ztf_pdiffimfilename': 'ztf_20201004493495_000817_zg_c01_o_q1_scimrefdiffimg.fits.fz',
+    'ztf_programpi': 'Kulkarni', 'ztf_programid': 1, 'ztf_nid': 1372, 'ztf_rcid': 0, 'ztf_field': 817,
+    'ztf_magzpsci': 26.03019905090332, 'ztf_magzpsciunc': 2.967269938380923e-05, 'ztf_rbversion': 't17_f5_c3',
+    'ant_mjd': 59126.493495400064, 'ant_time_received': 1602073185, 'ant_passband': 'g', 'ant_survey': 2,
+}
+
+
+def timed(func, *args, **kwargs):
+    """Returns the result of calling func, the elapsed wall time and the number of queries it ran."""
+    with CaptureQueriesContext(connection) as context:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return result, elapsed, len(context.captured_queries)
+
+
+def benchmark(name, count, func, *args, trace_memory=True, **kwargs):
+    """
+    Calls func, which processes count items, records its throughput in items per second in
+    ``results``, and returns its result and the elapsed wall time. Unless trace_memory is
+    False, e.g. because func writes to the database, func is then called again with tracemalloc
+    running to record its peak memory, as tracing slows the code it measures.
+    """
+    result, elapsed, queries = timed(func, *args, **kwargs)
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results[name] = {
+        'count': count,
+        'seconds': elapsed,
+        'throughput': count / elapsed,
+        'relative_throughput': count / elapsed / reference_throughput(),
+        'peak_memory': peak,
+        'queries': queries,
+    }
+    memory = f', peak memory {peak / 1e6:.1f}MB' if peak is not None else ''
+    print(f'\n{name}: {count} in {elapsed:.3f}s ({count / elapsed:.0f}/s){memory}, {queries} queries')
+    return result, elapsed
+
+
+def compare_to_baseline(current, baseline, threshold):
+    """
+    Returns a description of each benchmark whose throughput fell, or whose peak memory rose,
+    by more than ``threshold`` (a fraction) relative to the baseline. Throughputs are compared
+    relative to that of ``reference_workload`` in the same run, so that a baseline recorded on
+    one machine holds on another.
+    """
+    regressions = []
+    for name, result in sorted(current.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['relative_throughput'] < expected['relative_throughput'] * (1 - threshold):
+            regressions.append(f'{name}: {result["relative_throughput"]:.3g} times the reference throughput, '
+                               f'baseline {expected["relative_throughput"]:.3g}')
+        if result['peak_memory'] and expected['peak_memory'] and (
+            result['peak_memory'] > expected['peak_memory'] * (1 + threshold)
+        ):
+            regressions.append(f'{name}: peak memory {result["peak_memory"] / 1e6:.1f}MB, '
+                               f'baseline {expected["peak_memory"] / 1e6:.1f}MB')
+    return regressions
+
+
+def save_results(path):
+    with open(path, 'w') as f:
+        json.dump({'scale': SCALE, 'reference_throughput': reference_throughput(), 'results': results}, f,
+                  indent=2, sort_keys=True)
+
+
+def make_loci(num_loci, alerts_per_locus, alert_pool, **kwargs):
+    """Returns loci whose alerts are drawn from alert_pool, which is much faster than creating new alerts."""
+    return [
+        LocusFactory.create(
+            alerts=[alert_pool[(i + j) % len(alert_pool)] for j in range(0, alerts_per_locus)], **kwargs
+        )
+        for i in range(0, num_loci)
+    ]
+
+
+@tag('benchmark')
+class TestANTARESBrokerBenchmarks(TestCase):
+    """NOTE: to run these benchmarks in your venv: python ./tom_antares/tests/run_benchmarks.py"""
+
+    num_loci = int(2000 * SCALE)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.alerts = [ANTARESBroker.alert_to_dict(LocusFactory.create()) for i in range(0, cls.num_loci)]
+        for i, alert in enumerate(cls.alerts):
+            alert['properties']['newest_alert_observation_time'] = 59000 + i / 10
+        cls.alert_pool = [AlertFactory.create() for i in range(0, 500)]
+        for alert in cls.alert_pool:
+            alert.properties.update(EXTRA_ALERT_PROPERTIES)
+
+    def setUp(self):
+        self.broker = ANTARESBroker()
+
+    def test_alert_to_dict(self):
+        """Serialize loci with between 1 and 5000 alerts each, fully and compactly."""
+        for alerts_per_locus, num_loci in ALERTS_PER_LOCUS.items():
+            loci = make_loci(max(int(num_loci * SCALE), 1), alerts_per_locus, self.alert_pool)
+            for compact in (False, True):
+                serialized, _ = benchmark(
+                    f'alert_to_dict[alerts={alerts_per_locus},compact={compact}]', len(loci) * alerts_per_locus,
+                    lambda: [self.broker.alert_to_dict(locus, compact=compact) for locus in loci]
+                )
+                self.assertEqual(len(serialized), len(loci))
+
+    def test_fetch_alerts_paginated(self):
+        """Fetch a search of many pages through antares_client, answered in-process."""
+        loci = make_loci(self.num_loci, 20, self.alert_pool, tags=['in_m31'])
+        server = ANTARESStandInServer(loci, page_size=100)
+        parameters = {'tag': ['in_m31'], 'max_alerts': self.num_loci}
+        for compact in (False, True):
+            with mock.patch('antares_client._api.api.requests', SimpleNamespace(get=server.get)), \
+                    self.settings(BROKERS={'ANTARES': {'compact_alerts': compact}}):
+                alerts, _ = benchmark(
+                    f'fetch_alerts[compact={compact}]', self.num_loci,
+                    lambda: list(self.broker.fetch_alerts(parameters))
+                )
+            self.assertEqual(len(alerts), self.num_loci)
+
+    def test_query_form(self):
+        """Build and validate query forms."""
+        parameters = {
+            'query_name': 'm31', 'broker': 'ANTARES', 'tag': ['in_m31'], 'mag__min': 15, 'mag__max': 20,
+            'ra': 10.68, 'dec': 41.27, 'sr': 1.0, 'max_alerts': 20,
+        }
+        num_forms = int(1000 * SCALE)
+        tag_cache.clear()
+        with mock.patch.object(tag_cache, 'fetch', return_value=['in_m31', 'young_extragalactic_candidate']):
+            benchmark('ANTARESBrokerForm', num_forms,
+                      lambda: [ANTARESBrokerForm(parameters) for i in range(0, num_forms)])
+            valid, _ = benchmark('ANTARESBrokerForm.is_valid', num_forms,
+                                 lambda: [ANTARESBrokerForm(parameters).is_valid() for i in range(0, num_forms)])
+        tag_cache.clear()
+        self.assertTrue(all(valid))
+
+    def test_to_targets_against_to_target(self):
+        """Compare bulk target ingestion against creating one target and its aliases at a time."""
+        def one_at_a_time(alerts):
+            for alert in alerts:
+                target, _, aliases = self.broker.to_target(alert)
+                for alias in aliases:
+                    alias.target = target
+                    alias.save()
+
+        half = self.num_loci // 2
+        _, single_time = benchmark('to_target', half, one_at_a_time, self.alerts[:half], trace_memory=False)
+        _, bulk_time = benchmark('to_targets', half, self.broker.to_targets, self.alerts[half:], trace_memory=False)
+
+        self.assertEqual(Target.objects.count(), self.num_loci)
+        self.assertLess(bulk_time, single_time)
+        self.assertLess(results['to_targets']['queries'], results['to_target']['queries'])
+
+    def test_to_generic_alerts_against_to_generic_alert(self):
+        """Compare batch conversion to GenericAlerts against converting one alert at a time."""
+        alerts = (self.alerts * int(5000 * SCALE // self.num_loci + 1))[:int(5000 * SCALE)]
+
+        single, single_time = benchmark('to_generic_alert', len(alerts),
+                                        lambda: [self.broker.to_generic_alert(alert) for alert in alerts])
+        batch, batch_time = benchmark('to_generic_alerts', len(alerts), self.broker.to_generic_alerts, alerts)
+
+        self.assertEqual(batch, single)
+        self.assertLess(batch_time, single_time)
+
+    def test_compact_alert_to_dict_memory(self):
+        """Compare the cached size of full and compact serializations of loci with hundreds of alerts."""
+        loci = []
+        for i in range(0, 50):
+            alerts = [AlertFactory.create() for j in range(0, 300)]
+            for alert in alerts:
+                alert.properties.update(EXTRA_ALERT_PROPERTIES)
+            loci.append(LocusFactory.create(alerts=alerts))
+
+        sizes = {}
+        for compact in (False, True):
+            serialized = pickle.dumps([ANTARESBroker.alert_to_dict(locus, compact=compact) for locus in loci])
+            _, memory = measured_memory(pickle.loads, serialized)
+            sizes[compact] = (len(serialized), memory)
+
+        for compact, (pickled_size, memory) in sizes.items():
+            print(f'\nalert_to_dict(compact={compact}): {pickled_size / 1e6:.1f}MB pickled, '
+                  f'{memory / 1e6:.1f}MB in memory')
+        self.assertLess(sizes[True][0], sizes[False][0] / 2)
+        self.assertLess(sizes[True][1], sizes[False][1] / 4)
+
+    def test_lightcurve_features(self):
+        """Compare computing light-curve features for many loci at once against one locus at a time."""
+        loci = make_loci(int(5000 * SCALE), 20, self.alert_pool)
+        alerts = [ANTARESBroker.alert_to_dict(locus, compact=True) for locus in loci]
+
+        single, single_time = benchmark('compute_features[single]', len(alerts),
+                                        lambda: [compute_features([alert], now=60000) for alert in alerts])
+        batch, batch_time = benchmark('compute_features[batch]', len(alerts), compute_features, alerts, now=60000)
+
+        for name, values in batch.items():
+            np.testing.assert_array_equal(values, np.concatenate([features[name] for features in single]))
+        self.assertLess(batch_time, single_time / 10)
+
+    def test_end_to_end_against_stand_in_server(self):
+        """Time a search and its ingestion against a local ANTARES stand-in, over HTTP."""
+        loci = [LocusFactory.create(tags=['in_m31']) for i in range(0, self.num_loci)]
+        parameters = {'tag': ['in_m31'], 'max_alerts': self.num_loci}
+        locus_cache.clear()
+        with ANTARESStandInServer(loci, page_size=200) as server:
+            alerts, _ = benchmark('fetch_alerts[http]', self.num_loci,
+                                  lambda: list(self.broker.fetch_alerts(parameters)), trace_memory=False)
+            benchmark('ingest_alerts', self.num_loci, self.broker.ingest_alerts, alerts, trace_memory=False)
+
+        print(f'{sum(server.requests.values())} requests to the stand-in server')
+        self.assertEqual(len(alerts), self.num_loci)
+        self.assertEqual(Target.objects.count(), self.num_loci)
+
+    def test_sky_index(self):
+        """Build, save and query a sky index of 1M loci, and compare cone searches with a brute-force scan."""
+        num_loci = int(1000000 * SCALE)
+        rng = np.random.default_rng(0)
+        ra = rng.uniform(0, 360, num_loci)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, num_loci)))
+        locus_ids = np.char.add('ANT', np.arange(0, num_loci).astype(str))
+        num_cones = 1000
+        cones = rng.uniform(0, 360, num_cones), np.degrees(np.arcsin(rng.uniform(-1, 1, num_cones)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = SkyIndex(directory)
+            benchmark('SkyIndex.add_positions', num_loci, index.add_positions, locus_ids, ra, dec, trace_memory=False)
+            benchmark('SkyIndex.save', num_loci, index.save, trace_memory=False)
+            loaded, _ = benchmark('SkyIndex.load', num_loci, lambda: len(SkyIndex(directory)))
+
+            matches, index_time = benchmark('SkyIndex.cone', num_cones, lambda: [
+                index.cone(cone_ra, cone_dec, 0.1) for cone_ra, cone_dec in zip(*cones)
+            ])
+            benchmark('SkyIndex.cross_match', num_cones, index.cross_match, cones[0], cones[1], 1 / 60)
+            num_scans = 20
+            scanned, scan_time = benchmark('brute-force cone', num_scans, lambda: [
+                np.flatnonzero(angular_separation(cone_ra, cone_dec, ra, dec) <= 0.1)
+                for cone_ra, cone_dec in zip(cones[0][:num_scans], cones[1][:num_scans])
+            ], trace_memory=False)
+
+        self.assertEqual(loaded, num_loci)
+        self.assertEqual([len(cone) for cone in matches[:num_scans]], [len(cone) for cone in scanned])
+        if SCALE >= 1:
+            # A scan is cheap over the few loci of a smaller sky, so the index only wins by far at scale
+            self.assertLess(index_time / num_cones, scan_time / num_scans / 10)
@@ -0,0 +1,174 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tom_antares.metrics import InstrumentedRequests, metrics
+from tom_antares.utils import RateLimiter, get_antares_setting
+
+DEFAULT_HTTP_MAX_CONNECTIONS = 10
+DEFAULT_HTTP_RATE_BURST = 10
+
+
+def counting_pool(pool_class, transport):
+    '''
+    Returns a subclass of a urllib3 connection pool class which tells ``transport`` whenever
+    it opens a connection.
+    '''
+    class CountingPool(pool_class):
+        def _new_conn(self):
+            transport.connection_opened()
+            return super()._new_conn()
+
+    return CountingPool
+
+
+class PooledAdapter(HTTPAdapter):
+    '''
+    ``HTTPAdapter`` whose connection pools report the connections they open to a
+    ``PooledTransport``.
+    '''
+
+    def __init__(self, transport, **kwargs):
+        self.transport = transport
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool(pool_class, self.transport)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+class PooledTransport:
+    '''
+    Stands in for the ``requests`` module used by ``antares_client``, sending every GET to
+    ANTARES on one ``requests.Session`` shared by all threads, so that connections, and their
+    TLS sessions, are kept alive and reused rather than opened for each request.
+
+    The pool holds ``http_max_connections`` connections, which is also the number of requests
+    in flight at once: further requests wait for a connection to be free. Requests may be
+    limited to ``http_rate_limit`` per second by a token bucket holding ``http_rate_burst``
+    tokens, and ``http_connect_timeout`` and ``http_read_timeout`` override the
+    ``API_TIMEOUT`` of ``antares_client``. Configure in ``settings.py``:
+
+        BROKERS = {
+            'ANTARES': {
+                'http_max_connections': 10,
+                'http_rate_limit': 20,
+                'http_rate_burst': 10,
+                'http_connect_timeout': 5,
+                'http_read_timeout': 60,
+            }
+        }
+
+    ``stats`` counts the requests sent on new and on reused connections, which are also
+    recorded in ``metrics`` as ``tom_antares_http_connections_total``.
+    '''
+
+    def __init__(self, requests_module=requests):
+        self._requests = requests_module
+        self.new_connections = 0
+        self.reused_connections = 0
+        self._session = None
+        self._session_config = None
+        self._rate_limiter = None
+        self._rate_limiter_config = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._requests, name)
+
+    @property
+    def session(self):
+        max_connections = get_antares_setting('http_max_connections', DEFAULT_HTTP_MAX_CONNECTIONS)
+        with self._lock:
+            if self._session_config != max_connections:
+                if self._session is not None:
+                    self._session.close()
+                self._session = self._requests.Session()
+                adapter = PooledAdapter(self, pool_connections=1, pool_maxsize=max_connections, pool_block=True)
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+                self._session_config = max_connections
+            return self._session
+
+    @property
+    def rate_limiter(self):
+        '''
+        The ``RateLimiter`` configured by ``http_rate_limit``, or ``None``.
+        '''
+        config = (
+            get_antares_setting('http_rate_limit'),
+            get_antares_setting('http_rate_burst', DEFAULT_HTTP_RATE_BURST),
+        )
+        with self._lock:
+            if self._rate_limiter_config != config:
+                rate, burst = config
+                self._rate_limiter = RateLimiter(rate, burst=burst) if rate else None
+                self._rate_limiter_config = config
+            return self._rate_limiter
+
+    @staticmethod
+    def timeout(default=None):
+        '''
+        Returns the ``(connect, read)`` timeout of a request for which ``default`` was asked.
+        '''
+        return (
+            get_antares_setting('http_connect_timeout', default),
+            get_antares_setting('http_read_timeout', default),
+        )
+
+    def connection_opened(self):
+        self._local.opened = True
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        self._local.opened = False
+        response = self.session.get(url, params=params, timeout=self.timeout(timeout), **kwargs)
+        # A new connection is opened in the thread sending the request, when none is free
+        connection = 'new' if self._local.opened else 'reused'
+        with self._lock:
+            if connection == 'new':
+                self.new_connections += 1
+            else:
+                self.reused_connections += 1
+        metrics.increment('tom_antares_http_connections_total', connection=connection)
+        return response
+
+    def stats(self):
+        requests_sent = self.new_connections + self.reused_connections
+        return {
+            'requests': requests_sent,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_rate': self.reused_connections / requests_sent if requests_sent else 0.0,
+        }
+
+    def close(self):
+        '''
+        Closes the pooled connections. The pool is opened again by the next request.
+        '''
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._session_config = None
+
+
+http_transport = PooledTransport()
+
+
+def route_antares_client(antares_client=None):
+    '''
+    Routes the HTTP requests ``antares_client`` makes through ``http_transport``, recording
+    them in ``metrics``. Called with the module when ``tom_antares.antares`` first imports
+    ``antares_client``.
+    '''
+    from antares_client._api import api
+    if not isinstance(api.requests, InstrumentedRequests):
+        api.requests = InstrumentedRequests(http_transport)
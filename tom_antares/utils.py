@@ -0,0 +1,153 @@
+import importlib
+import itertools
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+
+class LazyModule:
+    '''
+    Stands in for a module, which is imported when one of its attributes is first used, and
+    then calls ``on_import`` with it. This keeps heavy dependencies such as ``antares_client``
+    and astropy out of the start-up of every process that loads ``TOM_ALERT_CLASSES``.
+    '''
+
+    def __init__(self, name, on_import=None):
+        self._name = name
+        self._on_import = on_import
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._on_import:
+                self._on_import(module)
+            self._module = module
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f'<LazyModule {self._name}>'
+
+
+np = LazyModule('numpy')
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    '''
+    Great-circle separation in degrees between two positions, or arrays of positions,
+    given in degrees. Uses the haversine formula, which is stable for small separations.
+    '''
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(x, dtype=float)) for x in (ra1, dec1, ra2, dec2))
+    a = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))))
+
+
+def numeric_or_nan(value):
+    '''
+    Returns ``value`` if it is a number, or NaN, e.g. for an alert property to be stored in a
+    float array. Booleans are not numbers here.
+    '''
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+
+
+def get_antares_setting(key, default=None):
+    '''
+    Returns ``settings.BROKERS['ANTARES'][key]``, or ``default`` if it has not been configured.
+    '''
+    return getattr(settings, 'BROKERS', {}).get('ANTARES', {}).get(key, default)
+
+
+def chunked(iterable, size):
+    '''
+    Yields successive lists of at most ``size`` items from ``iterable``.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_ids(value):
+    '''
+    Returns the ids in a comma or whitespace separated string, or a list of ids, in order
+    and without duplicates.
+    '''
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r'[\s,]+', value)
+    return list(dict.fromkeys(id_ for id_ in value if id_))
+
+
+def run_concurrently(tasks, max_workers, timeout):
+    '''
+    Runs each callable in ``tasks`` on a pool of at most ``max_workers`` threads.
+
+    Returns a ``(result, error)`` tuple for each task, in the order given, where ``error`` is
+    the exception the task raised, or a ``TimeoutError`` if it was still running ``timeout``
+    seconds after it started. Threads that time out are abandoned rather than interrupted.
+    '''
+    started = {}
+
+    def run(i, task):
+        started[i] = time.monotonic()
+        return task()
+
+    results = [None] * len(tasks)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(run, i, task): i for i, task in enumerate(tasks)}
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                results[futures[future]] = (None, error) if error else (future.result(), None)
+            now = time.monotonic()
+            for future in list(pending):
+                i = futures[future]
+                if i in started and now - started[i] > timeout:
+                    results[i] = (None, TimeoutError(f'Timed out after {timeout} seconds'))
+                    pending.discard(future)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting calls to ``wait``, from any number of threads, to ``rate`` per
+    second, e.g. to keep concurrent requests to ANTARES under ``rate`` per second. Up to
+    ``burst`` calls proceed at once after a quiet spell; with the default of one, calls are
+    spaced at least ``1 / rate`` seconds apart.
+    '''
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._next = None
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        Takes a token, and returns the number of seconds the caller must wait before using it.
+        '''
+        with self._lock:
+            now = self.clock()
+            # The time at which the bucket would be empty, were this call to go ahead
+            empty_at = now if self._next is None else max(now, self._next)
+            start = max(now, empty_at - (self.burst - 1) * self.interval)
+            self._next = empty_at + self.interval
+        return start - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            self.sleep(delay)